@@ -0,0 +1,296 @@
+"""Admission control and load shedding for expensive Warbler routes.
+
+Routes opt in with the `limit` decorator, which combines:
+
+- a per-endpoint concurrency limit (per worker process): requests wait up to
+  `queue_timeout` seconds for a slot and are shed with a 503 after that.
+  Slots aren't shared between processes, so the host-wide cap is
+  `concurrency` times the number of workers, and a sync worker (one request
+  at a time) never queues at all: the limit only does anything under gevent
+  or threaded workers;
+- token-bucket rate limits per client address and per logged-in user: a
+  request over its bucket is shed right away with a 429.
+
+Both responses carry a Retry-After header. Bucket state and the shed/queued
+counters live in a store: in-process memory by default, or a SQLite file
+shared by every worker on the host (set ADMISSION_STORE to its path).
+Each bucket is stored with the time it will be full again, and dropped
+once that has passed, since a full bucket is the same as none. If the SQLite
+file stays locked, requests are let through rather than failed.
+"""
+
+import logging
+import math
+import sqlite3
+import threading
+import time
+from functools import wraps
+
+from flask import g, request
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+
+log = logging.getLogger(__name__)
+
+# How often (seconds) to drop full buckets
+EVICT_INTERVAL = 60
+
+
+class _Eviction:
+    """When to drop full buckets, shared by the stores.
+
+    Which buckets go is up to each bucket's own `full_at`, not to the limits
+    this process happens to have seen, so workers sharing a store never
+    drop another limit's buckets early.
+    """
+
+    def __init__(self):
+        self.next_at = 0
+
+    def due(self, now):
+        """Return whether it's time to evict."""
+
+        if now < self.next_at:
+            return False
+
+        self.next_at = now + EVICT_INTERVAL
+        return True
+
+
+class MemoryStore:
+    """Token buckets and counters for this process only."""
+
+    def __init__(self):
+        self._buckets = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+        self._eviction = _Eviction()
+
+    def take(self, key, rate, burst, now=None):
+        """Take a token from bucket `key`; return seconds to wait, 0 if allowed."""
+
+        now = time.time() if now is None else now
+
+        with self._lock:
+            if self._eviction.due(now):
+                self._buckets = {k: bucket
+                                 for k, bucket in self._buckets.items()
+                                 if bucket[2] > now}
+
+            tokens, updated, _ = self._buckets.get(key, (burst, now, now))
+            tokens, wait = refill_and_take(tokens, updated, now, rate, burst)
+            self._buckets[key] = (tokens, now,
+                                  full_at(tokens, now, rate, burst))
+
+        return wait
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def counters(self):
+        with self._lock:
+            return dict(self._counters)
+
+
+class SQLiteStore:
+    """Token buckets and counters in a SQLite file shared across workers."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._eviction = _Eviction()
+
+        with self._connect() as conn:
+            # buckets from before full_at was stored; dropping them just
+            # refills them
+            conn.execute("DROP TABLE IF EXISTS buckets")
+            conn.execute("CREATE TABLE IF NOT EXISTS token_buckets "
+                         "(key TEXT PRIMARY KEY, tokens REAL, updated REAL, "
+                         "full_at REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS token_buckets_full_at "
+                         "ON token_buckets (full_at)")
+            conn.execute("CREATE TABLE IF NOT EXISTS counters "
+                         "(name TEXT PRIMARY KEY, value INTEGER)")
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def take(self, key, rate, burst, now=None):
+        now = time.time() if now is None else now
+        conn = self._connect()
+        evict = self._eviction.due(now)
+
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            if evict:
+                conn.execute("DELETE FROM token_buckets WHERE full_at <= ?",
+                             (now,))
+            row = conn.execute("SELECT tokens, updated FROM token_buckets "
+                               "WHERE key = ?", (key,)).fetchone()
+            tokens, updated = row if row else (burst, now)
+            tokens, wait = refill_and_take(tokens, updated, now, rate, burst)
+            conn.execute("INSERT OR REPLACE INTO token_buckets "
+                         "VALUES (?, ?, ?, ?)",
+                         (key, tokens, now, full_at(tokens, now, rate, burst)))
+            conn.execute("COMMIT")
+        except sqlite3.OperationalError:
+            # locked past the timeout (or the disk is full): failing the
+            # request would turn a busy limiter into an outage, so let it in
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            log.warning("Admission store unavailable, not limiting %s", key,
+                        exc_info=True)
+            return 0
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+
+        return wait
+
+    def incr(self, name, amount=1):
+        try:
+            self._connect().execute(
+                "INSERT INTO counters VALUES (?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                (name, amount))
+        except sqlite3.OperationalError:
+            log.warning("Admission store unavailable, %s not counted", name,
+                        exc_info=True)
+
+    def __len__(self):
+        return self._connect().execute(
+            "SELECT count(*) FROM token_buckets").fetchone()[0]
+
+    def counters(self):
+        return dict(self._connect().execute("SELECT name, value FROM counters"))
+
+
+def refill_and_take(tokens, updated, now, rate, burst):
+    """Token-bucket step: return (tokens left, seconds to wait or 0)."""
+
+    tokens = min(burst, tokens + max(0, now - updated) * rate)
+
+    if tokens >= 1:
+        return tokens - 1, 0
+
+    return tokens, (1 - tokens) / rate
+
+
+def full_at(tokens, now, rate, burst):
+    """When a bucket holding `tokens` at `now` will have refilled."""
+
+    return now + (burst - tokens) / rate
+
+
+def retry_after(seconds):
+    """Retry-After wants whole seconds; never tell clients 0."""
+
+    return max(1, math.ceil(seconds))
+
+
+class AdmissionControl:
+    """Holds the store and per-endpoint slots for an app."""
+
+    def __init__(self, app=None):
+        self.store = MemoryStore()
+        self._slots = {}
+        self._slots_lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('ADMISSION_ENABLED', True)
+        app.config.setdefault('ADMISSION_STORE', None)
+
+        self.app = app
+        if app.config['ADMISSION_STORE']:
+            self.store = SQLiteStore(app.config['ADMISSION_STORE'])
+
+    def _slot(self, endpoint, concurrency):
+        with self._slots_lock:
+            if endpoint not in self._slots:
+                self._slots[endpoint] = threading.BoundedSemaphore(concurrency)
+            return self._slots[endpoint]
+
+    def _shed(self, endpoint, reason, wait):
+        self.store.incr(f"{endpoint}.shed.{reason}")
+        log.warning("Shed %s (%s), retry after %ss", endpoint, reason, wait)
+
+        if reason == 'concurrency':
+            raise ServiceUnavailable(retry_after=wait)
+        raise TooManyRequests(retry_after=wait)
+
+    def _check_rate(self, endpoint, key, rate, burst):
+        wait = self.store.take(f"{endpoint}:{key}", rate, burst)
+        if wait:
+            self._shed(endpoint, 'rate', retry_after(wait))
+
+    def limit(self, concurrency=None, per_client=None, per_user=None,
+              queue_timeout=1.0, methods=None):
+        """Decorate a view with admission control.
+
+        `per_client` and `per_user` are (tokens per second, burst) pairs.
+        `methods` restricts the limits to those HTTP methods (e.g. only the
+        POST of a login form does the expensive work). `concurrency` is per
+        worker process; see the module docstring.
+        """
+
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                if (not self.app.config['ADMISSION_ENABLED']
+                        or (methods and request.method not in methods)):
+                    return view(*args, **kwargs)
+
+                endpoint = request.endpoint
+
+                if per_client:
+                    self._check_rate(endpoint, f"client:{request.remote_addr}",
+                                     *per_client)
+
+                user = g.get('user')
+                if per_user and user:
+                    self._check_rate(endpoint, f"user:{user.id}", *per_user)
+
+                if not concurrency:
+                    return view(*args, **kwargs)
+
+                slot = self._slot(endpoint, concurrency)
+                if not slot.acquire(blocking=False):
+                    self.store.incr(f"{endpoint}.queued")
+                    if not slot.acquire(timeout=queue_timeout):
+                        self._shed(endpoint, 'concurrency',
+                                   retry_after(queue_timeout))
+
+                try:
+                    response = view(*args, **kwargs)
+                except BaseException:
+                    slot.release()
+                    raise
+
+                # a streamed body is still being rendered after we return
+                if getattr(response, 'is_streamed', False):
+                    response.call_on_close(slot.release)
+                else:
+                    slot.release()
+
+                return response
+
+            return wrapper
+
+        return decorator
+
+    def stats(self):
+        """Shed and queued counts, keyed like 'login.shed.rate'."""
+
+        return self.store.counters()
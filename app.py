@@ -1,15 +1,64 @@
+import hashlib
+import json
 import os
-
-from flask import Flask, render_template, request, flash, redirect, session, g
+import re
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import click
+from flask import (
+    Flask, render_template, request, flash, redirect, session, g, Response,
+    stream_with_context, abort, jsonify, send_file,
+)
 from flask_debugtoolbar import DebugToolbarExtension
+from itsdangerous import URLSafeSerializer, BadSignature
+from werkzeug.middleware.proxy_fix import ProxyFix
+from sqlalchemy import or_
 from sqlalchemy.exc import IntegrityError
 from werkzeug.exceptions import Unauthorized
 
 from forms import UserAddForm, LoginForm, MessageForm, CsrfOnlyForm, EditUserForm
-from models import db, connect_db, User, Message, Like
+from models import (
+    db, connect_db, User, Message, Like, Follows, FollowEvent)
+from admission import AdmissionControl
+from events import make_broker, user_channel, PublishError
+from images import (
+    SIZES as IMAGE_SIZES, ImageError, cached_image, get_serializer as
+    get_image_serializer, proxy_url,
+)
+import profiler
+import traffic
+import warmup
+import archive
+import followgraph
+import jobs
+import profilecache
+import streaming
+from export import export_user, FORMATS as EXPORT_FORMATS
+from search import make_search, index_tags, index_tags_many
+from slow_queries import SlowQueryLog, summarize as summarize_slow_queries
+from streaming import stream_template
+from readmodels import message_rows, user_cards, profile_summary
+from suggestions import compute_suggestions, suggestions_for
+from trending import tracker as trending_tracker
 
 CURR_USER_KEY = "curr_user"
 
+# Most messages/users any one list page shows.
+LIST_LIMIT = 100
+# Liked messages per page of /users/<id>/likes.
+LIKES_PAGE_SIZE = 20
+# Most users a streamed user list (see streaming.py) shows.
+STREAMED_LIST_LIMIT = 5000
+
+# Default and most messages a delta API response (see message_delta) holds.
+DELTA_LIMIT = 100
+
+# Default and most usernames the autocomplete endpoint returns.
+AUTOCOMPLETE_LIMIT = 8
+AUTOCOMPLETE_MAX = 20
+
 app = Flask(__name__)
 
 # Get DB_URI from environ variable (useful for production/testing) or,
@@ -18,23 +67,106 @@ app.config['SQLALCHEMY_DATABASE_URI'] = (
     os.environ['DATABASE_URL'].replace("postgres://", "postgresql://"))
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
+# Green (gevent) workers serve many requests per process at once, so they
+# need a bigger pool than the default 5 connections (see gunicorn.conf.py).
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+    'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+    'pool_pre_ping': True,
+}
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
+app.config['BULK_MESSAGES_MAX'] = int(os.environ.get('BULK_MESSAGES_MAX', 5000))
+app.config['BULK_FOLLOWS_MAX'] = int(os.environ.get('BULK_FOLLOWS_MAX', 1000))
+app.config['ADMISSION_STORE'] = os.environ.get('ADMISSION_STORE')
+app.config['EVENTS_BROKER'] = os.environ.get('EVENTS_BROKER', 'local')
+# Should pages open /stream? "1"/"0", or unset to decide per worker: only
+# where an idle stream doesn't tie up a whole process (see live_updates)
+app.config['LIVE_UPDATES'] = (os.environ['LIVE_UPDATES'] == '1'
+                              if 'LIVE_UPDATES' in os.environ else None)
+app.config['SEARCH_BACKEND'] = os.environ.get('SEARCH_BACKEND', 'postgres')
+app.config['IMAGE_CACHE_DIR'] = os.environ.get(
+    'IMAGE_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'warbler-images'))
+app.config['IMAGE_CACHE_MAX_BYTES'] = int(
+    os.environ.get('IMAGE_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+# Let a front-end server (nginx etc.) send cached images itself
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
+app.config['TEMPLATE_CACHE_DIR'] = os.environ.get(
+    'TEMPLATE_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'warbler-jinja'))
+app.config['FAST_RESPONSE_MS'] = int(os.environ.get('FAST_RESPONSE_MS', 50))
+# Record requests for replay.py (off unless a file is given)
+app.config['TRAFFIC_LOG'] = os.environ.get('TRAFFIC_LOG')
+app.config['TRAFFIC_SAMPLE'] = float(os.environ.get('TRAFFIC_SAMPLE', 1.0))
+app.config['PROFILE_DIR'] = os.environ.get(
+    'PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'warbler-profiles'))
+app.config['PROFILE_SAMPLE'] = float(os.environ.get('PROFILE_SAMPLE', 0.0))
+app.config['PROFILE_INTERVAL_MS'] = float(os.environ.get('PROFILE_INTERVAL_MS', 5))
+app.config['PROFILE_MAX_BYTES'] = int(
+    os.environ.get('PROFILE_MAX_BYTES', 50 * 1024 * 1024))
+# Log (and EXPLAIN) statements slower than this many ms; unset or 0 is off
+app.config['SLOW_QUERY_MS'] = float(os.environ.get('SLOW_QUERY_MS', 0)) or None
+app.config['SLOW_QUERY_LOG'] = os.environ.get('SLOW_QUERY_LOG')
+app.config['ARCHIVE_DIR'] = os.environ.get(
+    'ARCHIVE_DIR', os.path.join(tempfile.gettempdir(), 'warbler-archive'))
+app.config['ARCHIVE_AFTER_DAYS'] = int(os.environ.get('ARCHIVE_AFTER_DAYS', 365))
+# Snapshot file for the in-memory follow graph; unset to always query
+app.config['FOLLOW_GRAPH_PATH'] = os.environ.get('FOLLOW_GRAPH_PATH')
+# File (ideally on tmpfs) for the profile summary cache workers share;
+# unset for no cache. Its size is fixed at SLOTS * 1 KB.
+app.config['PROFILE_SUMMARY_CACHE'] = os.environ.get('PROFILE_SUMMARY_CACHE')
+app.config['PROFILE_SUMMARY_SLOTS'] = int(
+    os.environ.get('PROFILE_SUMMARY_SLOTS', 16384))
+app.config['PROFILE_SUMMARY_TTL'] = float(
+    os.environ.get('PROFILE_SUMMARY_TTL', 60))
 toolbar = DebugToolbarExtension(app)
+admission = AdmissionControl(app)
+slow_query_log = SlowQueryLog(app)
+
+# Number of proxies in front of us (1 on Heroku) whose X-Forwarded-For we
+# trust; rate limits are keyed on the client address this gives us.
+app.wsgi_app = ProxyFix(app.wsgi_app,
+                        x_for=int(os.environ.get('TRUSTED_PROXIES', 0)))
 
 connect_db(app)
+warmup.init_app(app)
+traffic.init_app(app)
+profiler.init_app(app)
+
+broker = make_broker(app.config['EVENTS_BROKER'],
+                     app.config['SQLALCHEMY_DATABASE_URI'])
+search_index = make_search(app.config['SEARCH_BACKEND'])
+if app.config['FOLLOW_GRAPH_PATH'] and not broker.cross_process:
+    # Each worker (and `flask run-jobs`, and CLI commands) would only see
+    # other processes' follows and unfollows when it next reads the
+    # follow_events log, up to RELOAD_INTERVAL late.
+    app.logger.warning("FOLLOW_GRAPH_PATH needs a broker that reaches other "
+                       "processes (EVENTS_BROKER=postgres); not using the "
+                       "follow graph")
+    app.config['FOLLOW_GRAPH_PATH'] = None
+followgraph.configure(app.config['FOLLOW_GRAPH_PATH'], broker,
+                      FollowEvent.since)
+profilecache.configure(app.config['PROFILE_SUMMARY_CACHE'],
+                       app.config['PROFILE_SUMMARY_SLOTS'],
+                       app.config['PROFILE_SUMMARY_TTL'])
 
 
 ##############################################################################
 # User signup/login/logout
 
 
+# Endpoints that never need the current user; skip loading it for them.
+NO_USER_ENDPOINTS = {'static', 'resized_image'}
+
+
 @app.before_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
-    if CURR_USER_KEY in session:
+    if CURR_USER_KEY in session and request.endpoint not in NO_USER_ENDPOINTS:
         g.user = User.query.get(session[CURR_USER_KEY])
+        # still logged in elsewhere when the account was deleted
+        if g.user is not None and g.user.is_deleted:
+            g.user = None
 
     else:
         g.user = None
@@ -52,6 +184,42 @@ def do_logout():
     if CURR_USER_KEY in session:
         del session[CURR_USER_KEY]
 
+def get_api_serializer():
+    """Signs and checks API tokens."""
+
+    return URLSafeSerializer(app.config['SECRET_KEY'], salt="api-token")
+
+
+def password_fingerprint(user):
+    """Short digest of user's password hash; changing password revokes tokens."""
+
+    return hashlib.sha256(user.password.encode()).hexdigest()[:16]
+
+
+def make_api_token(user):
+    """Make a bearer token for the API."""
+
+    return get_api_serializer().dumps([user.id, password_fingerprint(user)])
+
+
+def get_api_user():
+    """Return the user for the request's 'Authorization: Bearer' token, or None."""
+
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not token:
+        return None
+
+    try:
+        user_id, fingerprint = get_api_serializer().loads(token)
+    except (BadSignature, ValueError):
+        return None
+
+    user = User.query.get(user_id)
+    if user and password_fingerprint(user) == fingerprint:
+        return user
+
+    return None
+
 @app.before_request
 def add_csrf_form_to_all_pages():
     """Before every route, add CSRF-only form to global object."""
@@ -60,6 +228,7 @@ def add_csrf_form_to_all_pages():
 
 
 @app.route('/signup', methods=["GET", "POST"])
+@admission.limit(concurrency=2, per_client=(0.1, 5), methods=["POST"])
 def signup():
     """Handle user signup.
 
@@ -96,6 +265,7 @@ def signup():
 
 
 @app.route('/login', methods=["GET", "POST"])
+@admission.limit(concurrency=2, per_client=(0.2, 10), methods=["POST"])
 def login():
     """Handle user login."""
 
@@ -132,7 +302,25 @@ def logout():
 ##############################################################################
 # General user routes:
 
+def streamed(users):
+    """Cards for `users` on a streamed page: capped, read a batch at a time."""
+
+    return user_cards(users
+                      .limit(STREAMED_LIST_LIMIT)
+                      .yield_per(streaming.BATCH_SIZE))
+
+
+def followed_ids():
+    """Ids the logged-in user follows (for the cards' Follow buttons)."""
+
+    if not g.user:
+        return set()
+
+    return {id for (id,) in g.user.following_ids()}
+
+
 @app.get('/users')
+@admission.limit(concurrency=4, per_client=(2, 20))
 def list_users():
     """Page with listing of users.
 
@@ -141,21 +329,61 @@ def list_users():
 
     search = request.args.get('q')
 
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+    users = User.query.filter(~User.is_deleted)
+    if search:
+        users = users.filter(User.username.like(f"%{search}%"))
+
+    return stream_template('users/index.html',
+                           users=streamed(users),
+                           following_ids=followed_ids())
+
+
+@app.get('/api/users/autocomplete')
+def autocomplete_users():
+    """Up to 'limit' (default 8) users whose username starts with 'q'.
 
-    return render_template('users/index.html', users=users)
+    Case-insensitive; served by the lower(username) prefix index.
+    """
+
+    prefix = request.args.get('q', '').strip().lower()
+    limit = min(request.args.get('limit', AUTOCOMPLETE_LIMIT, type=int),
+                AUTOCOMPLETE_MAX)
+
+    if not prefix or limit < 1:
+        return jsonify(users=[])
+
+    # LIKE metacharacters match themselves (Postgres escapes with \)
+    pattern = re.sub(r'([\\%_])', r'\\\1', prefix) + '%'
+    username = db.func.lower(User.username).collate('C')
+
+    rows = (db.session
+            .query(User.id, User.username, User.image_url)
+            .filter(username.like(pattern),
+                    ~User.is_deleted)
+            .order_by(username)
+            .limit(limit)
+            .all())
+
+    response = jsonify(users=[{'id': id, 'username': name,
+                               'image_url': resized(image_url, 'nav')}
+                              for id, name, image_url in rows])
+    response.cache_control.public = True
+    response.cache_control.max_age = 60
+    return response
 
 
 @app.get('/users/<int:user_id>')
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
+    user = profile_summary(user_id) or abort(404)
+
+    messages = message_rows(Message.query
+                            .filter(Message.user_id == user_id)
+                            .order_by(Message.timestamp.desc()),
+                            limit=LIST_LIMIT)
 
-    return render_template('users/show.html', user=user)
+    return render_template('users/show.html', user=user, messages=messages)
 
 
 @app.get('/users/<int:user_id>/following')
@@ -166,8 +394,15 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    user = profile_summary(user_id) or abort(404)
+    following = (User.query
+                 .join(Follows, Follows.user_being_followed_id == User.id)
+                 .filter(Follows.user_following_id == user_id))
+
+    return stream_template('users/following.html',
+                           user=user,
+                           following=streamed(following),
+                           following_ids=followed_ids())
 
 
 @app.get('/users/<int:user_id>/followers')
@@ -178,8 +413,15 @@ def users_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    user = profile_summary(user_id) or abort(404)
+    followers = (User.query
+                 .join(Follows, Follows.user_following_id == User.id)
+                 .filter(Follows.user_being_followed_id == user_id))
+
+    return stream_template('users/followers.html',
+                           user=user,
+                           followers=streamed(followers),
+                           following_ids=followed_ids())
 
 
 @app.post('/users/follow/<int:follow_id>')
@@ -191,8 +433,7 @@ def add_follow(follow_id):
         return redirect("/")
 
     followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
+    g.user.follow(followed_user.id)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -205,9 +446,7 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
-    db.session.commit()
+    g.user.unfollow(follow_id)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -228,6 +467,7 @@ def profile():
         if User.authenticate(g.user.username, password):
             db.session.add(g.user)
             db.session.commit()
+            profilecache.invalidate(g.user.id)
             return redirect(f"/users/{g.user.id}")
 
         else:
@@ -247,12 +487,57 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    # Free the username and email, lock the account out (password and API
+    # tokens) and drop the follows right away, so it can't log in, post or
+    # show up in timelines; the `delete_user` job removes the rest in the
+    # background.
+    user_id = g.user.id
+    g.user.mark_deleted()
+    follows = Follows.query.filter(or_(Follows.user_following_id == user_id,
+                                       Follows.user_being_followed_id == user_id))
+    removed = follows.with_entities(Follows.user_following_id,
+                                    Follows.user_being_followed_id).all()
+    follows.delete()
+    FollowEvent.log(removed, False)
+    jobs.enqueue('delete_user', {'user_id': user_id}, key=f"delete-user:{user_id}")
     db.session.commit()
 
+    # everyone on the other end of a follow has one fewer follower/following
+    for affected_id in {user_id}.union(*removed):
+        profilecache.invalidate(affected_id)
+
+    for follower_id, followed_id in removed:
+        followgraph.record(follower_id, followed_id, False)
+
     return redirect("/signup")
 
 
+@app.get('/users/export')
+def export_data():
+    """Download the current user's messages, likes and follows.
+
+    Takes a 'format' param in querystring: 'ndjson' (default) or 'csv'.
+    The gzip-compressed file is streamed as it is produced.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    format = request.args.get('format', 'ndjson')
+    if format not in EXPORT_FORMATS:
+        abort(400)
+
+    filename = f"warbler-{g.user.username}.{format}.gz"
+
+    return Response(
+        stream_with_context(export_user(g.user, format,
+                                        app.config['ARCHIVE_DIR'])),
+        mimetype='application/gzip',
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'},
+    )
+
+
 ##############################################################################
 # Messages routes:
 
@@ -271,21 +556,72 @@ def messages_add():
 
     if form.validate_on_submit():
 
-        msg = Message(text=form.text.data)
+        msg = Message(text=form.text.data, user_id=g.user.id)
 
-        g.user.messages.append(msg)
+        db.session.add(msg)
+        db.session.flush()
+        jobs.enqueue('index_message', {'message_id': msg.id},
+                     key=f"index-message:{msg.id}")
         db.session.commit()
+        profilecache.invalidate(g.user.id)
+        search_index.add(msg)
+
+        trending_tracker.record_message(msg.id)
+        trending_tracker.maybe_sync()
+
+        # the message is saved either way; open streams just won't see it
+        # until they reload
+        try:
+            broker.publish(user_channel(g.user.id), {
+                "id": msg.id,
+                "html": render_template('messages/_item.html', msg=msg),
+            })
+        except PublishError:
+            app.logger.exception("Couldn't publish message %s", msg.id)
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
+@app.get('/messages/search')
+def messages_search():
+    """Search messages.
+
+    Takes querystring params 'q' (words, a "#hashtag" or an "@username"),
+    'sort' ('relevance' or 'recent') and 'page'.
+    """
+
+    q = request.args.get('q', '').strip()
+    sort = request.args.get('sort', 'relevance')
+    page = request.args.get('page', 1, type=int)
+
+    if sort not in ('relevance', 'recent'):
+        sort = 'relevance'
+
+    messages, has_next = (search_index.search(q, sort, max(page, 1))
+                          if q else ([], False))
+
+    return render_template('messages/search.html',
+                           messages=messages,
+                           q=q,
+                           sort=sort,
+                           page=page,
+                           has_next=has_next)
+
+
 @app.get('/messages/<int:message_id>')
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get_or_404(message_id)
+    msg = Message.query.get(message_id)
+
+    if msg is None:
+        msg = archive.find_message(app.config['ARCHIVE_DIR'], message_id)
+        # an author who's gone takes their archived messages with them
+        if msg is None or msg.user is None:
+            abort(404)
+        return render_template('messages/show.html', message=msg, archived=True)
 
     return render_template('messages/show.html', message=msg)
 
@@ -294,7 +630,22 @@ def messages_show(message_id):
 def messages_destroy(message_id):
     """Delete a message."""
 
-    msg = Message.query.get_or_404(message_id)
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    msg = Message.query.get(message_id)
+
+    if msg is None:
+        archived = archive.find_message(app.config['ARCHIVE_DIR'], message_id)
+        if archived is None:
+            abort(404)
+        if archived.user_id != g.user.id:
+            flash("Access unauthorized.", "danger")
+            return redirect("/")
+        archive.remove(app.config['ARCHIVE_DIR'], message_ids=[message_id])
+        return redirect(f"/users/{g.user.id}")
+
     user = msg.user_id
 
     if  g.user.id != user:
@@ -304,10 +655,188 @@ def messages_destroy(message_id):
 
     db.session.delete(msg)
     db.session.commit()
+    profilecache.invalidate(user)
+
+    trending_tracker.discard(message_id)
+    search_index.remove(message_id)
 
     return redirect(f"/users/{g.user.id}")
 
 
+@app.post('/api/messages/bulk')
+def api_bulk_messages():
+    """Add many messages for the token's user in one batch.
+
+    Expects JSON like {"messages": ["text", {"text": "more text"}, ...]}.
+    Invalid items are reported by index; the rest are still added.
+    """
+
+    user = get_api_user()
+    if not user:
+        return jsonify(error="Invalid or missing API token."), 401
+
+    data = request.get_json(silent=True)
+    items = data.get('messages') if isinstance(data, dict) else None
+
+    if not isinstance(items, list):
+        return jsonify(error='Expected JSON like {"messages": [...]}.'), 400
+
+    if len(items) > app.config['BULK_MESSAGES_MAX']:
+        return jsonify(error=f"At most {app.config['BULK_MESSAGES_MAX']} "
+                             "messages per request."), 413
+
+    texts = [item.get('text') if isinstance(item, dict) else item
+             for item in items]
+    ids, errors = Message.bulk_create(user.id, texts)
+    index_later(ids)
+    db.session.commit()
+    profilecache.invalidate(user.id)
+    search_index.add_ids(ids)
+
+    return jsonify(added=len(ids), errors=errors)
+
+
+@app.post('/api/follows/bulk')
+def api_bulk_follows():
+    """Follow and/or unfollow many users for the token's user.
+
+    Expects JSON like {"follow": [...], "unfollow": [...]} (either or both),
+    listing user ids or usernames. Both lists are applied in one
+    transaction, follows first. Each list gets a result per item back, under
+    the same key (see `User.follow_many`).
+    """
+
+    user = get_api_user()
+    if not user:
+        return jsonify(error="Invalid or missing API token."), 401
+
+    data = request.get_json(silent=True)
+    if (not isinstance(data, dict) or
+            not {'follow', 'unfollow'} & data.keys() or
+            not all(isinstance(data[key], list)
+                    for key in ('follow', 'unfollow') if key in data)):
+        return jsonify(error='Expected JSON like {"follow": [...], '
+                             '"unfollow": [...]}.'), 400
+
+    if (len(data.get('follow', [])) + len(data.get('unfollow', [])) >
+            app.config['BULK_FOLLOWS_MAX']):
+        return jsonify(error=f"At most {app.config['BULK_FOLLOWS_MAX']} "
+                             "users per request."), 413
+
+    followed, unfollowed = user.update_follows(data.get('follow', ()),
+                                               data.get('unfollow', ()))
+
+    results = {}
+    if 'follow' in data:
+        results['follow'] = followed
+    if 'unfollow' in data:
+        results['unfollow'] = unfollowed
+
+    return jsonify(results)
+
+
+def parse_utc(value):
+    """Parse an ISO 8601 time into the naive UTC datetimes the columns hold.
+
+    A trailing "Z" or an offset is converted to UTC; a time without one is
+    taken to be UTC already. Raises ValueError if `value` isn't ISO 8601.
+    """
+
+    if value.endswith(('Z', 'z')):
+        value = value[:-1] + '+00:00'
+
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def message_delta(query):
+    """JSON for the messages in `query` newer than the client's cursor.
+
+    The cursor is `since_id` (a message id) or `since_timestamp` (ISO 8601,
+    UTC unless it has an offset); without one, the newest messages are
+    returned to start from. At most `limit` (default and max DELTA_LIMIT)
+    are returned, newest first. Responds 304 with no body when there's
+    nothing new.
+
+    `since_id` polls go by id, so for each user in `query` they read only
+    the (user_id, id) index entries past the cursor, up to the limit;
+    `since_timestamp` does the same on (user_id, timestamp).
+
+    Ids and timestamps are assigned when a message is inserted, not when it
+    commits, so a message whose transaction commits after a later one's can
+    land behind a cursor the client already has and never be returned.
+    Clients that mind should ask from a few seconds earlier and drop the
+    ids they've seen.
+    """
+
+    since_id = request.args.get('since_id', type=int)
+    since_timestamp = request.args.get('since_timestamp')
+    limit = min(request.args.get('limit', DELTA_LIMIT, type=int), DELTA_LIMIT)
+
+    if limit < 1:
+        return jsonify(error=f"limit must be 1 to {DELTA_LIMIT}."), 400
+
+    if since_id is not None:
+        query = (query
+                 .filter(Message.id > since_id)
+                 .order_by(Message.id.desc()))
+    else:
+        if since_timestamp:
+            try:
+                query = query.filter(
+                    Message.timestamp > parse_utc(since_timestamp))
+            except ValueError:
+                return jsonify(error="since_timestamp must be ISO 8601."), 400
+        query = query.order_by(Message.timestamp.desc(), Message.id.desc())
+
+    rows = (query
+            .join(User, User.id == Message.user_id)
+            .with_entities(Message.id, Message.text, Message.timestamp,
+                           Message.user_id, User.username)
+            .limit(limit + 1)
+            .all())
+
+    if not rows:
+        return Response(status=304)
+
+    messages = [{'id': id, 'text': text, 'timestamp': timestamp.isoformat(),
+                 'user_id': user_id, 'username': username}
+                for id, text, timestamp, user_id, username in rows[:limit]]
+
+    return jsonify(messages=messages,
+                   since_id=max(message['id'] for message in messages),
+                   since_timestamp=max(timestamp for _, _, timestamp, _, _
+                                       in rows[:limit]).isoformat(),
+                   more=len(rows) > limit)
+
+
+@app.get('/api/timeline')
+def api_timeline():
+    """Home timeline messages newer than the cursor (see `message_delta`).
+
+    Works with the session cookie or an API token.
+    """
+
+    user = g.user or get_api_user()
+    if not user:
+        return jsonify(error="Log in or send an API token."), 401
+
+    return message_delta(
+        Message.query.filter(or_(Message.user_id == user.id,
+                                 Message.user_id.in_(user.following_ids()))))
+
+
+@app.get('/api/users/<int:user_id>/messages')
+def api_user_messages(user_id):
+    """A user's messages newer than the cursor (see `message_delta`)."""
+
+    User.query.get_or_404(user_id)
+
+    return message_delta(Message.query.filter(Message.user_id == user_id))
+
+
 ##############################################################################
 #handling like routes
 
@@ -319,8 +848,10 @@ def like_a_message(message_id):
     msg = Message.query.get(message_id)
 
     if form.validate_on_submit():
-        g.user.like_message(msg)
-        return redirect(request.referrer)
+        if g.user.like_message(msg):
+            trending_tracker.record_like(msg.id)
+            trending_tracker.maybe_sync()
+        return redirect(request.referrer or "/")
 
     raise Unauthorized()
 
@@ -333,19 +864,175 @@ def unlike_a_message(message_id):
     msg = Message.query.get(message_id)
 
     if form.validate_on_submit():
-        g.user.unlike_message(msg)
-        return redirect(request.referrer)
+        liked_at = g.user.unlike_message(msg)
+        if liked_at:
+            trending_tracker.record_unlike(
+                msg.id, liked_at.replace(tzinfo=timezone.utc).timestamp())
+            trending_tracker.maybe_sync()
+        return redirect(request.referrer or "/")
 
     raise Unauthorized()
 
 @app.get('/users/<int:user_id>/likes')
 def get_and_display_liked_messages(user_id):
-    """Get users liked messages from db and display on page"""
+    """Show the messages a user liked, most recently liked first.
+
+    A page at a time: the cursor ('before', the ISO 8601 time of the last
+    like shown, and 'before_id', its message id) comes from the "Older
+    likes" link.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    user = profile_summary(user_id) or abort(404)
+
+    query = (Message
+             .query
+             .join(Like, Like.message_id == Message.id)
+             .filter(Like.user_id == user.id)
+             .order_by(Like.created_at.desc(), Like.message_id.desc()))
+
+    before = request.args.get('before')
+    before_id = request.args.get('before_id', type=int)
+    if before and before_id is not None:
+        try:
+            before = parse_utc(before)
+        except ValueError:
+            abort(400)
+        query = query.filter(db.tuple_(Like.created_at, Like.message_id) <
+                             db.tuple_(before, before_id))
+
+    rows = message_rows(query, Like.created_at,
+                        limit=LIKES_PAGE_SIZE + 1)
+    messages = [message for message, _ in rows[:LIKES_PAGE_SIZE]]
+
+    older = None
+    if len(rows) > LIKES_PAGE_SIZE:
+        message, liked_at = rows[LIKES_PAGE_SIZE - 1]
+        older = {'before': liked_at.isoformat(), 'before_id': message.id}
+
+    liked_ids = ({message.id for message in messages} if user.id == g.user.id
+                 else g.user.liked_message_ids(messages))
+
+    return render_template('users/likes.html',
+                           user=user,
+                           messages=messages,
+                           liked_ids=liked_ids,
+                           older=older)
+
+
+
+@app.get('/trending')
+def trending():
+    """Show the currently trending messages.
+
+    Ranking comes from the in-memory trending tracker; only the listed
+    messages are fetched, by primary key.
+    """
+
+    trending_tracker.load()
+    trending_tracker.maybe_sync()
+
+    ids = trending_tracker.top_ids()
+    found = {msg.id: msg
+             for msg in message_rows(Message.query.filter(Message.id.in_(ids)))}
+    messages = [found[id] for id in ids if id in found]
+
+    return render_template('messages/trending.html',
+                           messages=messages,
+                           liked_ids=(g.user.liked_message_ids(messages)
+                                      if g.user else set()))
+
+
+def live_updates():
+    """Should this page open /stream?
+
+    Each open stream holds a connection for as long as the page is open,
+    which in a sync worker is the whole process. Unless LIVE_UPDATES says
+    otherwise, only gevent workers and threaded servers open streams.
+    """
+
+    if app.config['LIVE_UPDATES'] is not None:
+        return app.config['LIVE_UPDATES']
+
+    return (profiler.green_worker() or
+            bool(request.environ.get('wsgi.multithread')))
 
-    messages = g.user.likes
 
-    return render_template('users/likes.html', messages=messages)
+@app.get('/stream')
+def stream():
+    """Server-sent events: new messages from people the user follows.
 
+    Each event's data is JSON with the message id and its rendered list
+    item. Comments are sent every 15 seconds to keep proxies from
+    dropping idle connections.
+    """
+
+    if not g.user:
+        raise Unauthorized()
+
+    channels = [user_channel(user_id) for (user_id,) in g.user.following_ids()]
+    channels.append(user_channel(g.user.id))
+    subscription = broker.subscribe(channels)
+
+    # the generator outlives the request's DB session, so it touches only
+    # the subscription
+    def events():
+        yield "retry: 5000\n\n"
+
+        while True:
+            event = subscription.get(timeout=15)
+            if event is None:
+                yield ": keepalive\n\n"
+            else:
+                yield (f"id: {event['id']}\n"
+                       f"event: warble\n"
+                       f"data: {json.dumps(event)}\n\n")
+
+    response = Response(events(), mimetype='text/event-stream')
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.call_on_close(subscription.close)
+
+    return response
+
+
+##############################################################################
+# Image proxy
+
+@app.template_filter('resized')
+def resized(url, size):
+    """Template filter: proxy URL for image `url` at one of IMAGE_SIZES."""
+
+    return proxy_url(url, size, app.config['SECRET_KEY'])
+
+
+@app.get('/images/<size>/<token>')
+def resized_image(size, token):
+    """Serve a resized copy of the signed image URL in `token`.
+
+    Falls back to redirecting to the original if it can't be fetched.
+    """
+
+    if size not in IMAGE_SIZES:
+        abort(404)
+
+    try:
+        url = get_image_serializer(app.config['SECRET_KEY']).loads(token)
+    except BadSignature:
+        abort(404)
+
+    try:
+        path = cached_image(url, size, app.config['IMAGE_CACHE_DIR'],
+                            app.config['IMAGE_CACHE_MAX_BYTES'])
+    except ImageError:
+        return redirect(url)
+
+    response = send_file(path, mimetype='image/jpeg', max_age=31536000)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
 
 
 ##############################################################################
@@ -354,6 +1041,7 @@ def get_and_display_liked_messages(user_id):
 
 
 @app.get('/')
+@admission.limit(concurrency=8, per_user=(2, 20))
 def homepage():
     """Show homepage:
 
@@ -363,22 +1051,355 @@ def homepage():
 
     if g.user:
 
-        following_ids = [user.id for user in g.user.following]
-        following_ids.append(g.user.id)
-
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-
-        return render_template('home.html', messages=messages)
+        messages = message_rows(
+            Message
+            .query
+            .filter(or_(Message.user_id == g.user.id,
+                        Message.user_id.in_(g.user.following_ids())))
+            .order_by(Message.timestamp.desc()),
+            limit=100)
+
+        return render_template('home.html',
+                               messages=messages,
+                               liked_ids=g.user.liked_message_ids(messages),
+                               profile=profile_summary(g.user.id),
+                               suggestions=suggestions_for(g.user),
+                               live_updates=live_updates())
 
     else:
         return render_template('home-anon.html')
 
 
+##############################################################################
+# Deferred jobs (run by `flask run-jobs`; see jobs.py)
+
+@jobs.job('index_message', concurrency=4)
+def index_message_job(message_id):
+    """Record a new message's hashtags and mentions."""
+
+    msg = Message.query.get(message_id)
+    if msg:
+        index_tags(msg)
+
+
+@jobs.job('index_messages', concurrency=4)
+def index_messages_job(message_ids):
+    """Record the hashtags and mentions of messages added in bulk."""
+
+    index_tags_many(db.session
+                    .query(Message.id, Message.text)
+                    .filter(Message.id.in_(message_ids)))
+
+
+def index_later(message_ids):
+    """Queue one job to index `message_ids` (caller commits)."""
+
+    if message_ids:
+        jobs.enqueue('index_messages', {'message_ids': message_ids},
+                     key=f"index-messages:{message_ids[0]}-{message_ids[-1]}")
+
+
+@jobs.job('delete_user', concurrency=1)
+def delete_user_job(user_id):
+    """Delete a user: their archived messages and likes, then their
+    messages, a batch per transaction, then the account."""
+
+    archive.remove(app.config['ARCHIVE_DIR'], user_id=user_id)
+
+    while True:
+        ids = [id for (id,) in (db.session
+                                .query(Message.id)
+                                .filter(Message.user_id == user_id)
+                                .limit(1000))]
+        if not ids:
+            break
+        Message.query.filter(Message.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+
+    User.query.filter_by(id=user_id).delete()
+    # committed here, so the profile can't be cached again after this
+    db.session.commit()
+    profilecache.invalidate(user_id)
+
+
+##############################################################################
+# Command-line jobs
+
+@app.cli.command('suggest-follows')
+@click.option('--per-user', default=10, help="Suggestions to keep per user.")
+@click.option('--batch-size', default=1000, help="Follower ids per batch.")
+def suggest_follows(per_user, batch_size):
+    """Recompute "who to follow" suggestions for every user."""
+
+    written = compute_suggestions(per_user=per_user, batch_size=batch_size)
+    click.echo(f"Wrote {written} suggestions.")
+
+
+@app.cli.command('export-user')
+@click.argument('username')
+@click.option('--format', 'format', default='ndjson',
+              type=click.Choice(list(EXPORT_FORMATS)))
+@click.option('--output', type=click.File('wb'), default='-',
+              help="File to write (default: stdout).")
+def export_user_command(username, format, output):
+    """Write a gzipped export of USERNAME's data."""
+
+    user = User.query.filter_by(username=username).first()
+    if not user:
+        raise click.ClickException(f"No user named {username}")
+
+    for chunk in export_user(user, format, app.config['ARCHIVE_DIR']):
+        output.write(chunk)
+
+
+@app.cli.command('api-token')
+@click.argument('username')
+def api_token_command(username):
+    """Print an API token for USERNAME (revoked when they change password)."""
+
+    user = User.query.filter_by(username=username).first()
+    if not user:
+        raise click.ClickException(f"No user named {username}")
+
+    click.echo(make_api_token(user))
+
+
+@app.cli.command('profile-token')
+def profile_token_command():
+    """Print an X-Warbler-Profile header value (good for an hour)."""
+
+    click.echo(profiler.make_token(app.config['SECRET_KEY']))
+
+
+@app.cli.command('ingest-messages')
+@click.argument('username')
+@click.argument('file', type=click.File('r'))
+@click.option('--batch-size', default=1000, help="Messages per insert.")
+def ingest_messages_command(username, file, batch_size):
+    """Add one message per line of FILE for USERNAME."""
+
+    user = User.query.filter_by(username=username).first()
+    if not user:
+        raise click.ClickException(f"No user named {username}")
+
+    total = 0
+    batch = []
+    first_line = 1
+
+    def flush():
+        ids, errors = Message.bulk_create(user.id, batch)
+        index_later(ids)
+        db.session.commit()
+        for error in errors:
+            click.echo(f"line {first_line + error['index']}: {error['error']}",
+                       err=True)
+        return len(ids)
+
+    for line_number, line in enumerate(file, start=1):
+        batch.append(line.rstrip("\n"))
+        if len(batch) == batch_size:
+            total += flush()
+            batch = []
+            first_line = line_number + 1
+
+    if batch:
+        total += flush()
+
+    click.echo(f"Added {total} messages.")
+
+
+@app.cli.command('follow-users')
+@click.argument('username')
+@click.argument('file', type=click.File('r'))
+@click.option('--unfollow', is_flag=True, help="Unfollow them instead.")
+@click.option('--ids', is_flag=True, help="Lines are user ids, not usernames.")
+@click.option('--batch-size', default=1000, help="Users per transaction.")
+def follow_users_command(username, file, unfollow, ids, batch_size):
+    """Have USERNAME follow each user listed (one per line) in FILE."""
+
+    user = User.query.filter_by(username=username).first()
+    if not user:
+        raise click.ClickException(f"No user named {username}")
+
+    counts = {}
+    batch = []
+    first_line = 1
+
+    def flush():
+        for index, result in enumerate(
+                user.follow_many(batch, following=not unfollow)):
+            counts[result['status']] = counts.get(result['status'], 0) + 1
+            if result['status'] in ('not_found', 'invalid', 'self'):
+                click.echo(f"line {first_line + index}: {result['status']}",
+                           err=True)
+
+    for line_number, line in enumerate(file, start=1):
+        line = line.strip()
+        if ids:
+            # anything else (including ids too big to be one) is invalid
+            batch.append(int(line) if re.fullmatch(r"[0-9]{1,10}", line)
+                         else None)
+        else:
+            batch.append(line)
+        if len(batch) == batch_size:
+            flush()
+            batch = []
+            first_line = line_number + 1
+
+    if batch:
+        flush()
+
+    click.echo(", ".join(f"{status}: {count}"
+                         for status, count in sorted(counts.items())))
+
+
+@app.cli.command('reindex-messages')
+@click.option('--batch-size', default=1000, help="Messages per transaction.")
+def reindex_messages_command(batch_size):
+    """Record the hashtags and mentions of every message again.
+
+    For messages whose index jobs never ran (or ran with older rules).
+    """
+
+    total = 0
+    last_id = 0
+
+    while True:
+        batch = (db.session
+                 .query(Message.id, Message.text)
+                 .filter(Message.id > last_id)
+                 .order_by(Message.id)
+                 .limit(batch_size)
+                 .all())
+        if not batch:
+            break
+
+        index_tags_many(batch)
+        db.session.commit()
+        total += len(batch)
+        last_id = batch[-1].id
+
+    click.echo(f"Indexed {total} messages.")
+
+
+@app.cli.command('admission-stats')
+def admission_stats_command():
+    """Print shed and queued request counts.
+
+    Counts are shared across workers only when ADMISSION_STORE is set;
+    otherwise each worker keeps (and logs) its own.
+    """
+
+    for name, value in sorted(admission.stats().items()):
+        click.echo(f"{name}\t{value}")
+
+
+@app.cli.command('archive-messages')
+@click.option('--older-than-days', type=int,
+              help="Default: ARCHIVE_AFTER_DAYS.")
+def archive_messages_command(older_than_days):
+    """Move old messages out of the database into ARCHIVE_DIR."""
+
+    if older_than_days is None:
+        older_than_days = app.config['ARCHIVE_AFTER_DAYS']
+
+    archived = archive.archive_messages(app.config['ARCHIVE_DIR'],
+                                        older_than_days)
+    for month, count in archived.items():
+        click.echo(f"{month}: archived {count} messages")
+    click.echo(f"Archived {sum(archived.values())} messages.")
+
+
+@app.cli.command('run-jobs')
+@click.option('--once', is_flag=True, help="Stop when no jobs are runnable.")
+@click.option('--poll-interval', default=1.0, help="Seconds between polls.")
+def run_jobs_command(once, poll_interval):
+    """Run queued jobs (the Procfile's worker process)."""
+
+    count = jobs.work(once=once, poll_interval=poll_interval)
+    click.echo(f"Ran {count} jobs.")
+
+
+@app.cli.command('job-stats')
+def job_stats_command():
+    """Print how many jobs there are of each kind and status."""
+
+    for (kind, status), count in sorted(jobs.stats().items()):
+        click.echo(f"{kind}\t{status}\t{count}")
+
+
+@app.cli.command('slow-queries')
+@click.option('--top', default=10, help="Statements to show.")
+@click.option('--plans/--no-plans', default=True, help="Show query plans.")
+def slow_queries_command(top, plans):
+    """Summarize SLOW_QUERY_LOG: the statements with the most slow time."""
+
+    path = app.config['SLOW_QUERY_LOG']
+    if not path:
+        raise click.ClickException("SLOW_QUERY_LOG isn't set")
+
+    with open(path) as file:
+        records = [json.loads(line) for line in file if line.strip()]
+
+    for summary in summarize_slow_queries(records, top):
+        click.echo(f"{summary['total_ms']:10.0f} ms total  {summary['count']:5}x  "
+                   f"max {summary['max_ms']:.0f} ms  "
+                   f"{', '.join(summary['sources'])}")
+        click.echo(f"    {summary['normalized']}")
+        click.echo(f"    params: {json.dumps(summary['params'])}")
+        if plans and summary['plan']:
+            for line in summary['plan'].splitlines():
+                click.echo(f"      {line}")
+        click.echo()
+
+
+@app.cli.command('build-follow-graph')
+def build_follow_graph_command():
+    """Write a follow graph snapshot to FOLLOW_GRAPH_PATH."""
+
+    path = app.config['FOLLOW_GRAPH_PATH']
+    if not path:
+        raise click.ClickException("FOLLOW_GRAPH_PATH isn't set")
+
+    # One consistent view of users and follows for the whole build, on a
+    # connection of its own (the session's may already be in a transaction
+    # at another level); rows are streamed from server-side cursors.
+    follower = Follows.user_following_id
+    followed = Follows.user_being_followed_id
+    with db.engine.connect().execution_options(
+            isolation_level='REPEATABLE READ',
+            stream_results=True) as connection, connection.begin():
+        built_at = time.time()
+        max_id = connection.execute(
+            db.select(db.func.max(User.id))).scalar() or 0
+        graph = followgraph.FollowGraph.build(
+            connection.execute(db.select(follower, followed)
+                               .order_by(follower, followed)),
+            connection.execute(db.select(followed, follower)
+                               .order_by(followed, follower)),
+            max_id, built_at)
+
+    graph.save(path)
+
+    # processes load this snapshot (or a newer one) within RELOAD_INTERVAL
+    FollowEvent.query.filter(
+        FollowEvent.at < built_at - followgraph.EVENTS_KEPT).delete()
+    db.session.commit()
+
+    click.echo(f"Saved {len(graph.following)} follows for user ids up to "
+               f"{max_id} to {path}.")
+
+
+@app.cli.command('compile-templates')
+def compile_templates_command():
+    """Compile every template into the bytecode cache."""
+
+    timings = warmup.compile_templates(app)
+    for name, seconds in sorted(timings.items()):
+        click.echo(f"{seconds * 1000:8.1f} ms  {name}")
+    click.echo(f"{len(timings)} templates in {sum(timings.values()):.3f}s")
+
+
 ##############################################################################
 # Turn off all caching in Flask
 #   (useful for dev; in production, this kind of stuff is typically
@@ -388,10 +1409,11 @@ def homepage():
 
 @app.after_request
 def add_header(response):
-    """Add non-caching headers on every request."""
+    """Add non-caching headers on every request that didn't set its own."""
 
     # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
-    response.cache_control.no_store = True
+    if response.cache_control.max_age is None:
+        response.cache_control.no_store = True
     return response
 
 ##############################################################################
@@ -0,0 +1,312 @@
+"""Archival of old messages to compressed files on local disk.
+
+`flask archive-messages` moves messages older than ARCHIVE_AFTER_DAYS out of
+the `messages` table, a calendar month at a time, into gzipped NDJSON files
+(one message per line, in id order, with the ids of users who liked it):
+
+    <ARCHIVE_DIR>/messages-<YYYY-MM>-<first id>-<last id>.ndjson.gz
+
+so the table (and every index timelines scan) only holds recent history.
+`find_message` reads a message back from the archive (scanning its file
+only up to it); `messages_show` falls back to it for ids no longer in the
+table.
+
+Archived messages are still their authors' data: `remove` rewrites the
+files without a deleted message, or without everything of a deleted
+account (its messages, and it from other messages' likes), and
+`user_records` reads a user's archived messages and likes for exports.
+"""
+
+import fcntl
+import gzip
+import json
+import os
+import re
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import cached_property
+
+from models import db, User, Message, Like
+
+BATCH_SIZE = 1000
+
+FILENAME_RE = re.compile(r"messages-(\d{4}-\d{2})-(\d+)-(\d+)\.ndjson\.gz$")
+
+# held while a file is rewritten, so two rewrites can't lose each other's
+# changes
+LOCK_FILENAME = ".lock"
+
+
+class ArchivedMessage:
+    """A message read back from the archive; quacks like `Message`."""
+
+    def __init__(self, record):
+        self.id = record['id']
+        self.text = record['text']
+        self.timestamp = datetime.fromisoformat(record['timestamp'])
+        self.user_id = record['user_id']
+        self.liked_by = record['liked_by']
+
+    @cached_property
+    def user(self):
+        """The author, or None if the account is gone."""
+
+        return User.query.get(self.user_id)
+
+
+def month_start(timestamp):
+    return timestamp.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(timestamp):
+    return month_start(month_start(timestamp) + timedelta(days=32))
+
+
+def write_archive(archive_dir, month, records):
+    """Write `records` for `month` to a new archive file; return its path
+    (None if there were no records).
+
+    `records` can be any iterable; it's written as it's read.
+    """
+
+    os.makedirs(archive_dir, exist_ok=True)
+    ids = []
+
+    # write to a temporary file first so readers never see a partial archive
+    fd, tmp_path = tempfile.mkstemp(dir=archive_dir)
+    with os.fdopen(fd, 'wb') as raw, gzip.open(raw, 'wt') as file:
+        for record in records:
+            file.write(json.dumps(record) + "\n")
+            ids.append(record['id'])
+
+    if not ids:
+        os.remove(tmp_path)
+        return None
+    first_id, last_id = min(ids), max(ids)
+
+    path = os.path.join(archive_dir,
+                        f"messages-{month:%Y-%m}-{first_id}-{last_id}.ndjson.gz")
+    os.replace(tmp_path, path)
+
+    return path
+
+
+def archive_month(archive_dir, start, end):
+    """Archive and delete the messages from `start` up to `end`.
+
+    Messages are read a batch at a time, so a busy month doesn't have to
+    fit in memory. Returns the number of messages archived.
+
+    The messages are locked as they're read (FOR UPDATE), and their likes
+    FOR SHARE, until they're deleted: a like or unlike of one of them waits,
+    then finds it gone, rather than being lost between what's written to
+    the file and what's deleted.
+    """
+
+    messages = (db.session
+                .query(Message.id, Message.text, Message.timestamp,
+                       Message.user_id)
+                .filter(Message.timestamp >= start, Message.timestamp < end)
+                .order_by(Message.id)
+                .with_for_update()
+                .yield_per(BATCH_SIZE))
+    ids = []
+
+    def records():
+        batch = []
+        for row in messages:
+            batch.append(row)
+            if len(batch) == BATCH_SIZE:
+                yield from batch_records(batch)
+                batch = []
+        yield from batch_records(batch)
+
+    def batch_records(batch):
+        liked_by = {}
+        for message_id, user_id in (db.session
+                                    .query(Like.message_id, Like.user_id)
+                                    .filter(Like.message_id.in_(
+                                        [id for id, _, _, _ in batch]))
+                                    .with_for_update(read=True)):
+            liked_by.setdefault(message_id, []).append(user_id)
+
+        for id, text, timestamp, user_id in batch:
+            ids.append(id)
+            yield {'id': id, 'text': text, 'timestamp': timestamp.isoformat(),
+                   'user_id': user_id, 'liked_by': liked_by.get(id, [])}
+
+    if write_archive(archive_dir, start, records()) is None:
+        return 0
+
+    # likes, tags, mentions and trending scores go with them (FK cascade)
+    for start_index in range(0, len(ids), BATCH_SIZE):
+        batch = ids[start_index:start_index + BATCH_SIZE]
+        (Message.query
+         .filter(Message.id.in_(batch))
+         .delete(synchronize_session=False))
+    db.session.commit()
+
+    return len(ids)
+
+
+def archive_messages(archive_dir, older_than_days, now=None):
+    """Archive every whole month of messages older than `older_than_days`.
+
+    Returns {month: messages archived}.
+    """
+
+    now = now or datetime.utcnow()
+    # only whole months, so each month ends up in one file
+    cutoff = month_start(now - timedelta(days=older_than_days))
+
+    oldest = db.session.query(db.func.min(Message.timestamp)).scalar()
+    archived = {}
+
+    if oldest is None:
+        return archived
+
+    start = month_start(oldest)
+    while start < cutoff:
+        end = next_month(start)
+        count = archive_month(archive_dir, start, end)
+        if count:
+            archived[f"{start:%Y-%m}"] = count
+        start = end
+
+    return archived
+
+
+def archive_files(archive_dir):
+    """Yield (path, first id, last id) for each archive file."""
+
+    try:
+        filenames = os.listdir(archive_dir)
+    except FileNotFoundError:
+        return
+
+    for filename in filenames:
+        match = FILENAME_RE.match(filename)
+        if match:
+            yield (os.path.join(archive_dir, filename),
+                   int(match.group(2)), int(match.group(3)))
+
+
+def iter_records(path):
+    """Yield an archive file's records one at a time."""
+
+    with gzip.open(path, 'rt') as file:
+        for line in file:
+            yield json.loads(line)
+
+
+def find_record(path, message_id):
+    """Return the record for `message_id` in an archive file, or None.
+
+    Files are in id order, so this reads (a record at a time) only up to
+    where the id is or would be; nothing is kept after.
+    """
+
+    for record in iter_records(path):
+        if record['id'] == message_id:
+            return record
+        if record['id'] > message_id:
+            break
+
+    return None
+
+
+def find_message(archive_dir, message_id):
+    """Return the archived message with `message_id`, or None."""
+
+    for path, first_id, last_id in archive_files(archive_dir):
+        if first_id <= message_id <= last_id:
+            try:
+                record = find_record(path, message_id)
+            except FileNotFoundError:
+                # emptied and removed since we listed it
+                continue
+            if record:
+                return ArchivedMessage(record)
+
+    return None
+
+
+def user_records(archive_dir, user_id):
+    """Yield `user_id`'s archived messages and likes, as export records.
+
+    Reads every archive file (a record at a time), so it's for exports,
+    not page views.
+    """
+
+    likes = []
+    for path, _, _ in sorted(archive_files(archive_dir)):
+        for record in iter_records(path):
+            if record['user_id'] == user_id:
+                yield {'record': 'message', 'id': record['id'],
+                       'text': record['text'],
+                       'timestamp': record['timestamp']}
+            if user_id in record['liked_by']:
+                likes.append({'record': 'like', 'id': record['id'],
+                              'user_id': record['user_id'],
+                              'text': record['text']})
+
+    yield from likes
+
+
+@contextmanager
+def _locked(archive_dir):
+    os.makedirs(archive_dir, exist_ok=True)
+    fd = os.open(os.path.join(archive_dir, LOCK_FILENAME),
+                 os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def remove(archive_dir, message_ids=(), user_id=None):
+    """Drop messages from the archive: those in `message_ids`, and with
+    `user_id` everything that user wrote, and their likes of the rest.
+
+    Only files that change are rewritten; a file left empty is deleted.
+    Returns the number of messages removed.
+    """
+
+    message_ids = set(message_ids)
+    removed = 0
+
+    with _locked(archive_dir):
+        for path, first_id, last_id in archive_files(archive_dir):
+            if user_id is None and not any(first_id <= id <= last_id
+                                           for id in message_ids):
+                continue
+
+            kept = 0
+            changed = False
+            # rewritten a record at a time; same name after, since the id
+            # range still covers what's left
+            fd, tmp_path = tempfile.mkstemp(dir=archive_dir)
+            with os.fdopen(fd, 'wb') as raw, gzip.open(raw, 'wt') as file:
+                for record in iter_records(path):
+                    if (record['id'] in message_ids or
+                            record['user_id'] == user_id):
+                        removed += 1
+                        changed = True
+                        continue
+                    if user_id in record['liked_by']:
+                        record['liked_by'] = [id for id in record['liked_by']
+                                              if id != user_id]
+                        changed = True
+                    file.write(json.dumps(record) + "\n")
+                    kept += 1
+
+            if changed and kept:
+                os.replace(tmp_path, path)
+            else:
+                os.remove(tmp_path)
+                if changed:
+                    os.remove(path)
+
+    return removed
@@ -0,0 +1,60 @@
+"""Keeping a directory of disposable files under a size budget.
+
+The image cache and the profile directory both grow with traffic. `prune`
+deletes the oldest files (by mtime) until a directory fits its budget.
+It walks and stats the whole tree, so code that writes files often goes
+through a `Pruner`, which prunes at most once per interval per process.
+"""
+
+import os
+import threading
+import time
+
+
+def prune(directory, max_bytes):
+    """Delete the oldest files until `directory` fits in `max_bytes`."""
+
+    files = []
+    for dirpath, _, filenames in os.walk(directory):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+class Pruner:
+    """Prunes a directory at most every `interval` seconds."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.pruned_at = 0.0
+        self._lock = threading.Lock()
+
+    def maybe_prune(self, directory, max_bytes):
+        """`prune` if `interval` has passed since the last time (and there
+        is a budget); return whether it did."""
+
+        if max_bytes is None:
+            return False
+
+        with self._lock:
+            now = time.time()
+            if now - self.pruned_at < self.interval:
+                return False
+            self.pruned_at = now
+
+        prune(directory, max_bytes)
+        return True
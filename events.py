@@ -0,0 +1,211 @@
+"""Publish/subscribe for live timeline updates (server-sent events).
+
+Publishers send an event to a channel (we use one channel per author:
+"user:<id>"); each open /stream connection subscribes to the channels of
+everyone its user follows.
+
+`LocalBroker` only reaches subscribers in the same process. Since gunicorn
+runs several workers, `PostgresBroker` relays events through Postgres
+LISTEN/NOTIFY so every worker's subscribers hear them. Set EVENTS_BROKER to
+"postgres" to use it.
+
+Everything here blocks on `threading`/`queue` primitives only, so it works
+unchanged under gevent or eventlet workers (which patch them), where an idle
+stream costs a greenlet rather than a whole worker.
+"""
+
+import json
+import logging
+import queue
+import select
+import threading
+import time
+
+import psycopg2
+
+NOTIFY_CHANNEL = "warbler_events"
+
+# seconds between attempts to reconnect a lost LISTEN connection (doubling
+# up to the max)
+RECONNECT_DELAY = 1
+RECONNECT_MAX_DELAY = 30
+
+log = logging.getLogger(__name__)
+
+
+class PublishError(Exception):
+    """The broker couldn't send an event (e.g. Postgres is down)."""
+
+
+class Subscription:
+    """Queue of events for one listener."""
+
+    def __init__(self, broker, channels, maxsize=100):
+        self.broker = broker
+        self.channels = set(channels)
+        self.queue = queue.Queue(maxsize=maxsize)
+
+    def put(self, event):
+        """Queue an event; slow listeners lose events rather than block us."""
+
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            pass
+
+    def get(self, timeout=None):
+        """Return the next event, or None after `timeout` seconds."""
+
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class LocalBroker:
+    """Delivers events to subscribers in this process."""
+
+    # do events reach other processes (workers, `flask run-jobs`, CLIs)?
+    cross_process = False
+
+    def __init__(self):
+        self._subscriptions = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, channels):
+        subscription = Subscription(self, channels)
+
+        with self._lock:
+            for channel in subscription.channels:
+                self._subscriptions.setdefault(channel, set()).add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for channel in subscription.channels:
+                listeners = self._subscriptions.get(channel, set())
+                listeners.discard(subscription)
+                if not listeners:
+                    self._subscriptions.pop(channel, None)
+
+    def deliver(self, channel, event):
+        """Hand an event to this process's subscribers of `channel`."""
+
+        with self._lock:
+            listeners = list(self._subscriptions.get(channel, ()))
+
+        for subscription in listeners:
+            subscription.put(event)
+
+    def publish(self, channel, event):
+        self.deliver(channel, event)
+
+
+class PostgresBroker(LocalBroker):
+    """Relays events between workers with Postgres LISTEN/NOTIFY.
+
+    Uses its own connections (outside of the SQLAlchemy session), so a
+    notification goes out immediately rather than at the next commit.
+    """
+
+    cross_process = True
+
+    def __init__(self, dsn):
+        super().__init__()
+        self.dsn = dsn
+        self._publisher = None
+        self._publisher_lock = threading.Lock()
+        self._listener = None
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn)
+        conn.autocommit = True
+        return conn
+
+    def _listen(self):
+        """Relay notifications to this process, reconnecting when Postgres
+        goes away (events sent while disconnected are lost)."""
+
+        delay = RECONNECT_DELAY
+
+        while True:
+            conn = None
+            try:
+                conn = self._connect()
+                conn.cursor().execute(f"LISTEN {NOTIFY_CHANNEL}")
+                delay = RECONNECT_DELAY
+
+                while True:
+                    select.select([conn], [], [], 30)
+                    conn.poll()
+                    while conn.notifies:
+                        self._relay(conn.notifies.pop(0).payload)
+            except (psycopg2.Error, OSError):
+                log.exception("lost the events connection; reconnecting in "
+                              "%ss", delay)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+            time.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+    def _relay(self, payload):
+        try:
+            message = json.loads(payload)
+            channel, event = message["channel"], message["event"]
+        except (ValueError, TypeError, KeyError):
+            log.warning("ignoring malformed event: %.200s", payload)
+            return
+
+        self.deliver(channel, event)
+
+    def subscribe(self, channels):
+        # start listening lazily, so forked workers each get their own thread
+        with self._publisher_lock:
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._listen,
+                                                  daemon=True)
+                self._listener.start()
+
+        return super().subscribe(channels)
+
+    def publish(self, channel, event):
+        payload = json.dumps({"channel": channel, "event": event})
+
+        with self._publisher_lock:
+            # a connection that broke since the last publish (e.g. Postgres
+            # restarted) gets one fresh retry
+            for attempt in range(2):
+                try:
+                    if self._publisher is None or self._publisher.closed:
+                        self._publisher = self._connect()
+                    self._publisher.cursor().execute(
+                        "SELECT pg_notify(%s, %s)", (NOTIFY_CHANNEL, payload))
+                    return
+                except (psycopg2.OperationalError, psycopg2.InterfaceError) as exc:
+                    if self._publisher is not None:
+                        self._publisher.close()
+                    if attempt:
+                        raise PublishError(f"couldn't publish to {channel}") from exc
+                except psycopg2.Error as exc:
+                    raise PublishError(f"couldn't publish to {channel}") from exc
+
+
+def user_channel(user_id):
+    """Channel that a user's new messages are published to."""
+
+    return f"user:{user_id}"
+
+
+def make_broker(kind, dsn=None):
+    """Return the broker named by EVENTS_BROKER ('local' or 'postgres')."""
+
+    if kind == "postgres":
+        return PostgresBroker(dsn)
+
+    return LocalBroker()
@@ -0,0 +1,121 @@
+"""Streaming export of a user's data (messages, likes and follows).
+
+Rows are read with server-side cursors (`yield_per`), turned into NDJSON or
+CSV lines and gzip-compressed as they go, so memory use stays the same no
+matter how big the account is. Archived messages and likes (see
+archive.py) come first, since they're the oldest.
+"""
+
+import csv
+import io
+import json
+import zlib
+
+import archive
+from models import db, User, Message, Follows, Like
+
+BATCH_SIZE = 500
+
+CSV_FIELDS = ['record', 'id', 'user_id', 'username', 'text', 'timestamp']
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+def export_records(user, archive_dir=None):
+    """Yield one dict per message, like, follow and follower of `user`,
+    archived ones (from `archive_dir`) included."""
+
+    if archive_dir:
+        yield from archive.user_records(archive_dir, user.id)
+
+    messages = (db.session
+                .query(Message.id, Message.text, Message.timestamp)
+                .filter(Message.user_id == user.id)
+                .order_by(Message.timestamp)
+                .yield_per(BATCH_SIZE))
+
+    for id, text, timestamp in messages:
+        yield {'record': 'message', 'id': id, 'text': text,
+               'timestamp': timestamp.isoformat()}
+
+    likes = (db.session
+             .query(Message.id, Message.user_id, Message.text)
+             .join(Like, Like.message_id == Message.id)
+             .filter(Like.user_id == user.id)
+             .order_by(Message.id)
+             .yield_per(BATCH_SIZE))
+
+    for id, user_id, text in likes:
+        yield {'record': 'like', 'id': id, 'user_id': user_id, 'text': text}
+
+    following = (db.session
+                 .query(User.id, User.username)
+                 .join(Follows, Follows.user_being_followed_id == User.id)
+                 .filter(Follows.user_following_id == user.id)
+                 .order_by(User.id)
+                 .yield_per(BATCH_SIZE))
+
+    for id, username in following:
+        yield {'record': 'following', 'user_id': id, 'username': username}
+
+    followers = (db.session
+                 .query(User.id, User.username)
+                 .join(Follows, Follows.user_following_id == User.id)
+                 .filter(Follows.user_being_followed_id == user.id)
+                 .order_by(User.id)
+                 .yield_per(BATCH_SIZE))
+
+    for id, username in followers:
+        yield {'record': 'follower', 'user_id': id, 'username': username}
+
+
+def ndjson_lines(records):
+    """Yield each record as a line of JSON."""
+
+    for record in records:
+        yield json.dumps(record) + "\n"
+
+
+def csv_lines(records):
+    """Yield a CSV header, then each record as a CSV line."""
+
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=CSV_FIELDS)
+
+    writer.writeheader()
+    for record in records:
+        writer.writerow(record)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+    yield buffer.getvalue()
+
+
+def gzip_chunks(lines, flush_every=BATCH_SIZE):
+    """Gzip-compress an iterable of text lines into a stream of bytes.
+
+    Output is flushed every `flush_every` lines so a slow export still
+    reaches the client steadily.
+    """
+
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+
+    for count, line in enumerate(lines, start=1):
+        chunk = compressor.compress(line.encode('utf-8'))
+        if count % flush_every == 0:
+            chunk += compressor.flush(zlib.Z_SYNC_FLUSH)
+        if chunk:
+            yield chunk
+
+    yield compressor.flush()
+
+
+def export_user(user, format='ndjson', archive_dir=None):
+    """Return a generator of gzip-compressed export bytes for `user`."""
+
+    lines = ndjson_lines if format == 'ndjson' else csv_lines
+    return gzip_chunks(lines(export_records(user, archive_dir)))
@@ -0,0 +1,392 @@
+"""Compact in-memory snapshot of the follow graph.
+
+The `follows` table is stored CSR-style in four flat arrays: for user id
+`u`, the people `u` follows are `following[following_offsets[u]:
+following_offsets[u + 1]]` (sorted), and likewise for followers. That's
+four bytes per edge per direction (plus eight per user id), and
+`is_following`, the counts and "followed by people you follow" are array
+lookups and bisects instead of queries.
+
+`flask build-follow-graph` writes a snapshot to FOLLOW_GRAPH_PATH (gunicorn
+runs it before forking workers; rerun it periodically). Workers mmap the
+file read-only, so every worker on the host shares one copy through the
+page cache. Follows and unfollows since the snapshot are applied as deltas
+on top: each worker applies its own at once and publishes them to the
+others over the events broker.
+
+The broker only reaches processes listening at the time, so every change
+is also logged to the `follow_events` table in its own transaction. A
+process catches up from the log when it loads a snapshot (a restarted
+worker, `run-jobs`, a CLI command) and again every RELOAD_INTERVAL, which
+also covers events the broker dropped while reconnecting. If the log can't
+be read, `current()` is None until it can, rather than a graph that may be
+behind.
+
+With FOLLOW_GRAPH_PATH unset (or no snapshot built yet), `current()` is
+None and callers query the database as before.
+"""
+
+import bisect
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+from collections import defaultdict
+
+from events import PublishError
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'WFG1'
+# magic, padding, built at (unix time), offsets per direction, edges
+HEADER = struct.Struct('<4s4xdqq')
+
+FOLLOWS_CHANNEL = "follows"
+
+# how often (seconds) a worker checks for a newer snapshot file and reads
+# the follow_events log
+RELOAD_INTERVAL = 30
+
+# Events are read again from this long (seconds) before the last read, for
+# ones logged (timestamped) earlier but committed later. Applying an event
+# twice, in order, is harmless.
+CATCH_UP_MARGIN = 60
+
+# `build-follow-graph` deletes logged events this much older than the
+# snapshot it wrote
+EVENTS_KEPT = 60 * 60
+
+
+class FollowGraph:
+    """A follow graph snapshot plus the follows/unfollows since."""
+
+    def __init__(self, following_offsets, following, follower_offsets,
+                 followers, built_at=0.0):
+        self.following_offsets = following_offsets
+        self.following = following
+        self.follower_offsets = follower_offsets
+        self.followers = followers
+        self.built_at = built_at
+        # log events up to this time have been applied
+        self.caught_up_at = built_at
+
+        # edges added/removed since the snapshot, and when
+        self._added = {}
+        self._removed = {}
+        # user id -> edges above that it's part of
+        self._touched = defaultdict(set)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def build(cls, following_edges, follower_edges, max_id, built_at=None):
+        """Build a graph from two streams of (source, target) id pairs.
+
+        `following_edges` are (follower, followed) sorted by both ids;
+        `follower_edges` are (followed, follower), likewise sorted. They're
+        consumed as they come, so they can be unbuffered query results.
+        """
+
+        following_offsets, following = _csr(following_edges, max_id)
+        follower_offsets, followers = _csr(follower_edges, max_id)
+
+        return cls(following_offsets, following, follower_offsets, followers,
+                   time.time() if built_at is None else built_at)
+
+    @classmethod
+    def from_edges(cls, edges, built_at=None):
+        """Build a graph from (follower id, followed id) pairs, in any order."""
+
+        edges = list(edges)
+        max_id = max((max(edge) for edge in edges), default=0)
+        return cls.build(sorted(edges),
+                         sorted((followed, follower)
+                                for follower, followed in edges),
+                         max_id, built_at)
+
+    def save(self, path):
+        """Write the snapshot to `path` (atomically)."""
+
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as file:
+            file.write(HEADER.pack(MAGIC, self.built_at,
+                                   len(self.following_offsets),
+                                   len(self.following)))
+            for values in (self.following_offsets, self.follower_offsets,
+                           self.following, self.followers):
+                values.tofile(file)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Map a snapshot written by `save` (read-only, shared)."""
+
+        with open(path, 'rb') as file:
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, built_at, offset_count, edge_count = HEADER.unpack_from(buffer)
+        if magic != MAGIC:
+            raise ValueError(f"{path} isn't a follow graph snapshot")
+
+        view = memoryview(buffer)
+        position = HEADER.size
+        parts = []
+        for typecode, count in (('q', offset_count), ('q', offset_count),
+                                ('i', edge_count), ('i', edge_count)):
+            size = count * array(typecode).itemsize
+            parts.append(view[position:position + size].cast(typecode))
+            position += size
+
+        following_offsets, follower_offsets, following, followers = parts
+        return cls(following_offsets, following, follower_offsets, followers,
+                   built_at)
+
+    def _row(self, offsets, targets, user_id):
+        if user_id + 1 >= len(offsets):
+            return targets[0:0]
+        return targets[offsets[user_id]:offsets[user_id + 1]]
+
+    def _in_snapshot(self, follower_id, followed_id):
+        row = self._row(self.following_offsets, self.following, follower_id)
+        index = bisect.bisect_left(row, followed_id)
+        return index < len(row) and row[index] == followed_id
+
+    def apply(self, follower_id, followed_id, following, at=None):
+        """Record a follow (`following` True) or unfollow since the snapshot."""
+
+        edge = (follower_id, followed_id)
+        at = time.time() if at is None else at
+
+        with self._lock:
+            self._added.pop(edge, None)
+            self._removed.pop(edge, None)
+            in_snapshot = self._in_snapshot(*edge)
+            if following and not in_snapshot:
+                self._added[edge] = at
+            elif not following and in_snapshot:
+                self._removed[edge] = at
+            self._touched[follower_id].add(edge)
+            self._touched[followed_id].add(edge)
+
+    def is_following(self, follower_id, followed_id):
+        edge = (follower_id, followed_id)
+        if edge in self._added:
+            return True
+        if edge in self._removed:
+            return False
+        return self._in_snapshot(follower_id, followed_id)
+
+    def following_ids(self, user_id):
+        """Ids `user_id` follows, sorted."""
+
+        return self._adjusted(self._row(self.following_offsets, self.following,
+                                        user_id),
+                              user_id, 0)
+
+    def follower_ids(self, user_id):
+        """Ids of `user_id`'s followers, sorted."""
+
+        return self._adjusted(self._row(self.follower_offsets, self.followers,
+                                        user_id),
+                              user_id, 1)
+
+    def _adjusted(self, row, user_id, side):
+        """`row` with this user's deltas applied; `side` 0 is following."""
+
+        with self._lock:
+            edges = [edge for edge in self._touched.get(user_id, ())
+                     if edge[side] == user_id]
+            added = [edge[1 - side] for edge in edges if edge in self._added]
+            removed = {edge[1 - side] for edge in edges if edge in self._removed}
+
+        if not added and not removed:
+            return row
+        return sorted([id for id in row if id not in removed] + added)
+
+    def following_count(self, user_id):
+        return len(self.following_ids(user_id))
+
+    def followers_count(self, user_id):
+        return len(self.follower_ids(user_id))
+
+    def followed_by_following(self, user_id, other_id):
+        """How many people `user_id` follows also follow `other_id`."""
+
+        mine = self.following_ids(user_id)
+        theirs = self.follower_ids(other_id)
+        if len(mine) > len(theirs):
+            mine, theirs = theirs, mine
+
+        count = 0
+        for id in mine:
+            index = bisect.bisect_left(theirs, id)
+            if index < len(theirs) and theirs[index] == id:
+                count += 1
+        return count
+
+    def deltas_since(self, at):
+        """Deltas newer than `at`, as (follower, followed, following, at)."""
+
+        with self._lock:
+            return ([(*edge, True, when) for edge, when in self._added.items()
+                     if when >= at] +
+                    [(*edge, False, when) for edge, when in self._removed.items()
+                     if when >= at])
+
+
+def _csr(edges, max_id):
+    """Offsets and targets arrays for sorted (source, target) `edges`."""
+
+    offsets = array('q', [0]) * (max_id + 2)
+    targets = array('i')
+
+    for source, target in edges:
+        offsets[source + 1] += 1
+        targets.append(target)
+    for index in range(1, len(offsets)):
+        offsets[index] += offsets[index - 1]
+
+    return offsets, targets
+
+
+##############################################################################
+# This process's graph
+
+_path = None
+_broker = None
+_read_events = None
+_graph = None
+_checked_at = 0.0
+_mtime = None
+_listener = None
+_state_lock = threading.Lock()
+
+
+def configure(path, broker, read_events=None):
+    """Use the snapshot at `path`, sharing deltas over `broker`.
+
+    `read_events(at)` returns the logged events after unix time `at` as
+    (follower, followed, following, at), in the order they were logged.
+    """
+
+    global _path, _broker, _read_events, _graph, _mtime, _listener
+    _path = path
+    _broker = broker
+    _read_events = read_events
+    _graph = _mtime = _listener = None
+
+
+def enabled():
+    """Whether follows should be logged for the graph."""
+
+    return bool(_path)
+
+
+def catch_up(graph, now=None):
+    """Apply the logged events `graph` may not have seen."""
+
+    now = time.time() if now is None else now
+
+    if _read_events is not None:
+        for event in _read_events(graph.caught_up_at - CATCH_UP_MARGIN):
+            graph.apply(*event)
+    graph.caught_up_at = now
+
+
+def current():
+    """This worker's graph, or None if there's no snapshot to use (or it
+    can't be brought up to date)."""
+
+    global _graph, _checked_at, _mtime, _listener
+
+    if not _path:
+        return None
+
+    now = time.time()
+    if _graph is not None and now - _checked_at < RELOAD_INTERVAL:
+        return _graph
+
+    with _state_lock:
+        try:
+            mtime = os.stat(_path).st_mtime
+        except FileNotFoundError:
+            mtime = _mtime
+            if _graph is None:
+                return None
+
+        graph = FollowGraph.load(_path) if mtime != _mtime else _graph
+        try:
+            catch_up(graph, now)
+        except Exception:
+            # tried again on the next call; the database has the answers
+            log.warning("couldn't read follow_events; using the database",
+                        exc_info=True)
+            _graph = None
+            _mtime = None
+            return None
+
+        _graph, _mtime, _checked_at = graph, mtime, now
+
+        # started lazily, so each forked worker gets its own listener
+        if _listener is None and _broker is not None:
+            _listener = threading.Thread(target=_listen, daemon=True)
+            _listener.start()
+
+    return _graph
+
+
+def _listen():
+    subscription = _broker.subscribe([FOLLOWS_CHANNEL])
+    while True:
+        event = subscription.get()
+        if event and _graph is not None:
+            followed = event['followed']
+            for followed_id in (followed if isinstance(followed, list)
+                                else [followed]):
+                _graph.apply(event['follower'], followed_id,
+                             event['following'], event['at'])
+
+
+def _publish(event):
+    """Tell the other workers about a change, if there's a broker. They
+    also catch up from follow_events, so a broker outage only delays it."""
+
+    if _broker is None:
+        return
+    try:
+        _broker.publish(FOLLOWS_CHANNEL, event)
+    except PublishError:
+        log.warning("couldn't publish a follow change", exc_info=True)
+
+
+def record(follower_id, followed_id, following):
+    """Apply a follow/unfollow here now and tell the other workers."""
+
+    graph = current()
+    if graph is None:
+        return
+
+    at = time.time()
+    graph.apply(follower_id, followed_id, following, at)
+    _publish({'follower': follower_id,
+              'followed': followed_id,
+              'following': following,
+              'at': at})
+
+
+def record_many(follower_id, followed_ids, following):
+    """`record` for many users at once, told to the other workers together."""
+
+    graph = current()
+    if graph is None or not followed_ids:
+        return
+
+    at = time.time()
+    for followed_id in followed_ids:
+        graph.apply(follower_id, followed_id, following, at)
+    _publish({'follower': follower_id,
+              'followed': list(followed_ids),
+              'following': following,
+              'at': at})
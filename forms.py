@@ -1,6 +1,16 @@
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, TextAreaField, BooleanField
-from wtforms.validators import DataRequired, Email, Length, Optional
+from wtforms.validators import (
+    DataRequired, Email, Length, Optional, ValidationError)
+
+from models import DELETED_USERNAME_PREFIX
+
+
+def not_reserved(form, field):
+    """Usernames kept for deleted accounts can't be taken."""
+
+    if field.data and field.data.startswith(DELETED_USERNAME_PREFIX):
+        raise ValidationError("That username is reserved.")
 
 
 class MessageForm(FlaskForm):
@@ -12,7 +22,7 @@ class MessageForm(FlaskForm):
 class UserAddForm(FlaskForm):
     """Form for adding users."""
 
-    username = StringField('Username', validators=[DataRequired()])
+    username = StringField('Username', validators=[DataRequired(), not_reserved])
     email = StringField('E-mail', validators=[DataRequired(), Email()])
     password = PasswordField('Password', validators=[Length(min=6)])
     image_url = StringField('(Optional) Image URL')
@@ -30,7 +40,7 @@ class CsrfOnlyForm(FlaskForm):
 class EditUserForm(FlaskForm):
     """Form for editing users."""
 
-    username = StringField('Username')
+    username = StringField('Username', validators=[not_reserved])
     email = StringField('E-mail', validators=[Optional(),Email()])
     image_url = StringField('Image url')
     header_image_url = StringField('(Optional) Image URL')
@@ -0,0 +1,75 @@
+"""Gunicorn settings for Warbler.
+
+By default this runs gevent workers: each process serves up to
+WORKER_CONNECTIONS requests at once, yielding to other requests whenever one
+waits on the database or the network, so we scale with greenlets instead of
+memory-hungry processes. That matters because every logged-in homepage
+holds a /stream connection open; under sync workers a few open tabs would
+take every worker. bcrypt hashing runs on gevent's thread pool (see
+models.run_blocking) so it doesn't stall the loop.
+
+WORKER_CLASS=sync gets plain one-request-per-process workers; pages then
+don't open /stream (see LIVE_UPDATES in app.py).
+
+A typical gevent setup on a 512MB dyno:
+
+    WEB_CONCURRENCY=2 WORKER_CONNECTIONS=100 \\
+    DB_POOL_SIZE=10 DB_MAX_OVERFLOW=10
+
+Keep WEB_CONCURRENCY * (DB_POOL_SIZE + DB_MAX_OVERFLOW) under the database's
+connection limit; requests beyond the pool wait for a free connection.
+"""
+
+import logging
+import os
+import subprocess
+import sys
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8000)}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+worker_class = os.environ.get('WORKER_CLASS', 'gevent')
+worker_connections = int(os.environ.get('WORKER_CONNECTIONS', 100))
+timeout = int(os.environ.get('WORKER_TIMEOUT', 30))
+
+# Comma-separated GET routes each worker requests once on boot, e.g. "/,/users"
+warm_routes = [route for route in os.environ.get('WARM_ROUTES', '').split(',')
+               if route]
+
+
+def on_starting(server):
+    """Compile templates into the shared bytecode cache, and snapshot the
+    follow graph (if FOLLOW_GRAPH_PATH is set and EVENTS_BROKER=postgres),
+    before any worker starts.
+
+    Both run in a separate process, so the master stays small; workers
+    share the results through the filesystem.
+    """
+
+    subprocess.run([sys.executable, '-m', 'flask', 'compile-templates'],
+                   check=False)
+
+    if (os.environ.get('FOLLOW_GRAPH_PATH') and
+            os.environ.get('EVENTS_BROKER') == 'postgres'):
+        subprocess.run([sys.executable, '-m', 'flask', 'build-follow-graph'],
+                       check=False)
+
+
+def post_fork(server, worker):
+    """Make psycopg2 yield to other greenlets while it waits on Postgres."""
+
+    if worker_class == 'gevent':
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+
+
+def post_worker_init(worker):
+    """Load every template (and any WARM_ROUTES) before taking traffic."""
+
+    import warmup
+    from app import app
+
+    # send warm-up timings to gunicorn's error log
+    warmup.log.handlers = worker.log.error_log.handlers
+    warmup.log.setLevel(logging.INFO)
+
+    warmup.warm(app, warm_routes)
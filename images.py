@@ -0,0 +1,297 @@
+"""Resizing proxy for user avatars and header images.
+
+`User.image_url` and `header_image_url` point at arbitrary remote images,
+often far bigger than the few sizes our templates show. Templates use the
+`resized` filter instead, which turns a remote URL into a signed
+/images/<size>/<token> URL (so we never fetch URLs we didn't issue).
+
+On first request we fetch the original once, store it under the SHA-256 of
+its bytes (so users sharing an image share the cache), and write each size as
+it is asked for:
+
+    <IMAGE_CACHE_DIR>/urls/<sha256 of source url>   -> content hash
+    <IMAGE_CACHE_DIR>/<content hash>/original
+    <IMAGE_CACHE_DIR>/<content hash>/<size>.jpg
+
+The oldest files are deleted once the directory holds more than
+IMAGE_CACHE_MAX_BYTES (checked at most every PRUNE_INTERVAL seconds).
+
+Image URLs are whatever users type in, so `fetch` only connects to public
+addresses: the address each connection (redirects included) actually
+reached is checked, so a hostname that resolves to 127.0.0.1, 10.x or
+169.254.169.254 (cloud metadata) gets nothing. A fetch gets MAX_BYTES and
+FETCH_DEADLINE seconds in all, however slowly the server sends.
+"""
+
+import hashlib
+import http.client
+import io
+import ipaddress
+import os
+import socket
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from contextlib import contextmanager
+
+from itsdangerous import URLSafeSerializer
+from PIL import Image, ImageOps
+
+import diskbudget
+
+# name -> (width, height) in pixels, twice the CSS size for high-DPI screens
+SIZES = {
+    'nav': (64, 64),
+    'thumb': (96, 96),
+    'card': (140, 140),
+    'avatar': (400, 400),
+    'card-hero': (800, 288),
+    'hero': (1920, 576),
+}
+
+MAX_BYTES = 10 * 1024 * 1024
+# per socket operation, and for a whole fetch (redirects included): a server
+# sending a byte every few seconds would never trip the first
+FETCH_TIMEOUT = 5
+FETCH_DEADLINE = 20
+MAX_REDIRECTS = 5
+
+# Non-public networks fetch() may connect to anyway (for local development
+# and tests); everything else has to be a global address.
+ALLOWED_NETWORKS = []
+
+# how often (seconds) a process checks the cache directory's size
+PRUNE_INTERVAL = 60
+
+
+class ImageError(Exception):
+    """The source image couldn't be fetched or decoded."""
+
+
+def get_serializer(secret_key):
+    return URLSafeSerializer(secret_key, salt="image-proxy")
+
+
+def proxy_url(url, size, secret_key):
+    """Return our proxy URL for `url` at `size`.
+
+    Local images (/static/...) are already ours and are returned unchanged.
+    """
+
+    if not url or not url.startswith(('http://', 'https://')):
+        return url
+
+    return f"/images/{size}/{get_serializer(secret_key).dumps(url)}"
+
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _write_atomic(path, data):
+    """Write `data` to `path` so readers never see a partial file."""
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as file:
+        file.write(data)
+    os.replace(tmp_path, path)
+
+
+def address_allowed(address):
+    """May we fetch from IP `address`? Only public ones, unless allowed."""
+
+    ip = ipaddress.ip_address(address.split('%')[0])
+    if getattr(ip, 'ipv4_mapped', None):
+        ip = ip.ipv4_mapped
+
+    return ip.is_global or any(ip in network for network in ALLOWED_NETWORKS)
+
+
+def _create_connection(address, *args, **kwargs):
+    """socket.create_connection, refusing to talk to non-public addresses.
+
+    Checks the address actually connected to, so DNS can't answer one
+    thing to a check and another to the connection.
+    """
+
+    sock = socket.create_connection(address, *args, **kwargs)
+    peer = sock.getpeername()[0]
+    if not address_allowed(peer):
+        sock.close()
+        raise ImageError(f"Refusing to fetch from {peer}")
+
+    watched = getattr(_deadline_state, 'sockets', None)
+    if watched is not None:
+        # a second handle on the same socket, which stays usable after TLS
+        # wraps (and detaches) this one
+        watched.append(sock.dup())
+    return sock
+
+
+_deadline_state = threading.local()
+
+
+@contextmanager
+def _deadline(seconds):
+    """Cut off the connections this thread opens once `seconds` have passed.
+
+    Yields a list that's non-empty once time ran out; reads on the cut-off
+    connections fail (or end early) right away.
+    """
+
+    sockets = _deadline_state.sockets = []
+    expired = []
+
+    def expire():
+        expired.append(True)
+        for sock in list(sockets):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    timer = threading.Timer(seconds, expire)
+    timer.daemon = True
+    timer.start()
+    try:
+        yield expired
+    finally:
+        timer.cancel()
+        _deadline_state.sockets = None
+        for sock in sockets:
+            sock.close()
+
+
+class _PublicHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = _create_connection
+
+
+class _PublicHTTPSConnection(http.client.HTTPSConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = _create_connection
+
+
+class _PublicHTTPHandler(urllib.request.HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(_PublicHTTPConnection, req)
+
+
+class _PublicHTTPSHandler(urllib.request.HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(_PublicHTTPSConnection, req,
+                            context=self._context)
+
+
+class _RedirectHandler(urllib.request.HTTPRedirectHandler):
+    """Follow at most MAX_REDIRECTS redirects, and only to http(s)."""
+
+    max_redirections = MAX_REDIRECTS
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        if not newurl.startswith(('http://', 'https://')):
+            raise urllib.error.HTTPError(newurl, code,
+                                         "Redirect to a non-http(s) URL",
+                                         headers, fp)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+_opener = urllib.request.OpenerDirector()
+for _handler in (_PublicHTTPHandler(), _PublicHTTPSHandler(),
+                 _RedirectHandler(), urllib.request.HTTPDefaultErrorHandler(),
+                 urllib.request.HTTPErrorProcessor()):
+    _opener.add_handler(_handler)
+
+
+def fetch(url):
+    """Download `url`, refusing anything but http(s) from public addresses,
+    and anything too big."""
+
+    if not url.startswith(('http://', 'https://')):
+        raise ImageError(f"Not an http(s) URL: {url}")
+
+    with _deadline(FETCH_DEADLINE) as expired:
+        try:
+            with _opener.open(url, timeout=FETCH_TIMEOUT) as response:
+                data = response.read(MAX_BYTES + 1)
+        except (OSError, http.client.HTTPException, ValueError) as exc:
+            if expired:
+                raise ImageError(f"{url} took over {FETCH_DEADLINE}s") from exc
+            raise ImageError(f"Couldn't fetch {url}: {exc}") from exc
+
+        # a cut-off body without a length just looks short
+        if expired:
+            raise ImageError(f"{url} took over {FETCH_DEADLINE}s")
+
+    if len(data) > MAX_BYTES:
+        raise ImageError(f"{url} is larger than {MAX_BYTES} bytes")
+
+    return data
+
+
+def resize(data, size):
+    """Crop and scale image bytes to fill `size`; return JPEG bytes."""
+
+    try:
+        image = Image.open(io.BytesIO(data))
+        image = ImageOps.exif_transpose(image).convert('RGB')
+    except (OSError, ValueError, Image.DecompressionBombError) as exc:
+        raise ImageError(f"Couldn't decode image: {exc}") from exc
+
+    image = ImageOps.fit(image, SIZES[size], Image.LANCZOS)
+
+    output = io.BytesIO()
+    image.save(output, 'JPEG', quality=85, optimize=True, progressive=True)
+    return output.getvalue()
+
+
+_pruner = diskbudget.Pruner(PRUNE_INTERVAL)
+
+
+def cached_image(url, size, cache_dir, max_bytes=None):
+    """Return the path of `url` resized to `size`, fetching it if needed.
+
+    With `max_bytes`, the cache is pruned to that size now and then (see
+    diskbudget.py): a URL whose original is gone is fetched again, one whose
+    pointer is gone just gets a new one.
+    """
+
+    url_path = os.path.join(cache_dir, 'urls', _sha256(url.encode()))
+
+    try:
+        with open(url_path) as file:
+            content_hash = file.read().strip()
+    except FileNotFoundError:
+        content_hash = None
+
+    if content_hash:
+        sized_path = os.path.join(cache_dir, content_hash, f"{size}.jpg")
+        if os.path.exists(sized_path):
+            return sized_path
+
+        original_path = os.path.join(cache_dir, content_hash, 'original')
+        try:
+            with open(original_path, 'rb') as file:
+                data = file.read()
+        except FileNotFoundError:
+            data = None
+    else:
+        data = None
+
+    if data is None:
+        data = fetch(url)
+        content_hash = _sha256(data)
+        _write_atomic(os.path.join(cache_dir, content_hash, 'original'), data)
+        _write_atomic(url_path, content_hash.encode())
+
+    sized_path = os.path.join(cache_dir, content_hash, f"{size}.jpg")
+    if not os.path.exists(sized_path):
+        _write_atomic(sized_path, resize(data, size))
+        _pruner.maybe_prune(cache_dir, max_bytes)
+
+    return sized_path
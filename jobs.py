@@ -0,0 +1,242 @@
+"""Durable job queue for work that shouldn't hold up a request.
+
+Routes `enqueue` a job in the same transaction as the change that needs
+it, so a job exists exactly when its change was committed. Workers (`flask
+run-jobs`, the "worker" process in the Procfile) claim jobs from the
+`jobs` table with `SELECT ... FOR UPDATE SKIP LOCKED` on Postgres, so any
+number of them can poll without taking the same job. On SQLite, which has
+no row locks, a conditional UPDATE does the claiming instead.
+
+Job kinds are registered with the `job` decorator:
+
+    @jobs.job('index_message', concurrency=4, max_attempts=5)
+    def index_message(message_id): ...
+
+- `concurrency` caps how many jobs of the kind run at once, across workers:
+  the claiming UPDATE only succeeds while fewer are running, and on
+  Postgres claimers of a kind take turns (a transaction-scoped advisory
+  lock), so two workers can't both take the last slot.
+- Failed jobs are retried with exponential backoff, up to `max_attempts`,
+  then left as 'failed' with their error.
+- A handler's database work is committed together with marking its job
+  done, so it happens once. A handler that commits part way through must be
+  safe to run again.
+- Jobs still 'running' after STALE_AFTER (their worker died) are queued
+  again.
+"""
+
+import logging
+import time
+import traceback
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import db, Job
+
+log = logging.getLogger(__name__)
+
+JobType = namedtuple('JobType', ['func', 'concurrency', 'max_attempts'])
+
+# kind -> JobType
+HANDLERS = {}
+
+RETRY_BASE = timedelta(seconds=5)
+RETRY_MAX = timedelta(hours=1)
+STALE_AFTER = timedelta(minutes=10)
+
+MAX_ERROR_LENGTH = 2000
+
+
+def job(kind, concurrency=1, max_attempts=5):
+    """Register the decorated function as the handler for `kind` jobs."""
+
+    def register(func):
+        HANDLERS[kind] = JobType(func, concurrency, max_attempts)
+        return func
+
+    return register
+
+
+def enqueue(kind, payload=None, key=None, delay=0, session=None):
+    """Queue a `kind` job to be run with keyword arguments `payload`.
+
+    A job whose idempotency `key` was used before is not queued. Returns
+    whether the job was queued. Caller is responsible for committing.
+    """
+
+    session = session or db.session
+    dialect = session.connection().dialect.name
+    insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+    now = datetime.utcnow()
+
+    statement = (insert(Job)
+                 .values(kind=kind, payload=payload or {}, idempotency_key=key,
+                         status='queued', attempts=0,
+                         run_after=now + timedelta(seconds=delay),
+                         created_at=now)
+                 .on_conflict_do_nothing(index_elements=['idempotency_key']))
+
+    return session.execute(statement).rowcount == 1
+
+
+def retry_delay(attempts):
+    return min(RETRY_BASE * 2 ** (attempts - 1), RETRY_MAX)
+
+
+def claim(session=None, now=None):
+    """Mark the next runnable job 'running' and return it, or None."""
+
+    session = session or db.session
+    now = now or datetime.utcnow()
+    postgres = session.connection().dialect.name == 'postgresql'
+
+    # a first cut, without locks; the claim itself checks again
+    running = dict(session
+                   .query(Job.kind, func.count())
+                   .filter(Job.status == 'running')
+                   .group_by(Job.kind))
+    kinds = [kind for kind, job_type in HANDLERS.items()
+             if running.get(kind, 0) < job_type.concurrency]
+
+    while kinds:
+        query = (session
+                 .query(Job.id, Job.kind)
+                 .filter(Job.status == 'queued',
+                         Job.run_after <= now,
+                         Job.kind.in_(kinds))
+                 .order_by(Job.run_after, Job.id)
+                 .limit(1))
+        if postgres:
+            query = query.with_for_update(skip_locked=True)
+
+        row = query.first()
+        if row is None:
+            break
+        job_id, kind = row
+
+        if postgres:
+            # held until we commit, so the count below sees every claim of
+            # this kind made before ours
+            session.execute(db.select(func.pg_advisory_xact_lock(
+                func.hashtext(f"jobs:{kind}"))))
+
+        running = db.aliased(Job)
+        under_limit = (db.select(func.count())
+                       .select_from(running)
+                       .where(running.kind == kind,
+                              running.status == 'running')
+                       .scalar_subquery() < HANDLERS[kind].concurrency)
+
+        claimed = (session
+                   .query(Job)
+                   .filter(Job.id == job_id, Job.status == 'queued',
+                           under_limit)
+                   .update({Job.status: 'running',
+                            Job.attempts: Job.attempts + 1,
+                            Job.locked_at: now},
+                           synchronize_session=False))
+        session.commit()
+
+        if claimed:
+            return session.query(Job).get(job_id)
+
+        # the kind filled up since we counted (or, without row locks,
+        # another worker took the job); try the others
+        kinds.remove(kind)
+
+    session.rollback()
+    return None
+
+
+def run_one(session=None, now=None):
+    """Claim and run one job; return it, or None if nothing was runnable."""
+
+    session = session or db.session
+    job = claim(session, now)
+    if job is None:
+        return None
+
+    job_id = job.id
+    job_type = HANDLERS[job.kind]
+
+    try:
+        job_type.func(**job.payload)
+    except Exception:
+        session.rollback()
+        job = session.query(Job).get(job_id)
+        job.last_error = traceback.format_exc()[-MAX_ERROR_LENGTH:]
+        job.locked_at = None
+
+        if job.attempts < job_type.max_attempts:
+            job.status = 'queued'
+            job.run_after = datetime.utcnow() + retry_delay(job.attempts)
+            log.warning("job %s (%s) failed, attempt %s; will retry",
+                        job_id, job.kind, job.attempts)
+        else:
+            job.status = 'failed'
+            log.error("job %s (%s) failed for good after %s attempts",
+                      job_id, job.kind, job.attempts)
+    else:
+        job = session.query(Job).get(job_id)
+        job.status = 'done'
+        job.locked_at = None
+
+    session.commit()
+    return job
+
+
+def requeue_stale(session=None, now=None):
+    """Queue again jobs whose worker stopped while running them.
+
+    Returns how many were requeued.
+    """
+
+    session = session or db.session
+    now = now or datetime.utcnow()
+
+    count = (session
+             .query(Job)
+             .filter(Job.status == 'running',
+                     Job.locked_at < now - STALE_AFTER)
+             .update({Job.status: 'queued', Job.locked_at: None,
+                      Job.run_after: now},
+                     synchronize_session=False))
+    session.commit()
+
+    return count
+
+
+def work(once=False, poll_interval=1.0, session=None):
+    """Run jobs until stopped; with `once`, until none are runnable.
+
+    Returns how many jobs were run.
+    """
+
+    session = session or db.session
+    count = 0
+    requeue_stale(session)
+
+    while True:
+        job = run_one(session)
+        if job is not None:
+            count += 1
+            continue
+
+        if once:
+            return count
+
+        requeue_stale(session)
+        time.sleep(poll_interval)
+
+
+def stats(session=None):
+    """Return {(kind, status): number of jobs}."""
+
+    session = session or db.session
+    return {(kind, status): count
+            for kind, status, count in (session
+                                        .query(Job.kind, Job.status, func.count())
+                                        .group_by(Job.kind, Job.status))}
@@ -0,0 +1,122 @@
+"""Simple HTTP load test for comparing gunicorn worker setups.
+
+    python loadtest.py http://localhost:8000/ --requests 2000 --concurrency 50
+
+Prints throughput and latency percentiles. To compare worker classes at
+equal memory, start the same number of worker processes each way, e.g.
+
+    WORKER_CLASS=sync   WEB_CONCURRENCY=2 gunicorn -c gunicorn.conf.py app:app
+    WORKER_CLASS=gevent WEB_CONCURRENCY=2 gunicorn -c gunicorn.conf.py app:app
+
+and run the same load test against each. Pass --cookie to test pages that
+need a logged-in session.
+
+--idle-streams N first opens N /stream (server-sent events) connections
+with that cookie and leaves them idle, like N users with the homepage open.
+Sync workers each get stuck on one stream, so with more streams than
+workers nothing else gets served; green workers keep serving.
+"""
+
+import argparse
+import socket
+import threading
+import time
+import urllib.request
+from urllib.error import HTTPError
+from urllib.parse import urlsplit
+
+
+def percentile(values, pct):
+    """Return the `pct` percentile of sorted `values`."""
+
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def run(url, requests, concurrency, cookie=None):
+    """Fetch `url` `requests` times from `concurrency` threads.
+
+    Returns (elapsed seconds, sorted latencies, error count).
+    """
+
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    remaining = iter(range(requests))
+
+    headers = {'Cookie': cookie} if cookie else {}
+
+    def worker():
+        while True:
+            with lock:
+                if next(remaining, None) is None:
+                    return
+
+            start = time.perf_counter()
+            try:
+                request = urllib.request.Request(url, headers=headers)
+                with urllib.request.urlopen(request) as response:
+                    response.read()
+                failed = False
+            except (HTTPError, OSError):
+                failed = True
+            elapsed = time.perf_counter() - start
+
+            with lock:
+                latencies.append(elapsed)
+                if failed:
+                    errors.append(elapsed)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return time.perf_counter() - start, sorted(latencies), len(errors)
+
+
+def open_idle_streams(url, count, cookie):
+    """Open `count` /stream connections on `url`'s host; return the sockets."""
+
+    parts = urlsplit(url)
+    request = (f"GET /stream HTTP/1.1\r\nHost: {parts.netloc}\r\n"
+               f"Cookie: {cookie or ''}\r\n\r\n").encode()
+
+    streams = []
+    for _ in range(count):
+        stream = socket.create_connection((parts.hostname, parts.port or 80))
+        stream.sendall(request)
+        streams.append(stream)
+
+    return streams
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('url')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--cookie', help="Cookie header to send")
+    parser.add_argument('--idle-streams', type=int, default=0,
+                        help="Idle /stream connections to hold open")
+    args = parser.parse_args()
+
+    streams = open_idle_streams(args.url, args.idle_streams, args.cookie)
+    time.sleep(1 if streams else 0)
+
+    elapsed, latencies, errors = run(args.url, args.requests,
+                                     args.concurrency, args.cookie)
+
+    print(f"{len(latencies)} requests in {elapsed:.2f}s "
+          f"({len(latencies) / elapsed:.1f} req/s), {errors} errors")
+    for pct in (50, 90, 99):
+        print(f"p{pct}: {percentile(latencies, pct) * 1000:.1f} ms")
+
+    for stream in streams:
+        stream.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,48 @@
 """SQLAlchemy models for Warbler."""
 
+import secrets
+import time
 from datetime import datetime
 
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.dialects.postgresql import TSVECTOR
+
+import followgraph
+import profilecache
 
 bcrypt = Bcrypt()
 db = SQLAlchemy()
 
+# Accounts being deleted are renamed to "deleted-<id>" with an email at
+# this domain (see User.mark_deleted); the prefix can't be signed up with.
+DELETED_USERNAME_PREFIX = "deleted-"
+DELETED_EMAIL_DOMAIN = "@deleted.invalid"
+
+# Ids are Postgres integers; anything outside this range can't be one
+ID_RANGE = range(-2**31, 2**31)
+
+
+def run_blocking(func, *args):
+    """Call `func(*args)`, off the event loop if we're in a gevent worker.
+
+    bcrypt keeps the CPU busy for a noticeable time; in a green worker that
+    would stall every other request the process is serving, so we hand it to
+    gevent's thread pool (bcrypt releases the GIL while hashing).
+    """
+
+    try:
+        from gevent import get_hub, monkey
+    except ImportError:
+        return func(*args)
+
+    if monkey.is_module_patched('threading'):
+        return get_hub().threadpool.apply(func, args)
+
+    return func(*args)
+
 
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
@@ -24,14 +59,86 @@ class Follows(db.Model):
         db.Integer,
         db.ForeignKey('users.id', ondelete="cascade"),
         primary_key=True,
+        index=True,
+    )
+
+
+class FollowEvent(db.Model):
+    """A follow or unfollow, logged while the follow graph is in use so
+    every process's copy can catch up with it (see followgraph.py)."""
+
+    __tablename__ = 'follow_events'
+
+    id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+    )
+
+    # no foreign keys: an unfollow outlives a deleted account
+    follower_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    followed_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    following = db.Column(
+        db.Boolean,
+        nullable=False,
     )
 
+    # unix time, as the graph keeps it
+    at = db.Column(
+        db.Float,
+        nullable=False,
+        index=True,
+    )
+
+    @classmethod
+    def log(cls, edges, following):
+        """Log follows (or unfollows) of (follower id, followed id) `edges`.
+
+        Does nothing unless the follow graph is in use. Caller is responsible
+        for committing, with the change itself.
+        """
+
+        if not followgraph.enabled() or not edges:
+            return
+
+        at = time.time()
+        db.session.execute(db.insert(cls).values(
+            [{'follower_id': follower_id, 'followed_id': followed_id,
+              'following': following, 'at': at}
+             for follower_id, followed_id in edges]))
+
+    @classmethod
+    def since(cls, at):
+        """(follower, followed, following, at) for events after `at`, in the
+        order they were logged."""
+
+        with db.engine.connect() as connection:
+            return connection.execute(
+                db.select(cls.follower_id, cls.followed_id, cls.following,
+                          cls.at)
+                .where(cls.at > at)
+                .order_by(cls.id)).all()
+
 
 class User(db.Model):
     """User in the system."""
 
     __tablename__ = 'users'
 
+    __table_args__ = (
+        # case-insensitive username prefix search (autocomplete); "C" order,
+        # so it serves both LIKE 'prefix%' and ORDER BY for the first N
+        db.Index('ix_users_username_prefix',
+                 db.text('lower(username) COLLATE "C"')),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True,
@@ -74,31 +181,40 @@ class User(db.Model):
         nullable=False,
     )
 
-    ## like columns thats linked to the specific message id
-    # everytime you click on the heart it makes post request that either update user.likes.append(new_liked_message) or user.likes.pop(unliked_message)
+    # These are query-style ("dynamic") relationships: reading one gives a
+    # query to count or .limit(), never the whole collection. Related rows
+    # are removed by the database's ON DELETE CASCADE, not loaded to be
+    # deleted one by one.
 
     messages = db.relationship('Message',
+                                lazy='dynamic',
                                 cascade='all, delete',
+                                passive_deletes=True,
                                 order_by='Message.timestamp.desc()')
 
     followers = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_being_followed_id == id),
-        secondaryjoin=(Follows.user_following_id == id)
+        secondaryjoin=(Follows.user_following_id == id),
+        lazy='dynamic',
+        passive_deletes=True,
     )
 
     following = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_following_id == id),
-        secondaryjoin=(Follows.user_being_followed_id == id)
+        secondaryjoin=(Follows.user_being_followed_id == id),
+        lazy='dynamic',
+        passive_deletes=True,
     )
 
     likes = db.relationship('Message',
                                 secondary= "likes",
-                                backref="users",
-                                cascade='all, delete',
+                                backref=db.backref("users", lazy='dynamic'),
+                                lazy='dynamic',
+                                passive_deletes=True,
                                 order_by='Message.timestamp.desc()')
 
 
@@ -107,37 +223,268 @@ class User(db.Model):
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
+    @hybrid_property
+    def is_deleted(self):
+        """Has this account been deleted (and is waiting to be removed)?
+
+        Works in queries too: `~User.is_deleted` filters deleted accounts out.
+        """
+
+        return self.email.endswith(DELETED_EMAIL_DOMAIN)
+
+    def mark_deleted(self):
+        """Free this account's username and email, and lock it out.
+
+        The password becomes the hash of a random one nobody knows, which
+        also revokes the account's API tokens. Caller is responsible for
+        committing.
+        """
+
+        self.username = f"{DELETED_USERNAME_PREFIX}{self.id}"
+        self.email = f"{DELETED_USERNAME_PREFIX}{self.id}{DELETED_EMAIL_DOMAIN}"
+        self.password = run_blocking(bcrypt.generate_password_hash,
+                                     secrets.token_urlsafe(32)).decode('UTF-8')
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        graph = followgraph.current()
+        if graph:
+            return graph.is_following(other_user.id, self.id)
+
+        return Follows.query.filter_by(user_being_followed_id=self.id,
+                                       user_following_id=other_user.id).count() > 0
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        graph = followgraph.current()
+        if graph:
+            return graph.is_following(self.id, other_user.id)
 
+        return Follows.query.filter_by(user_following_id=self.id,
+                                       user_being_followed_id=other_user.id).count() > 0
+
+    def following_count(self):
+        graph = followgraph.current()
+        if graph:
+            return graph.following_count(self.id)
+
+        return self.following.count()
+
+    def followers_count(self):
+        graph = followgraph.current()
+        if graph:
+            return graph.followers_count(self.id)
+
+        return self.followers.count()
+
+    def followed_by_following(self, other_user):
+        """How many people this user follows also follow `other_user`."""
+
+        graph = followgraph.current()
+        if graph:
+            return graph.followed_by_following(self.id, other_user.id)
+
+        return (Follows.query
+                .filter(Follows.user_being_followed_id == other_user.id,
+                        Follows.user_following_id.in_(self.following_ids()))
+                .count())
+
+    def following_ids(self):
+        """Query for the ids of users this user follows (not loaded yet)."""
+
+        return (db.session
+                .query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == self.id))
+
+    def follow(self, user_id):
+        """Follow user `user_id` (if not already) and commit.
+
+        Inserts the follows row directly, without loading `self.following`.
+        Returns True if a new follow was added.
+        """
+        insert = (postgresql.insert(Follows)
+                  .values(user_following_id=self.id,
+                          user_being_followed_id=user_id)
+                  .on_conflict_do_nothing())
+        added = db.session.execute(insert).rowcount > 0
+        if added:
+            FollowEvent.log([(self.id, user_id)], True)
+        db.session.commit()
+        if added:
+            followgraph.record(self.id, user_id, True)
+            profilecache.invalidate(self.id)
+            profilecache.invalidate(user_id)
+        return added
+
+    def unfollow(self, user_id):
+        """Stop following user `user_id` and commit.
+
+        Returns True if a follow was removed.
+        """
+        removed = Follows.query.filter_by(user_following_id=self.id,
+                                          user_being_followed_id=user_id).delete()
+        if removed:
+            FollowEvent.log([(self.id, user_id)], False)
+        db.session.commit()
+        if removed:
+            followgraph.record(self.id, user_id, False)
+            profilecache.invalidate(self.id)
+            profilecache.invalidate(user_id)
+        return removed > 0
+
+    def follow_many(self, users, following=True):
+        """Follow (or, with `following` False, unfollow) many users and commit.
+
+        `users` are user ids (ints) or usernames (strs, a leading "@" is
+        fine). They're looked up with one query, then the follows rows are
+        inserted (or deleted) with one statement, in one transaction.
+
+        Returns a result per item of `users`, in order: {"user": item,
+        "id": user id or None, "status": ...}, where status is "followed"
+        (or "unfollowed"), "unchanged" if already so, "not_found", "self"
+        or "invalid" (neither a username nor an id in ID_RANGE).
+        """
+
+        if following:
+            return self.update_follows(follow=users)[0]
+        return self.update_follows(unfollow=users)[1]
+
+    def update_follows(self, follow=(), unfollow=()):
+        """Follow the users in `follow`, then unfollow those in `unfollow`,
+        in one transaction, and commit.
+
+        Returns (results for `follow`, results for `unfollow`), each as
+        `follow_many` describes.
+        """
+
+        follow_results, followed = self._change_follows(follow, True)
+        unfollow_results, unfollowed = self._change_follows(unfollow, False)
+        db.session.commit()
+
+        for changed, following in ((followed, True), (unfollowed, False)):
+            if changed:
+                followgraph.record_many(self.id, sorted(changed), following)
+        if followed or unfollowed:
+            profilecache.invalidate(self.id)
+            for user_id in followed | unfollowed:
+                profilecache.invalidate(user_id)
+
+        return follow_results, unfollow_results
+
+    def _change_follows(self, users, following):
+        """Insert or delete follows rows for `users` without committing.
+
+        Returns (results, ids of the users whose row changed).
+        """
+
+        def parse(user):
+            if isinstance(user, int) and not isinstance(user, bool):
+                return (user, None) if user in ID_RANGE else (None, None)
+            if isinstance(user, str) and user.strip().lstrip('@'):
+                return None, user.strip().lstrip('@')
+            return None, None
+
+        parsed = [parse(user) for user in users]
+        ids = {id for id, _ in parsed if id is not None}
+        usernames = {username for _, username in parsed if username is not None}
+
+        found = (db.session
+                 .query(User.id, User.username)
+                 .filter(db.or_(User.id.in_(ids),
+                                User.username.in_(usernames)),
+                         ~User.is_deleted)
+                 .all()) if ids or usernames else []
+        found_ids = {id for id, _ in found}
+        ids_by_username = {username: id for id, username in found}
+
+        targets = sorted(found_ids - {self.id})
+        changed = set()
+        if targets and following:
+            insert = (postgresql.insert(Follows)
+                      .values([{'user_following_id': self.id,
+                                'user_being_followed_id': user_id}
+                               for user_id in targets])
+                      .on_conflict_do_nothing()
+                      .returning(Follows.user_being_followed_id))
+            changed = {id for (id,) in db.session.execute(insert)}
+        elif targets:
+            delete = (db.delete(Follows)
+                      .where(Follows.user_following_id == self.id,
+                             Follows.user_being_followed_id.in_(targets))
+                      .returning(Follows.user_being_followed_id))
+            changed = {id for (id,) in db.session.execute(delete)}
+        FollowEvent.log([(self.id, user_id) for user_id in sorted(changed)],
+                        following)
+
+        results = []
+        for user, (id, username) in zip(users, parsed):
+            if id is not None:
+                user_id = id if id in found_ids else None
+            elif username is not None:
+                user_id = ids_by_username.get(username)
+            else:
+                results.append({"user": user, "id": None, "status": "invalid"})
+                continue
+
+            if user_id is None:
+                status = "not_found"
+            elif user_id == self.id:
+                status = "self"
+            elif user_id in changed:
+                status = "followed" if following else "unfollowed"
+            else:
+                status = "unchanged"
+            results.append({"user": user, "id": user_id, "status": status})
+
+        return results, changed
 
     def like_message(self, message):
-        """Has this message been liked by the user? If not, add relationship to likes table and commit"""
+        """Has this message been liked by the user? If not, add relationship to likes table and commit
+
+        Returns True if a new like was added.
+        """
         if not self.has_liked_message(message):
             like = Like(user_id=self.id, message_id=message.id)
             db.session.add(like)
             db.session.commit()
+            profilecache.invalidate(self.id)
+            return True
+
+        return False
 
     def unlike_message(self, message):
-        """Has this message been liked by the user? If so, remove relationship from likes table"""
-        if self.has_liked_message(message):
-            Like.query.filter_by(user_id=self.id,message_id=message.id).delete()
-            db.session.commit()
+        """Has this message been liked by the user? If so, remove relationship from likes table
+
+        Returns when the removed like was made, or None if there wasn't one.
+        """
+        liked_at = db.session.execute(
+            db.delete(Like)
+            .where(Like.user_id == self.id, Like.message_id == message.id)
+            .returning(Like.created_at)).scalar()
+        db.session.commit()
+        if liked_at is not None:
+            profilecache.invalidate(self.id)
+        return liked_at
 
     def has_liked_message(self,message):
         """Check likes table for relationship between user and message"""
         return Like.query.filter(Like.user_id == self.id,
                                 Like.message_id == message.id).count() > 0
 
+    def liked_message_ids(self, messages):
+        """Ids of those of `messages` this user has liked (one query)."""
+
+        ids = [message.id for message in messages]
+        if not ids:
+            return set()
+
+        return {id for (id,) in (db.session
+                                 .query(Like.message_id)
+                                 .filter(Like.user_id == self.id,
+                                         Like.message_id.in_(ids)))}
+
 
 
     @classmethod
@@ -147,7 +494,8 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = run_blocking(bcrypt.generate_password_hash,
+                                  password).decode('UTF-8')
 
         user = User(
             username=username,
@@ -173,7 +521,8 @@ class User(db.Model):
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = run_blocking(bcrypt.check_password_hash,
+                                   user.password, password)
             if is_auth:
                 return user
 
@@ -185,6 +534,15 @@ class Message(db.Model):
 
     __tablename__ = 'messages'
 
+    __table_args__ = (
+        db.Index('ix_messages_search_vector', 'search_vector',
+                 postgresql_using='gin'),
+        # a user's messages by time: profiles, timelines and "since" polls
+        db.Index('ix_messages_user_id_timestamp', 'user_id', 'timestamp'),
+        # a user's messages past a since_id cursor, in id order
+        db.Index('ix_messages_user_id_id', 'user_id', 'id'),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True,
@@ -203,18 +561,110 @@ class Message(db.Model):
 
     user_id = db.Column(
         db.Integer,
-        db.ForeignKey('users.id'),
+        db.ForeignKey('users.id', ondelete="cascade"),
         nullable=False,
     )
 
+    # kept current by Postgres; used for full-text search (see search.py)
+    search_vector = db.deferred(db.Column(
+        TSVECTOR,
+        db.Computed("to_tsvector('english', text)", persisted=True),
+    ))
+
     user = db.relationship('User')
 
+    @classmethod
+    def bulk_create(cls, user_id, texts):
+        """Add many messages for `user_id` with a single multi-row insert.
+
+        Items that aren't valid message text are skipped rather than failing
+        the whole batch. Returns (ids of the new messages, errors), where
+        errors is a list of {"index": ..., "error": ...} dicts pointing back
+        into `texts`.
+
+        Caller is responsible for committing.
+        """
+
+        max_length = cls.text.type.length
+        timestamp = datetime.utcnow()
+        rows = []
+        errors = []
+
+        for index, text in enumerate(texts):
+            if not isinstance(text, str) or not text.strip():
+                errors.append({"index": index, "error": "Text is required."})
+            elif len(text) > max_length:
+                errors.append({
+                    "index": index,
+                    "error": f"Text is longer than {max_length} characters.",
+                })
+            else:
+                rows.append({"user_id": user_id,
+                             "text": text,
+                             "timestamp": timestamp})
+
+        if not rows:
+            return [], errors
+
+        ids = db.session.execute(cls.__table__.insert()
+                                 .values(rows)
+                                 .returning(cls.id)).scalars().all()
+        return sorted(ids), errors
+
 
 class Like(db.Model):
     """ a like table to join liked messages and users """
 
     __tablename__ = 'likes'
 
+    __table_args__ = (
+        # a user's likes, most recent first (message id breaks ties)
+        db.Index('ix_likes_user_id_created_at', 'user_id',
+                 db.text('created_at DESC'), db.text('message_id DESC')),
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+
+class Hashtag(db.Model):
+    """A #hashtag used in a message."""
+
+    __tablename__ = 'hashtags'
+
+    tag = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="cascade"),
+        primary_key=True,
+        index=True,
+    )
+
+
+class Mention(db.Model):
+    """An @mention of a user in a message."""
+
+    __tablename__ = 'mentions'
+
     user_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id', ondelete="cascade"),
@@ -225,8 +675,128 @@ class Like(db.Model):
         db.Integer,
         db.ForeignKey('messages.id', ondelete="cascade"),
         primary_key=True,
+        index=True,
+    )
+
+
+class TrendingScore(db.Model):
+    """Snapshot of a message's time-decayed trending score (see trending.py)."""
+
+    __tablename__ = 'trending_scores'
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+        index=True,
+    )
+
+
+class FollowSuggestion(db.Model):
+    """A precomputed "who to follow" suggestion (see suggestions.py)."""
+
+    __tablename__ = 'follow_suggestions'
+
+    __table_args__ = (
+        db.Index('ix_follow_suggestions_user_id_score', 'user_id', 'score'),
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    suggested_user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    # number of people `user_id` follows who follow `suggested_user_id`
+    score = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+
+class Job(db.Model):
+    """A unit of deferred work, run by `flask run-jobs` (see jobs.py)."""
+
+    __tablename__ = 'jobs'
+
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_after', 'status', 'run_after'),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    kind = db.Column(
+        db.String(50),
+        nullable=False,
+    )
+
+    payload = db.Column(
+        db.JSON,
+        nullable=False,
+        default=dict,
+    )
+
+    # a job with a key already used (by any job, in any state) isn't queued
+    idempotency_key = db.Column(
+        db.String(200),
+        unique=True,
+    )
+
+    # 'queued', 'running', 'done' or 'failed'
+    status = db.Column(
+        db.String(10),
+        nullable=False,
+        default='queued',
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    run_after = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
     )
 
+    locked_at = db.Column(
+        db.DateTime,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+
+# Loader policy for lists of Message instances (list pages mostly use the
+# rows in readmodels.py instead): templates show each author's id,
+# username and avatar, so load just those, for all authors in one query
+# (instead of one lazy load per author).
+AUTHOR_LOADER = db.selectinload(Message.user).load_only(
+    User.id, User.username, User.image_url)
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
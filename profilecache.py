@@ -0,0 +1,253 @@
+"""Profile summaries cached in memory shared by every worker on a host.
+
+The cache is one fixed-size file, mmap'd by each worker (put it on tmpfs,
+e.g. /dev/shm, so it never touches disk). It's a hash table of SLOT_SIZE
+byte slots in buckets of WAYS: a user id can only be in its bucket, and
+storing into a full bucket evicts the entry stored longest ago. Memory use
+is `slots * SLOT_SIZE` however many users there are, shared instead of
+multiplied by the number of workers.
+
+Reads take no lock. Each slot starts with a sequence number that a writer
+makes odd while it changes the slot and even again after (a seqlock); a
+reader that sees it odd or changed across its copy just reads again.
+Writers take an exclusive flock on the file.
+
+Invalidation is by version: a table of counters, one per user id (modulo
+its size), bumped by `invalidate`. An entry is only used if it was stored
+at the current version, and `put` only stores if the version hasn't moved
+since the caller read it (see `version`) -- so a summary read from the
+database before a change can't be cached after it. Entries also expire
+after `ttl` seconds, which bounds how stale counts changed elsewhere
+(imports, background jobs) can get.
+"""
+
+import fcntl
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+MAGIC = b'WPC1'
+# magic, padding, slot count, ways per bucket
+HEADER = struct.Struct('<4s4xqq')
+VERSION = SEQUENCE = struct.Struct('<Q')
+# sequence, user id, version, stored at, payload length, padding
+SLOT = struct.Struct('<QqQdI4x')
+
+SLOT_SIZE = 1024
+MAX_PAYLOAD = SLOT_SIZE - SLOT.size
+WAYS = 4
+
+# times a read retries a slot that's being written before giving up
+READ_RETRIES = 8
+
+
+class ProfileCache:
+    """A shared cache of JSON-serializable values keyed by user id."""
+
+    def __init__(self, path, slots=16384, ttl=60.0):
+        self.path = path
+        self.buckets = max(slots // WAYS, 1)
+        self.slots = self.buckets * WAYS
+        self.ttl = ttl
+
+        self.versions_at = HEADER.size
+        self.slots_at = self.versions_at + self.slots * VERSION.size
+        size = self.slots_at + self.slots * SLOT_SIZE
+
+        self._lock = threading.Lock()
+        self.fd = self._open(size)
+        self.buffer = mmap.mmap(self.fd, size)
+
+    def _open(self, size):
+        """Open the file, setting it up if it's new or laid out differently."""
+
+        header = HEADER.pack(MAGIC, self.slots, WAYS)
+
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            with _FileLock(fd, self._lock):
+                # replaced by another worker since we opened it
+                if os.fstat(fd).st_ino != os.stat(self.path).st_ino:
+                    os.close(fd)
+                    continue
+
+                current_size = os.fstat(fd).st_size
+                if current_size == 0:
+                    os.ftruncate(fd, size)
+                    os.pwrite(fd, header, 0)
+                    return fd
+                if (current_size == size and
+                        os.pread(fd, HEADER.size, 0) == header):
+                    return fd
+
+                # Laid out for other settings (and maybe mapped by workers
+                # still running them): swap in a new file rather than
+                # resizing this one under them.
+                new_path = f"{self.path}.{os.getpid()}.new"
+                new_fd = os.open(new_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC,
+                                 0o600)
+                os.ftruncate(new_fd, size)
+                os.pwrite(new_fd, header, 0)
+                os.close(new_fd)
+                os.replace(new_path, self.path)
+            os.close(fd)
+
+    def close(self):
+        self.buffer.close()
+        os.close(self.fd)
+
+    def _locked(self):
+        return _FileLock(self.fd, self._lock)
+
+    def _version_offset(self, user_id):
+        return self.versions_at + (user_id % self.slots) * VERSION.size
+
+    def _bucket_offsets(self, user_id):
+        bucket = hash(user_id) % self.buckets
+        first = self.slots_at + bucket * WAYS * SLOT_SIZE
+        return range(first, first + WAYS * SLOT_SIZE, SLOT_SIZE)
+
+    def version(self, user_id):
+        """`user_id`'s current version (read before loading what to `put`)."""
+
+        return VERSION.unpack_from(self.buffer, self._version_offset(user_id))[0]
+
+    def _read(self, offset):
+        """Consistent (user id, version, stored at, payload) at `offset`."""
+
+        for _ in range(READ_RETRIES):
+            sequence, user_id, version, stored_at, length = \
+                SLOT.unpack_from(self.buffer, offset)
+            if sequence & 1:
+                continue
+            start = offset + SLOT.size
+            payload = self.buffer[start:start + min(length, MAX_PAYLOAD)]
+            if SEQUENCE.unpack_from(self.buffer, offset)[0] == sequence:
+                return user_id, version, stored_at, payload
+
+        return None
+
+    def get(self, user_id):
+        """The value cached for `user_id`, or None."""
+
+        version = self.version(user_id)
+        now = time.time()
+
+        for offset in self._bucket_offsets(user_id):
+            entry = self._read(offset)
+            if entry and entry[0] == user_id:
+                _, entry_version, stored_at, payload = entry
+                if entry_version == version and now - stored_at < self.ttl:
+                    return json.loads(payload)
+                return None
+
+        return None
+
+    def put(self, user_id, value, version):
+        """Cache `value` for `user_id` if it's still at `version`.
+
+        Returns whether it was stored (not if it's been invalidated since,
+        or is too big for a slot).
+        """
+
+        payload = json.dumps(value, separators=(',', ':')).encode('utf-8')
+        if len(payload) > MAX_PAYLOAD:
+            return False
+
+        with self._locked():
+            if self.version(user_id) != version:
+                return False
+
+            # this user's slot, else an empty one, else the oldest
+            offsets = self._bucket_offsets(user_id)
+            entries = [SLOT.unpack_from(self.buffer, offset)
+                       for offset in offsets]
+            index = next(
+                (index for index, entry in enumerate(entries)
+                 if entry[1] == user_id),
+                next((index for index, entry in enumerate(entries)
+                      if entry[1] == 0),
+                     min(range(WAYS), key=lambda index: entries[index][3])))
+
+            offset = offsets[index]
+            sequence = entries[index][0]
+            SEQUENCE.pack_into(self.buffer, offset, sequence + 1)
+            self.buffer[offset + SLOT.size:
+                        offset + SLOT.size + len(payload)] = payload
+            SLOT.pack_into(self.buffer, offset, sequence + 1, user_id, version,
+                           time.time(), len(payload))
+            SEQUENCE.pack_into(self.buffer, offset, sequence + 2)
+
+        return True
+
+    def invalidate(self, user_id):
+        """Stop using (and storing) what's cached for `user_id` so far."""
+
+        with self._locked():
+            offset = self._version_offset(user_id)
+            VERSION.pack_into(self.buffer, offset,
+                              VERSION.unpack_from(self.buffer, offset)[0] + 1)
+
+
+class _FileLock:
+    """Exclusive across processes (flock) and this process's threads."""
+
+    def __init__(self, fd, lock):
+        self.fd = fd
+        self.lock = lock
+
+    def __enter__(self):
+        self.lock.acquire()
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+    def __exit__(self, *exc_info):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.lock.release()
+
+
+##############################################################################
+# This process's cache
+
+_settings = None
+_cache = None
+_pid = None
+
+
+def configure(path, slots=16384, ttl=60.0):
+    """Use a cache at `path` (None for no cache)."""
+
+    global _settings, _cache
+    _settings = (path, slots, ttl) if path else None
+    if _cache is not None:
+        _cache.close()
+    _cache = None
+
+
+def current():
+    """This worker's cache, or None if there isn't one.
+
+    Opened lazily, so each forked worker has its own descriptor (flock
+    locks belong to the open file, which a fork would share).
+    """
+
+    global _cache, _pid
+
+    if _settings is None:
+        return None
+
+    if _cache is None or _pid != os.getpid():
+        _cache = ProfileCache(*_settings)
+        _pid = os.getpid()
+
+    return _cache
+
+
+def invalidate(user_id):
+    """Forget `user_id`'s cached summary, if there's a cache."""
+
+    cache = current()
+    if cache is not None:
+        cache.invalidate(user_id)
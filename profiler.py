@@ -0,0 +1,202 @@
+"""Sampling profiler for production requests.
+
+A profiled request gets a background thread that looks at the request's
+stack every PROFILE_INTERVAL_MS and counts each distinct stack. That costs
+little (nothing is traced), so it's safe under real load. In a gevent
+worker it follows the request's own greenlet, so time spent waiting (on
+Postgres, say) shows up where it's spent rather than as other requests'
+work. Requests are profiled when:
+
+- they're picked at random (a PROFILE_SAMPLE fraction of requests), or
+- they carry an X-Warbler-Profile header with a token from
+  `flask profile-token`.
+
+Profiles are written in "folded" format, one file per request under
+PROFILE_DIR/<endpoint>/. Files for a route can be concatenated and fed to
+flamegraph.pl or speedscope:
+
+    cat $PROFILE_DIR/homepage/*.folded | flamegraph.pl > homepage.svg
+
+The oldest files are deleted once PROFILE_DIR holds more than
+PROFILE_MAX_BYTES (checked at most every PRUNE_INTERVAL seconds, since that
+walks the whole directory).
+"""
+
+import os
+import random
+import sys
+import time
+from collections import Counter
+
+from flask import g, request
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+
+import diskbudget
+
+PROFILE_HEADER = 'X-Warbler-Profile'
+
+# Profile tokens stop working after this many seconds
+TOKEN_MAX_AGE = 60 * 60
+
+# Static files say nothing; streams would profile an idle wait for minutes
+SKIP_ENDPOINTS = {'static', 'stream'}
+
+# how often (seconds) a process checks PROFILE_DIR's size
+PRUNE_INTERVAL = 60
+
+
+def green_worker():
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+
+    return monkey.is_module_patched('threading')
+
+
+def _os_thread_functions():
+    """Return (start_new_thread, get_ident, sleep, allocate_lock) that use
+    real OS threads, even in a gevent worker.
+
+    The sampler must keep running while the request hogs the CPU, which a
+    greenlet wouldn't.
+    """
+
+    if green_worker():
+        from gevent import monkey
+        return (monkey.get_original('_thread', 'start_new_thread'),
+                monkey.get_original('_thread', 'get_ident'),
+                monkey.get_original('time', 'sleep'),
+                monkey.get_original('_thread', 'allocate_lock'))
+
+    import _thread
+    return (_thread.start_new_thread, _thread.get_ident, time.sleep,
+            _thread.allocate_lock)
+
+
+def frame_label(frame):
+    code = frame.f_code
+    filename = os.path.basename(code.co_filename)
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})"
+
+
+class Sampler:
+    """Counts the stacks seen on one thread until stopped."""
+
+    def __init__(self, interval):
+        (self._start_thread, get_ident,
+         self._sleep, allocate_lock) = _os_thread_functions()
+        self.interval = interval
+        self.thread_id = get_ident()
+        if green_worker():
+            import greenlet
+            self.greenlet = greenlet.getcurrent()
+        else:
+            self.greenlet = None
+        self.stacks = Counter()
+        self._running = False
+        self._finished = allocate_lock()
+
+    def start(self):
+        self._running = True
+        self._finished.acquire()
+        self._start_thread(self._run, ())
+
+    def stop(self):
+        """Stop sampling; return the Counter of folded stacks."""
+
+        self._running = False
+        # wait for the sampling thread to finish its last sample
+        self._finished.acquire()
+        self._finished.release()
+        return self.stacks
+
+    def _frame(self):
+        """The request's current frame."""
+
+        # a switched-out greenlet keeps its frame in gr_frame; the running
+        # one is whatever its OS thread is running
+        if self.greenlet is not None and self.greenlet.gr_frame is not None:
+            return self.greenlet.gr_frame
+        return sys._current_frames().get(self.thread_id)
+
+    def _run(self):
+        try:
+            while self._running:
+                frame = self._frame()
+                stack = []
+                while frame is not None:
+                    stack.append(frame_label(frame))
+                    frame = frame.f_back
+                if stack:
+                    self.stacks[';'.join(reversed(stack))] += 1
+                self._sleep(self.interval)
+        finally:
+            self._finished.release()
+
+
+def get_serializer(secret_key):
+    return URLSafeTimedSerializer(secret_key, salt="profile")
+
+
+def make_token(secret_key):
+    """Return a value for the X-Warbler-Profile header."""
+
+    return get_serializer(secret_key).dumps("profile")
+
+
+def token_is_valid(token, secret_key):
+    try:
+        get_serializer(secret_key).loads(token, max_age=TOKEN_MAX_AGE)
+    except BadSignature:
+        return False
+    return True
+
+
+def write_profile(profile_dir, endpoint, stacks, elapsed_ms):
+    """Write `stacks` as a folded-stack file; return its path."""
+
+    route_dir = os.path.join(profile_dir, endpoint)
+    os.makedirs(route_dir, exist_ok=True)
+
+    path = os.path.join(
+        route_dir, f"{time.time():.3f}-{os.getpid()}-{elapsed_ms:.0f}ms.folded")
+    with open(path, 'w') as file:
+        for stack, count in stacks.most_common():
+            file.write(f"{stack} {count}\n")
+
+    return path
+
+
+_pruner = diskbudget.Pruner(PRUNE_INTERVAL)
+
+
+def init_app(app):
+    """Profile sampled or requested requests into app.config['PROFILE_DIR']."""
+
+    @app.before_request
+    def start_profiling():
+        if request.endpoint in SKIP_ENDPOINTS:
+            return
+
+        token = request.headers.get(PROFILE_HEADER)
+        wanted = (token_is_valid(token, app.config['SECRET_KEY']) if token
+                  else random.random() < app.config['PROFILE_SAMPLE'])
+
+        if wanted:
+            g.profile_sampler = Sampler(app.config['PROFILE_INTERVAL_MS'] / 1000)
+            g.profile_started = time.perf_counter()
+            g.profile_sampler.start()
+
+    @app.teardown_request
+    def finish_profiling(exc):
+        sampler = g.pop('profile_sampler', None)
+        if sampler is None:
+            return
+
+        stacks = sampler.stop()
+        elapsed_ms = (time.perf_counter() - g.profile_started) * 1000
+        write_profile(app.config['PROFILE_DIR'], request.endpoint or 'unknown',
+                      stacks, elapsed_ms)
+        _pruner.maybe_prune(app.config['PROFILE_DIR'],
+                            app.config['PROFILE_MAX_BYTES'])
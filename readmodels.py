@@ -0,0 +1,160 @@
+"""Read-only row objects for list pages.
+
+Timelines and user lists show a few columns of each message and user.
+Loading them as ORM instances loads every column (a user's password hash,
+bio and location included) and tracks each object in the session's
+identity map for the rest of the request. These pages instead run
+column-limited queries and wrap each row in a small `__slots__` object
+with the attributes the templates read (`msg.user.username`,
+`user.header_image_url`, ...), so the templates are the same either way.
+
+The rows are plain data: no lazy loads, no relationships, nothing to
+save. Views that need more than a list page shows use the models.
+"""
+
+import profilecache
+from models import db, User, Message, Follows, Like
+
+
+class AuthorRow:
+    """A message's author, as list pages show it."""
+
+    __slots__ = ('id', 'username', 'image_url')
+
+    def __init__(self, id, username, image_url):
+        self.id = id
+        self.username = username
+        self.image_url = image_url
+
+
+class MessageRow:
+    """A message in a list, with its author as `user`."""
+
+    __slots__ = ('id', 'text', 'timestamp', 'user_id', 'user')
+
+    def __init__(self, id, text, timestamp, user_id, user):
+        self.id = id
+        self.text = text
+        self.timestamp = timestamp
+        self.user_id = user_id
+        self.user = user
+
+
+class UserCardRow:
+    """A user as the cards on user lists show them."""
+
+    __slots__ = ('id', 'username', 'image_url', 'header_image_url', 'bio')
+
+    def __init__(self, id, username, image_url, header_image_url, bio):
+        self.id = id
+        self.username = username
+        self.image_url = image_url
+        self.header_image_url = header_image_url
+        self.bio = bio
+
+
+class ProfileRow:
+    """A user's profile header: who they are, and how many of everything."""
+
+    __slots__ = ('id', 'username', 'image_url', 'header_image_url', 'bio',
+                 'location', 'messages_count', 'following_count',
+                 'followers_count', 'likes_count')
+
+    def __init__(self, id, username, image_url, header_image_url, bio,
+                 location, messages_count, following_count, followers_count,
+                 likes_count):
+        self.id = id
+        self.username = username
+        self.image_url = image_url
+        self.header_image_url = header_image_url
+        self.bio = bio
+        self.location = location
+        self.messages_count = messages_count
+        self.following_count = following_count
+        self.followers_count = followers_count
+        self.likes_count = likes_count
+
+
+def _count(*criteria):
+    return (db.select(db.func.count())
+            .where(*criteria)
+            .scalar_subquery())
+
+
+MESSAGE_COLUMNS = (Message.id, Message.text, Message.timestamp,
+                   Message.user_id, User.username, User.image_url)
+
+USER_CARD_COLUMNS = (User.id, User.username, User.image_url,
+                     User.header_image_url, User.bio)
+
+PROFILE_COLUMNS = (User.id, User.username, User.image_url,
+                   User.header_image_url, User.bio, User.location,
+                   _count(Message.user_id == User.id),
+                   _count(Follows.user_following_id == User.id),
+                   _count(Follows.user_being_followed_id == User.id),
+                   _count(Like.user_id == User.id))
+
+
+def message_rows(query, *columns, limit=None):
+    """Run a `Message` query as a list of MessageRows, authors joined in.
+
+    Each author gets one AuthorRow, shared by their messages. With extra
+    `columns`, returns (row, value, ...) tuples instead. `limit` is applied
+    here, after the join.
+    """
+
+    authors = {}
+    results = []
+
+    query = (query
+             .join(User, User.id == Message.user_id)
+             .with_entities(*MESSAGE_COLUMNS, *columns))
+    if limit is not None:
+        query = query.limit(limit)
+
+    for values in query:
+        id, text, timestamp, user_id, username, image_url = values[:6]
+
+        author = authors.get(user_id)
+        if author is None:
+            author = authors[user_id] = AuthorRow(user_id, username, image_url)
+
+        row = MessageRow(id, text, timestamp, user_id, author)
+        results.append((row, *values[6:]) if columns else row)
+
+    return results
+
+
+def user_cards(query):
+    """Run a `User` query as UserCardRows, lazily (so it can be streamed)."""
+
+    return (UserCardRow(*values)
+            for values in query.with_entities(*USER_CARD_COLUMNS))
+
+
+def profile_summary(user_id):
+    """`user_id`'s ProfileRow, or None if there's no such (or a deleted)
+    user.
+
+    Served from the shared profile cache when there is one (see
+    profilecache.py); otherwise (or on a miss) it's one query.
+    """
+
+    cache = profilecache.current()
+    if cache is not None:
+        values = cache.get(user_id)
+        if values is not None:
+            return ProfileRow(*values)
+        version = cache.version(user_id)
+
+    values = (db.session
+              .query(*PROFILE_COLUMNS)
+              .filter(User.id == user_id, ~User.is_deleted)
+              .first())
+    if values is None:
+        return None
+
+    if cache is not None:
+        cache.put(user_id, list(values), version)
+
+    return ProfileRow(*values)
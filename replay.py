@@ -0,0 +1,193 @@
+"""Replay recorded traffic (see traffic.py) against a local Warbler.
+
+    python replay.py traffic.jsonl http://localhost:8000 --processes 4
+
+Requests are sent on the recorded schedule (--speed 2 replays twice as
+fast, --speed 0 as fast as possible), split over --processes worker
+processes. Each user's requests stay in one process, in order, and are
+sent with a session cookie for that user, signed with SECRET_KEY, so the
+server must use the same key. Only reads (GET/HEAD) are replayed; writes
+were recorded without their bodies and are counted as skipped.
+
+Prints latency percentiles per route next to the recorded p50, so a change
+can be checked against the real request mix.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import time
+import urllib.request
+from collections import defaultdict
+from urllib.error import HTTPError
+
+from flask import Flask
+from flask.sessions import SecureCookieSessionInterface
+
+from loadtest import percentile
+
+REPLAYED_METHODS = {'GET', 'HEAD'}
+
+# Never replayed: these hold the connection open until the client leaves
+SKIP_ENDPOINTS = {'stream'}
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    """Report redirects as responses instead of following them."""
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def load(path):
+    """Return recorded requests from `path`, oldest first."""
+
+    with open(path) as file:
+        records = [json.loads(line) for line in file if line.strip()]
+
+    return sorted(records, key=lambda record: record['ts'])
+
+
+def split(records, processes):
+    """Split replayable `records` into `processes` shares, by user.
+
+    Returns (shares, number of records skipped).
+    """
+
+    shares = [[] for _ in range(processes)]
+    skipped = 0
+
+    for index, record in enumerate(records):
+        if (record['method'] not in REPLAYED_METHODS
+                or record['endpoint'] in SKIP_ENDPOINTS):
+            skipped += 1
+            continue
+
+        user_id = record['user_id']
+        key = user_id if user_id is not None else index
+        shares[key % processes].append(record)
+
+    return shares, skipped
+
+
+def session_cookies(user_ids, secret_key):
+    """Return {user id: signed Flask session cookie logging in that user}."""
+
+    app = Flask(__name__)
+    app.secret_key = secret_key
+    serializer = SecureCookieSessionInterface().get_signing_serializer(app)
+
+    return {user_id: serializer.dumps({'curr_user': user_id})
+            for user_id in user_ids}
+
+
+def replay_share(base_url, records, speed, start_at, cookies):
+    """Send `records` on schedule from `start_at`.
+
+    Returns ([(endpoint, seconds, status)], seconds behind schedule at worst).
+    """
+
+    opener = urllib.request.build_opener(NoRedirect)
+    first_ts = records[0]['ts'] if records else 0
+    results = []
+    behind = 0
+
+    for record in records:
+        if speed:
+            due = start_at + (record['ts'] - first_ts) / speed
+            wait = due - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            else:
+                behind = max(behind, -wait)
+
+        headers = {}
+        if record['user_id'] is not None:
+            headers['Cookie'] = f"session={cookies[record['user_id']]}"
+
+        request = urllib.request.Request(base_url + record['path'],
+                                         headers=headers,
+                                         method=record['method'])
+        start = time.perf_counter()
+        try:
+            with opener.open(request) as response:
+                response.read()
+                status = response.status
+        except HTTPError as exc:
+            status = exc.code
+        except OSError:
+            status = None
+        results.append((record['endpoint'], time.perf_counter() - start, status))
+
+    return results, behind
+
+
+def report(records, results):
+    """Return report lines: latency percentiles per endpoint."""
+
+    recorded = defaultdict(list)
+    for record in records:
+        recorded[record['endpoint']].append(record['ms'])
+
+    replayed = defaultdict(list)
+    errors = defaultdict(int)
+    for endpoint, seconds, status in results:
+        replayed[endpoint].append(seconds * 1000)
+        if status is None or status >= 500:
+            errors[endpoint] += 1
+
+    lines = [f"{'route':<24}{'count':>7}{'errors':>7}{'p50':>9}{'p90':>9}"
+             f"{'p99':>9}{'max':>9}{'rec p50':>9}"]
+    for endpoint in sorted(replayed, key=lambda e: -len(replayed[e])):
+        times = sorted(replayed[endpoint])
+        was = sorted(recorded[endpoint])
+        lines.append(f"{str(endpoint):<24}{len(times):>7}{errors[endpoint]:>7}"
+                     f"{percentile(times, 50):>9.1f}{percentile(times, 90):>9.1f}"
+                     f"{percentile(times, 99):>9.1f}{times[-1]:>9.1f}"
+                     f"{percentile(was, 50):>9.1f}")
+
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('log', help="JSONL file written by the recorder")
+    parser.add_argument('url', help="Base URL, e.g. http://localhost:8000")
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help="Replay speed multiplier; 0 for no delays")
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--secret-key', default=os.environ.get('SECRET_KEY'),
+                        help="Server's SECRET_KEY (default: $SECRET_KEY)")
+    args = parser.parse_args()
+
+    records = load(args.log)
+    shares, skipped = split(records, args.processes)
+    user_ids = {record['user_id'] for record in records
+                if record['user_id'] is not None}
+    if user_ids and not args.secret_key:
+        parser.error("--secret-key (or SECRET_KEY) is needed to log in users")
+    cookies = session_cookies(user_ids, args.secret_key) if user_ids else {}
+
+    start_at = time.time() + 0.5
+    start = time.perf_counter()
+    with multiprocessing.Pool(args.processes) as pool:
+        outcomes = pool.starmap(
+            replay_share,
+            [(args.url.rstrip('/'), share, args.speed, start_at, cookies)
+             for share in shares])
+    elapsed = time.perf_counter() - start
+
+    results = [result for share_results, _ in outcomes
+               for result in share_results]
+    behind = max((behind for _, behind in outcomes), default=0)
+
+    print(f"{len(results)} requests in {elapsed:.2f}s "
+          f"({len(results) / elapsed:.1f} req/s), {skipped} writes/streams "
+          f"skipped, at worst {behind:.2f}s behind schedule")
+    for line in report(records, results):
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+"""Search over message text, hashtags and mentions.
+
+Two backends answer the same queries:
+
+- `PostgresSearch` uses the `messages.search_vector` tsvector column (kept
+  current by Postgres as a generated column) and its GIN index.
+- `MemorySearch` is an in-process inverted index, for tests. It only knows
+  about messages added to it. The app's tables still need Postgres.
+
+Queries that are a single "#tag" or "@username" go to the `hashtags` and
+`mentions` tables instead, which `index_tags` fills in when a message is
+posted (`index_tags_many` for messages added in bulk, and by
+`flask reindex-messages`).
+"""
+
+import re
+from collections import defaultdict
+
+from sqlalchemy import func
+
+from models import db, User, Message, Hashtag, Mention, AUTHOR_LOADER
+
+HASHTAG_RE = re.compile(r"#(\w+)")
+MENTION_RE = re.compile(r"@(\w+)")
+WORD_RE = re.compile(r"\w+")
+
+PER_PAGE = 20
+
+
+def index_tags(message):
+    """Record the hashtags and @mentions in `message`'s text.
+
+    Mentions of usernames that don't exist are ignored. Caller is
+    responsible for committing.
+    """
+
+    index_tags_many([message])
+
+
+def index_tags_many(messages):
+    """`index_tags` for many messages (anything with `id` and `text`), with
+    one username lookup for all of them.
+
+    Tags recorded for these messages before are replaced, so it's safe to
+    run again. Caller is responsible for committing.
+    """
+
+    tags = {}
+    usernames = {}
+    for message in messages:
+        tags[message.id] = {tag.lower()
+                            for tag in HASHTAG_RE.findall(message.text)}
+        usernames[message.id] = set(MENTION_RE.findall(message.text))
+
+    if not tags:
+        return
+
+    for model in (Hashtag, Mention):
+        (model.query
+         .filter(model.message_id.in_(list(tags)))
+         .delete(synchronize_session=False))
+
+    db.session.add_all(Hashtag(message_id=message_id, tag=tag)
+                       for message_id, message_tags in tags.items()
+                       for tag in message_tags)
+
+    wanted = set().union(*usernames.values())
+    if wanted:
+        user_ids = dict(db.session
+                        .query(User.username, User.id)
+                        .filter(User.username.in_(wanted)))
+        db.session.add_all(Mention(message_id=message_id,
+                                   user_id=user_ids[username])
+                           for message_id, names in usernames.items()
+                           for username in names if username in user_ids)
+
+
+def tag_query(q):
+    """Messages query for a lone "#tag" or "@username" search, else None."""
+
+    if HASHTAG_RE.fullmatch(q):
+        return (Message.query
+                .join(Hashtag, Hashtag.message_id == Message.id)
+                .filter(Hashtag.tag == q[1:].lower()))
+
+    if MENTION_RE.fullmatch(q):
+        return (Message.query
+                .join(Mention, Mention.message_id == Message.id)
+                .join(User, User.id == Mention.user_id)
+                .filter(User.username == q[1:]))
+
+    return None
+
+
+def paginate(query, page, per_page):
+    """Return (messages on `page`, whether there is a next page)."""
+
+    messages = (query
+                .options(AUTHOR_LOADER)
+                .offset((page - 1) * per_page)
+                .limit(per_page + 1)
+                .all())
+    return messages[:per_page], len(messages) > per_page
+
+
+class PostgresSearch:
+    """Full-text search with Postgres' tsvector/tsquery."""
+
+    def add(self, message):
+        """Nothing to do: `search_vector` is a generated column."""
+
+    def add_ids(self, message_ids):
+        """Nothing to do, as for `add`."""
+
+    def remove(self, message_id):
+        """Nothing to do: the row (and its index entries) are gone."""
+
+    def search(self, q, order='relevance', page=1, per_page=PER_PAGE):
+        """Return (messages, has_next) matching `q`.
+
+        `order` is 'relevance' (text rank, then newest) or 'recent'.
+        """
+
+        query = tag_query(q)
+
+        if query is None:
+            tsquery = func.websearch_to_tsquery('english', q)
+            query = Message.query.filter(Message.search_vector.op('@@')(tsquery))
+
+            if order == 'relevance':
+                query = query.order_by(
+                    func.ts_rank(Message.search_vector, tsquery).desc())
+
+        query = query.order_by(Message.timestamp.desc(), Message.id.desc())
+
+        return paginate(query, page, per_page)
+
+
+class MemorySearch:
+    """In-process inverted index from lowercased words to message ids."""
+
+    def __init__(self):
+        # word -> {message_id: times the word appears}
+        self._postings = defaultdict(dict)
+        self._words = {}
+
+    def add(self, message):
+        counts = defaultdict(int)
+        for word in WORD_RE.findall(message.text.lower()):
+            counts[word] += 1
+
+        for word, count in counts.items():
+            self._postings[word][message.id] = count
+        self._words[message.id] = list(counts)
+
+    def add_ids(self, message_ids):
+        """`add` messages that were inserted without being loaded."""
+
+        for message in (db.session
+                        .query(Message.id, Message.text)
+                        .filter(Message.id.in_(message_ids))):
+            self.add(message)
+
+    def remove(self, message_id):
+        for word in self._words.pop(message_id, ()):
+            postings = self._postings[word]
+            postings.pop(message_id, None)
+            if not postings:
+                del self._postings[word]
+
+    def search(self, q, order='relevance', page=1, per_page=PER_PAGE):
+        query = tag_query(q)
+        if query is not None:
+            query = query.order_by(Message.timestamp.desc(), Message.id.desc())
+            return paginate(query, page, per_page)
+
+        words = set(WORD_RE.findall(q.lower()))
+        if not words:
+            return [], False
+
+        postings = [self._postings.get(word, {}) for word in words]
+        ids = set.intersection(*(set(posting) for posting in postings))
+
+        # ids increase with time, so newest first is highest id first
+        if order == 'relevance':
+            key = lambda id: (sum(posting[id] for posting in postings), id)
+        else:
+            key = lambda id: id
+        ranked = sorted(ids, key=key, reverse=True)
+
+        start = (page - 1) * per_page
+        page_ids = ranked[start:start + per_page]
+        found = {message.id: message
+                 for message in (Message.query
+                                 .options(AUTHOR_LOADER)
+                                 .filter(Message.id.in_(page_ids)))}
+
+        return ([found[id] for id in page_ids if id in found],
+                len(ranked) > start + per_page)
+
+
+def make_search(kind):
+    """Return the search backend named by SEARCH_BACKEND."""
+
+    if kind == 'memory':
+        return MemorySearch()
+
+    return PostgresSearch()
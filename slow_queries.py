@@ -0,0 +1,257 @@
+"""Slow query log.
+
+With SLOW_QUERY_MS set, every SQL statement taking longer than that is
+logged with its parameters (secrets redacted) and the Flask endpoint (or
+CLI command) that ran it. The first time a worker sees a slow statement, it
+also captures the statement's plan in the background: `EXPLAIN (ANALYZE,
+BUFFERS)` for plain SELECTs, plain `EXPLAIN` for anything else -- ANALYZE
+runs the statement again, so it's never used on writes (data-modifying
+CTEs included) or on SELECT ... FOR UPDATE/SHARE, which would take the
+locks again.
+
+Statements are grouped by a normalized form (literals and bind parameters
+become "?", IN-lists collapse), so the same query with different ids counts
+as one. With SLOW_QUERY_LOG set, each slow statement is appended there as a
+JSON line; `flask slow-queries` summarizes the worst of them.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+from collections import defaultdict
+
+import click
+from flask import has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+log = logging.getLogger(__name__)
+
+# Longest parameter value kept in the log, in characters
+MAX_PARAM_LENGTH = 100
+
+# Parameters whose names match this are logged as REDACTED, as are values
+# that look like bcrypt hashes wherever they are
+_SECRET_PARAM_RE = re.compile(r"password|token|secret|email", re.I)
+_BCRYPT_RE = re.compile(r"^\$2[abxy]?\$\d\d\$")
+REDACTED = "REDACTED"
+
+_ROW_LOCK_RE = re.compile(r"\bFOR\s+(?:NO\s+KEY\s+)?(?:UPDATE|SHARE|KEY\s+SHARE)\b",
+                          re.I)
+
+_PARAMS_RE = re.compile(r"%\(\w+\)s|%s|\$\d+")
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_SPACE_RE = re.compile(r"\s+")
+
+
+def normalize(statement):
+    """Return `statement` with literals and parameters replaced by "?"."""
+
+    statement = _PARAMS_RE.sub("?", statement)
+    statement = _STRING_RE.sub("?", statement)
+    statement = _NUMBER_RE.sub("?", statement)
+    statement = _IN_LIST_RE.sub("(...)", statement)
+    return _SPACE_RE.sub(" ", statement).strip()
+
+
+def fingerprint(normalized):
+    return hashlib.sha1(normalized.encode()).hexdigest()[:12]
+
+
+def short_params(parameters):
+    """Parameters as JSON-safe values, with long values truncated and
+    secrets (passwords, tokens, emails) redacted."""
+
+    def short(value):
+        if value is None or isinstance(value, (bool, int, float)):
+            return value
+        text = str(value)
+        if _BCRYPT_RE.match(text):
+            return REDACTED
+        if len(text) > MAX_PARAM_LENGTH:
+            return text[:MAX_PARAM_LENGTH] + "..."
+        return text
+
+    if isinstance(parameters, dict):
+        return {key: REDACTED if _SECRET_PARAM_RE.search(str(key))
+                else short(value)
+                for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [short(value) for value in parameters]
+    return short(parameters)
+
+
+def can_analyze(statement):
+    """Is `statement` safe to run again under EXPLAIN ANALYZE?
+
+    Only plain SELECTs are: a WITH may hide an INSERT/UPDATE/DELETE, and
+    FOR UPDATE/SHARE would take (and maybe wait on) row locks.
+    """
+
+    return (statement.lstrip().upper().startswith('SELECT')
+            and not _ROW_LOCK_RE.search(statement))
+
+
+def source():
+    """The endpoint (or CLI command) the current statement runs for."""
+
+    if has_request_context():
+        return request.endpoint
+
+    context = click.get_current_context(silent=True)
+    return f"cli:{context.info_name}" if context else None
+
+
+class SlowQueryLog:
+    """Times statements on every engine; logs and explains slow ones."""
+
+    def __init__(self, app=None):
+        self.threshold_ms = None
+        self.path = None
+        # fingerprints this process has already captured a plan for
+        self.explained = set()
+        self._queue = queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.threshold_ms = app.config.get('SLOW_QUERY_MS')
+        self.path = app.config.get('SLOW_QUERY_LOG')
+
+        # listening either way (it's cheap when off), so the threshold can
+        # be turned on later
+        event.listen(Engine, 'before_cursor_execute', self.before_execute)
+        event.listen(Engine, 'after_cursor_execute', self.after_execute)
+
+    def before_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        if self.threshold_ms is not None:
+            context._query_started = time.perf_counter()
+
+    def after_execute(self, conn, cursor, statement, parameters, context,
+                      executemany):
+        started = getattr(context, '_query_started', None)
+        if self.threshold_ms is None or started is None:
+            return
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+        if (elapsed_ms < self.threshold_ms
+                or conn.get_execution_options().get('skip_slow_query_log')):
+            return
+
+        normalized = normalize(statement)
+        record = {
+            'ts': round(time.time(), 3),
+            'ms': round(elapsed_ms, 1),
+            'fingerprint': fingerprint(normalized),
+            'normalized': normalized,
+            'statement': statement,
+            'params': None if executemany else short_params(parameters),
+            'source': source(),
+            'plan': None,
+        }
+        log.warning("slow query (%.0f ms, %s): %s", elapsed_ms,
+                    record['source'], normalized[:200])
+
+        explain = None
+        if not executemany and record['fingerprint'] not in self.explained:
+            self.explained.add(record['fingerprint'])
+            explain = (conn.engine, statement, parameters)
+
+        self._queue.put((record, explain))
+        self._ensure_worker()
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._work, daemon=True)
+                self._worker.start()
+
+    def _work(self):
+        while True:
+            record, explain = self._queue.get()
+            try:
+                if explain:
+                    record['plan'] = self.explain(*explain)
+                self.write(record)
+            except Exception:
+                log.exception("couldn't record slow query")
+            finally:
+                self._queue.task_done()
+
+    def wait(self):
+        """Block until every slow query seen so far is recorded."""
+
+        self._queue.join()
+
+    def explain(self, engine, statement, parameters):
+        """Return the plan for `statement` as text."""
+
+        prefix = ("EXPLAIN (ANALYZE, BUFFERS) " if can_analyze(statement)
+                  else "EXPLAIN ")
+
+        if engine.dialect.name != 'postgresql':
+            prefix = "EXPLAIN "
+
+        with engine.connect() as conn:
+            conn = conn.execution_options(skip_slow_query_log=True)
+            # roll back anything ANALYZE did, and don't run too long
+            transaction = conn.begin()
+            try:
+                if engine.dialect.name == 'postgresql':
+                    conn.exec_driver_sql("SET LOCAL statement_timeout = 10000")
+                rows = conn.exec_driver_sql(prefix + statement, parameters)
+                return "\n".join(str(row[0]) for row in rows)
+            finally:
+                transaction.rollback()
+
+    def write(self, record):
+        if not self.path:
+            return
+
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            os.write(fd, (json.dumps(record) + "\n").encode())
+        finally:
+            os.close(fd)
+
+
+def summarize(records, top=10):
+    """Group `records` by statement; return the `top` by total time.
+
+    Each summary has the normalized statement, count, total and max ms, the
+    sources that ran it, the slowest example's parameters and a plan.
+    """
+
+    groups = defaultdict(list)
+    for record in records:
+        groups[record['fingerprint']].append(record)
+
+    summaries = []
+    for fingerprint, group in groups.items():
+        slowest = max(group, key=lambda record: record['ms'])
+        plans = [record['plan'] for record in group if record['plan']]
+        summaries.append({
+            'fingerprint': fingerprint,
+            'normalized': slowest['normalized'],
+            'count': len(group),
+            'total_ms': sum(record['ms'] for record in group),
+            'max_ms': slowest['ms'],
+            'sources': sorted({str(record['source']) for record in group}),
+            'params': slowest['params'],
+            'plan': plans[-1] if plans else None,
+        })
+
+    summaries.sort(key=lambda summary: summary['total_ms'], reverse=True)
+    return summaries[:top]
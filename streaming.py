@@ -0,0 +1,79 @@
+"""Streamed, incrementally compressed template responses.
+
+`stream_template` renders a template with Jinja's `generate()` and sends
+the HTML as it's produced, gzip-compressed on the fly when the client
+accepts it. Pass it queries (read with `yield_per`, so a server-side
+cursor on Postgres) rather than lists, and a page of thousands of cards is
+rendered from a batch of rows and one chunk of output at a time: the
+browser gets the page head at once, and worker memory stays flat however
+long the list is.
+
+Templates rendered this way can't use `|length` on their lists (use
+`{% for %}...{% else %}` for the empty case).
+"""
+
+import zlib
+
+from flask import (
+    Response, current_app, get_flashed_messages, request, stream_with_context,
+)
+
+# bytes of HTML gathered before a chunk is compressed and sent
+CHUNK_SIZE = 16 * 1024
+
+# rows fetched per round trip by `yield_per` on streamed pages
+BATCH_SIZE = 500
+
+
+def chunked(pieces, size=CHUNK_SIZE):
+    """Join Jinja's many small string pieces into ~`size` byte chunks."""
+
+    buffer = []
+    buffered = 0
+
+    for piece in pieces:
+        piece = piece.encode('utf-8')
+        buffer.append(piece)
+        buffered += len(piece)
+        if buffered >= size:
+            yield b''.join(buffer)
+            buffer = []
+            buffered = 0
+
+    if buffer:
+        yield b''.join(buffer)
+
+
+def gzipped(chunks):
+    """Gzip a stream of chunks, flushing after each so it's sent as it comes."""
+
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+
+    for chunk in chunks:
+        yield (compressor.compress(chunk) +
+               compressor.flush(zlib.Z_SYNC_FLUSH))
+
+    yield compressor.flush()
+
+
+def stream_template(template_name, **context):
+    """A response streaming `template_name` rendered with `context`."""
+
+    app = current_app._get_current_object()
+    app.update_template_context(context)
+    template = app.jinja_env.get_or_select_template(template_name)
+
+    # The session cookie is written before the body is rendered, so take the
+    # flashed messages out of it now; the template then gets them from the
+    # request (where get_flashed_messages caches them) as usual.
+    get_flashed_messages(with_categories=True)
+
+    body = chunked(template.generate(context))
+    headers = {'Vary': 'Accept-Encoding'}
+
+    if 'gzip' in request.accept_encodings:
+        body = gzipped(body)
+        headers['Content-Encoding'] = 'gzip'
+
+    return Response(stream_with_context(body), mimetype='text/html',
+                    headers=headers)
@@ -0,0 +1,104 @@
+"""Batch job computing "who to follow" suggestions for Warbler.
+
+Candidates are friends-of-friends: people followed by the people you follow,
+scored by how many of the people you follow follow them. The two-hop join,
+ranking and insert all run inside the database, one range of follower ids at
+a time, so the job's memory use depends on `batch_size` rather than on the
+size of the `follows` table.
+
+Run it periodically with `flask suggest-follows`.
+"""
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import aliased
+
+from models import db, User, Follows, FollowSuggestion
+
+
+def _candidates(start, end, per_user):
+    """Select top `per_user` suggestions for followers with ids in [start, end)."""
+
+    mine = aliased(Follows)
+    theirs = aliased(Follows)
+    already = aliased(Follows)
+
+    user_id = mine.user_following_id
+    suggested_user_id = theirs.user_being_followed_id
+
+    already_following = (db.session
+                         .query(already)
+                         .filter(already.user_following_id == user_id,
+                                 already.user_being_followed_id == suggested_user_id)
+                         .exists())
+
+    ranked = (db.session
+              .query(user_id.label('user_id'),
+                     suggested_user_id.label('suggested_user_id'),
+                     func.count().label('score'),
+                     func.row_number().over(
+                         partition_by=user_id,
+                         order_by=(func.count().desc(), suggested_user_id),
+                     ).label('rank'))
+              .join(theirs, theirs.user_following_id == mine.user_being_followed_id)
+              .filter(user_id >= start,
+                      user_id < end,
+                      suggested_user_id != user_id,
+                      ~already_following)
+              .group_by(user_id, suggested_user_id)
+              .subquery())
+
+    return (select(ranked.c.user_id, ranked.c.suggested_user_id, ranked.c.score)
+            .where(ranked.c.rank <= per_user))
+
+
+def compute_suggestions(per_user=10, batch_size=1000):
+    """Rebuild `follow_suggestions` for every user; return rows written.
+
+    Each batch of follower ids is replaced and committed on its own, so the
+    sidebar keeps showing the previous suggestions for users not yet reached.
+    """
+
+    max_id = db.session.query(func.max(User.id)).scalar() or 0
+    written = 0
+
+    for start in range(0, max_id + 1, batch_size):
+        end = start + batch_size
+
+        (FollowSuggestion.query
+         .filter(FollowSuggestion.user_id >= start,
+                 FollowSuggestion.user_id < end)
+         .delete(synchronize_session=False))
+
+        insert = (FollowSuggestion.__table__
+                  .insert()
+                  .from_select(['user_id', 'suggested_user_id', 'score'],
+                               _candidates(start, end, per_user)))
+        written += db.session.execute(insert).rowcount
+
+        db.session.commit()
+
+    return written
+
+
+def suggestions_for(user, limit=5):
+    """Return up to `limit` suggested users for `user`, best first.
+
+    Skips anyone `user` has followed since the job last ran.
+    """
+
+    already_following = (db.session
+                         .query(Follows)
+                         .filter(Follows.user_following_id == user.id,
+                                 Follows.user_being_followed_id
+                                 == FollowSuggestion.suggested_user_id)
+                         .exists())
+
+    return (User
+            .query
+            .join(FollowSuggestion,
+                  FollowSuggestion.suggested_user_id == User.id)
+            .filter(FollowSuggestion.user_id == user.id, ~already_following,
+                    ~User.is_deleted)
+            .order_by(FollowSuggestion.score.desc())
+            .limit(limit)
+            .all())
@@ -0,0 +1,200 @@
+"""Admission control tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_admission.py
+
+
+import os
+import sqlite3
+import tempfile
+import threading
+from unittest import TestCase
+
+from flask import Flask
+
+from models import db
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app
+from admission import (AdmissionControl, MemoryStore, SQLiteStore,
+                       EVICT_INTERVAL)
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.create_all()
+
+
+class TokenBucketTestCase(TestCase):
+    """Test the bucket stores."""
+
+    def check_store(self, store):
+        # burst of 2, then one token every 2 seconds
+        self.assertEqual(store.take("k", 0.5, 2, now=100), 0)
+        self.assertEqual(store.take("k", 0.5, 2, now=100), 0)
+        self.assertEqual(store.take("k", 0.5, 2, now=100), 2)
+        self.assertEqual(store.take("k", 0.5, 2, now=101), 1)
+        self.assertEqual(store.take("k", 0.5, 2, now=102), 0)
+
+        # other keys have their own bucket
+        self.assertEqual(store.take("other", 0.5, 2, now=102), 0)
+
+        store.incr("shed")
+        store.incr("shed", 2)
+        self.assertEqual(store.counters(), {"shed": 3})
+
+    def test_memory_store(self):
+        self.check_store(MemoryStore())
+
+    def test_sqlite_store(self):
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, "admission.sqlite")
+            self.check_store(SQLiteStore(path))
+
+            # a second worker sees the same buckets
+            self.assertEqual(SQLiteStore(path).take("k", 0.5, 2, now=102), 2)
+
+    def check_eviction(self, store):
+        store.take("idle", 0.5, 2, now=1000)
+        store.take("busy", 0.5, 2, now=1000)
+        store.take("busy", 0.5, 2, now=1000 + EVICT_INTERVAL - 1)
+        # slow to refill: 5 tokens, one a minute, two of them taken
+        store.take("slow", 1 / 60, 5, now=1000)
+        store.take("slow", 1 / 60, 5, now=1000)
+
+        # "idle" has refilled by now, so it goes; "busy" and "slow" haven't
+        store.take("new", 0.5, 2, now=1000 + EVICT_INTERVAL)
+        self.assertEqual(len(store), 3)
+        self.assertEqual(store.take("idle", 0.5, 2, now=1061), 0)
+
+    def test_memory_store_evicts_idle_buckets(self):
+        self.check_eviction(MemoryStore())
+
+    def test_sqlite_store_evicts_idle_buckets(self):
+        with tempfile.TemporaryDirectory() as dir:
+            self.check_eviction(SQLiteStore(os.path.join(dir, "a.sqlite")))
+
+    def test_sqlite_store_evicts_by_bucket(self):
+        """A worker that only sees a fast limit keeps other limits' buckets"""
+
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, "a.sqlite")
+            login, other = SQLiteStore(path), SQLiteStore(path)
+
+            for _ in range(5):
+                login.take("login:client:1", 1 / 60, 5, now=1000)
+            other.take("search:client:1", 10, 20, now=1000 + EVICT_INTERVAL)
+
+            self.assertEqual(len(other), 2)
+            self.assertEqual(login.take("login:client:1", 1 / 60, 5,
+                                        now=1000 + EVICT_INTERVAL), 0)
+            self.assertEqual(login.take("login:client:1", 1 / 60, 5,
+                                        now=1000 + EVICT_INTERVAL), 60)
+
+    def test_sqlite_store_locked(self):
+        """A store locked by another worker lets requests through"""
+
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, "admission.sqlite")
+            store = SQLiteStore(path)
+            store._connect().execute("PRAGMA busy_timeout = 10")
+
+            other = sqlite3.connect(path, isolation_level=None)
+            other.execute("BEGIN EXCLUSIVE")
+            try:
+                with self.assertLogs("admission", "WARNING"):
+                    self.assertEqual(store.take("k", 0.5, 1, now=100), 0)
+                    self.assertEqual(store.take("k", 0.5, 1, now=100), 0)
+                    store.incr("shed")
+            finally:
+                other.execute("ROLLBACK")
+                other.close()
+
+            self.assertEqual(store.take("k", 0.5, 1, now=100), 0)
+            self.assertEqual(store.take("k", 0.5, 1, now=100), 2)
+
+
+class AdmissionTestCase(TestCase):
+    """Test shedding requests."""
+
+    def test_login_rate_limited(self):
+        """Too many login attempts from one client get a 429"""
+
+        with app.test_client() as client:
+            statuses = [
+                client.post('/login',
+                            data={"username": "nobody", "password": "wrongpass"},
+                            environ_overrides={"REMOTE_ADDR": "10.0.0.26"}
+                            ).status_code
+                for _ in range(12)
+            ]
+
+            self.assertEqual(statuses[0], 200)
+            self.assertEqual(statuses[-1], 429)
+
+            resp = client.post('/login',
+                               environ_overrides={"REMOTE_ADDR": "10.0.0.26"})
+            self.assertGreaterEqual(int(resp.headers["Retry-After"]), 1)
+
+            # GETs of the form aren't limited
+            resp = client.get('/login',
+                              environ_overrides={"REMOTE_ADDR": "10.0.0.26"})
+            self.assertEqual(resp.status_code, 200)
+
+    def test_concurrency_shed(self):
+        """Requests over the concurrency limit queue, then get a 503"""
+
+        test_app = Flask(__name__)
+        admission = AdmissionControl(test_app)
+        entered = threading.Event()
+        release = threading.Event()
+
+        @test_app.get('/slow')
+        @admission.limit(concurrency=1, queue_timeout=0.1)
+        def slow():
+            entered.set()
+            release.wait(5)
+            return "done"
+
+        def first_request():
+            test_app.test_client().get('/slow')
+
+        thread = threading.Thread(target=first_request)
+        thread.start()
+        entered.wait(5)
+
+        resp = test_app.test_client().get('/slow')
+        release.set()
+        thread.join()
+
+        self.assertEqual(resp.status_code, 503)
+        self.assertIn("Retry-After", resp.headers)
+        self.assertEqual(admission.stats(),
+                         {"slow.queued": 1, "slow.shed.concurrency": 1})
+
+    def test_streamed_response_holds_slot(self):
+        """A streamed response keeps its slot until it's been sent"""
+
+        test_app = Flask(__name__)
+        admission = AdmissionControl(test_app)
+
+        @test_app.get('/stream')
+        @admission.limit(concurrency=1, queue_timeout=0.1)
+        def stream():
+            return test_app.response_class(iter(["a", "b"]))
+
+        client = test_app.test_client()
+        first = client.get('/stream', buffered=False)
+        self.assertEqual(client.get('/stream').status_code, 503)
+
+        self.assertEqual(first.get_data(as_text=True), "ab")
+        first.close()
+        self.assertEqual(client.get('/stream').status_code, 200)
@@ -0,0 +1,237 @@
+"""Message archival tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_archive.py
+
+
+import gzip
+import os
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+from unittest.mock import patch
+
+from sqlalchemy.exc import OperationalError
+
+from models import db, User, Message, Follows, Like
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, delete_user_job
+import archive
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.create_all()
+
+
+class ArchiveTestCase(TestCase):
+    """Test archiving old messages and reading them back."""
+
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        u1 = User.signup("testuser", "test@test.com", "HASHED_PASSWORD", None)
+        u2 = User.signup("test2user", "test2@test.com", "HASHED_PASSWORD2", None)
+        db.session.commit()
+
+        old1 = Message(text="old one", user_id=u1.id,
+                       timestamp=datetime(2020, 1, 5))
+        old2 = Message(text="old two", user_id=u1.id,
+                       timestamp=datetime(2020, 2, 5))
+        new = Message(text="new", user_id=u1.id)
+        db.session.add_all([old1, old2, new])
+        db.session.commit()
+
+        db.session.add(Like(user_id=u2.id, message_id=old1.id))
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.old1_id = old1.id
+        self.old2_id = old2.id
+        self.new_id = new.id
+
+        self.archive_dir = tempfile.TemporaryDirectory()
+        app.config['ARCHIVE_DIR'] = self.archive_dir.name
+
+    def tearDown(self):
+        db.session.rollback()
+        self.archive_dir.cleanup()
+
+    def test_archive_messages(self):
+        """Old months are moved to one file each; recent ones stay"""
+
+        archived = archive.archive_messages(self.archive_dir.name, 30)
+
+        self.assertEqual(archived, {"2020-01": 1, "2020-02": 1})
+        self.assertEqual([m.id for m in Message.query.all()], [self.new_id])
+        self.assertEqual(len(os.listdir(self.archive_dir.name)), 2)
+
+        message = archive.find_message(self.archive_dir.name, self.old1_id)
+        self.assertEqual(message.text, "old one")
+        self.assertEqual(message.timestamp, datetime(2020, 1, 5))
+        self.assertEqual(message.liked_by, [self.u2_id])
+        self.assertEqual(message.user.username, "testuser")
+
+        self.assertIsNone(archive.find_message(self.archive_dir.name,
+                                               self.new_id))
+
+    def test_find_record_stops_early(self):
+        """Finding a message reads its file only as far as the message"""
+
+        path = os.path.join(self.archive_dir.name, "messages.ndjson.gz")
+        with gzip.open(path, 'wt') as file:
+            file.write('{"id": 1, "text": "a"}\n{"id": 3, "text": "b"}\n'
+                       'past here is never read\n')
+
+        self.assertEqual(archive.find_record(path, 3)["text"], "b")
+        self.assertIsNone(archive.find_record(path, 2))
+
+    def test_show_archived_message(self):
+        """messages_show falls back to the archive"""
+
+        archive.archive_messages(self.archive_dir.name, 30)
+
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session["curr_user"] = self.u1_id
+
+            resp = client.get(f"/messages/{self.old2_id}")
+            html = resp.get_data(as_text=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("old two", html)
+            self.assertIn("(archived)", html)
+            # the author can still delete it
+            self.assertIn("Delete", html)
+
+            resp = client.get(f"/messages/{self.new_id + 1000}")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_archive_cli(self):
+        """The CLI archives using the given age"""
+
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=['archive-messages',
+                                     '--older-than-days', '30'])
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Archived 2 messages.", result.output)
+
+    def test_delete_archived_message(self):
+        """Authors can delete archived messages; nobody else can"""
+
+        archive.archive_messages(self.archive_dir.name, 30)
+
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session["curr_user"] = self.u2_id
+            client.post(f"/messages/{self.old1_id}/delete")
+            self.assertIsNotNone(
+                archive.find_message(self.archive_dir.name, self.old1_id))
+
+            with client.session_transaction() as change_session:
+                change_session["curr_user"] = self.u1_id
+            resp = client.post(f"/messages/{self.old1_id}/delete")
+            self.assertEqual(resp.location, f"/users/{self.u1_id}")
+
+            self.assertIsNone(
+                archive.find_message(self.archive_dir.name, self.old1_id))
+            self.assertEqual(client.get(f"/messages/{self.old1_id}").status_code,
+                             404)
+            # its month's file had nothing else, so it's gone
+            self.assertEqual(len(list(archive.archive_files(
+                self.archive_dir.name))), 1)
+
+    def test_deleted_author(self):
+        """Deleting an account clears it out of the archive"""
+
+        archive.archive_messages(self.archive_dir.name, 30)
+        old3 = Message(text="old three", user_id=self.u2_id,
+                       timestamp=datetime(2020, 1, 6))
+        db.session.add(old3)
+        db.session.commit()
+        old3_id = old3.id
+        archive.archive_messages(self.archive_dir.name, 30)
+
+        with app.test_client() as client:
+            # archived, but its author is gone
+            User.query.filter_by(id=self.u1_id).delete()
+            db.session.commit()
+            self.assertEqual(client.get(f"/messages/{self.old2_id}").status_code,
+                             404)
+
+        delete_user_job(self.u1_id)
+        delete_user_job(self.u2_id)
+
+        self.assertIsNone(archive.find_message(self.archive_dir.name,
+                                               self.old1_id))
+        self.assertIsNone(archive.find_message(self.archive_dir.name, old3_id))
+        self.assertEqual(list(archive.archive_files(self.archive_dir.name)), [])
+
+    def test_likes_wait_for_archiving(self):
+        """A like or unlike can't land between writing and deleting"""
+
+        write_archive = archive.write_archive
+        blocked = []
+
+        def write_then_like(*args):
+            path = write_archive(*args)
+
+            with db.engine.connect() as connection:
+                for statement in (
+                        db.insert(Like).values(user_id=self.u1_id,
+                                               message_id=self.old1_id),
+                        db.delete(Like).where(Like.user_id == self.u2_id)):
+                    transaction = connection.begin()
+                    try:
+                        connection.exec_driver_sql(
+                            "SET LOCAL lock_timeout = '100ms'")
+                        connection.execute(statement)
+                    except OperationalError:
+                        blocked.append(statement)
+                    finally:
+                        transaction.rollback()
+            return path
+
+        with patch.object(archive, 'write_archive', write_then_like):
+            archive.archive_month(self.archive_dir.name, datetime(2020, 1, 1),
+                                  datetime(2020, 2, 1))
+
+        self.assertEqual(len(blocked), 2)
+        message = archive.find_message(self.archive_dir.name, self.old1_id)
+        self.assertEqual(message.liked_by, [self.u2_id])
+
+    def test_likes_removed_with_liker(self):
+        """A deleted account's likes go from messages it didn't write"""
+
+        archive.archive_messages(self.archive_dir.name, 30)
+        self.assertEqual(archive.remove(self.archive_dir.name,
+                                        user_id=self.u2_id), 0)
+
+        message = archive.find_message(self.archive_dir.name, self.old1_id)
+        self.assertEqual(message.liked_by, [])
+
+    def test_user_records(self):
+        """A user's archived messages and likes are there for exports"""
+
+        archive.archive_messages(self.archive_dir.name, 30)
+
+        self.assertEqual(
+            [(r['record'], r['id'])
+             for r in archive.user_records(self.archive_dir.name, self.u1_id)],
+            [('message', self.old1_id), ('message', self.old2_id)])
+        self.assertEqual(
+            [(r['record'], r['id'])
+             for r in archive.user_records(self.archive_dir.name, self.u2_id)],
+            [('like', self.old1_id)])
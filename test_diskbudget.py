@@ -0,0 +1,60 @@
+"""Directory budget tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_diskbudget.py
+
+
+import os
+import tempfile
+import time
+from unittest import TestCase
+from unittest.mock import patch
+
+import diskbudget
+from diskbudget import prune, Pruner
+
+
+class DiskBudgetTestCase(TestCase):
+    """Test pruning a directory to its budget."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_prune(self):
+        """The oldest files go once the directory is over its budget"""
+
+        for age in (3, 2, 1):
+            path = os.path.join(self.directory.name, f"{age}", "file")
+            os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as file:
+                file.write("x" * 100)
+            mtime = time.time() - age
+            os.utime(path, (mtime, mtime))
+
+        prune(self.directory.name, 250)
+
+        self.assertFalse(os.path.exists(
+            os.path.join(self.directory.name, "3", "file")))
+        self.assertTrue(os.path.exists(
+            os.path.join(self.directory.name, "2", "file")))
+        self.assertTrue(os.path.exists(
+            os.path.join(self.directory.name, "1", "file")))
+
+    def test_pruner_interval(self):
+        """A Pruner walks the directory at most once per interval"""
+
+        pruner = Pruner(60)
+
+        with patch.object(diskbudget, 'prune') as prune_mock:
+            self.assertTrue(pruner.maybe_prune(self.directory.name, 250))
+            self.assertFalse(pruner.maybe_prune(self.directory.name, 250))
+            self.assertFalse(pruner.maybe_prune(self.directory.name, None))
+
+            pruner.pruned_at -= 60
+            self.assertTrue(pruner.maybe_prune(self.directory.name, 250))
+
+        self.assertEqual(prune_mock.call_count, 2)
@@ -0,0 +1,210 @@
+"""Live update (server-sent events) tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_events.py
+
+
+import json
+import os
+from unittest import TestCase
+from unittest.mock import patch
+
+import psycopg2
+
+from models import db, User, Message, Follows
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app
+import events
+from events import LocalBroker, PostgresBroker, PublishError, user_channel
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class BrokerTestCase(TestCase):
+    """Test the brokers."""
+
+    def test_local_broker(self):
+        """Subscribers get events for their channels only"""
+
+        broker = LocalBroker()
+        sub = broker.subscribe(["user:1", "user:2"])
+
+        broker.publish("user:1", {"id": 1})
+        broker.publish("user:3", {"id": 3})
+
+        self.assertEqual(sub.get(timeout=0), {"id": 1})
+        self.assertIsNone(sub.get(timeout=0))
+
+        sub.close()
+        broker.publish("user:1", {"id": 4})
+        self.assertIsNone(sub.get(timeout=0))
+
+    def test_postgres_broker(self):
+        """Events published by one worker reach another's subscribers"""
+
+        worker1 = PostgresBroker(app.config['SQLALCHEMY_DATABASE_URI'])
+        worker2 = PostgresBroker(app.config['SQLALCHEMY_DATABASE_URI'])
+
+        sub = worker2.subscribe(["user:1"])
+
+        # the listener starts in the background; keep publishing until it
+        # has picked one up
+        for attempt in range(20):
+            worker1.publish("user:1", {"id": attempt})
+            event = sub.get(timeout=0.25)
+            if event:
+                break
+
+        self.assertIsNotNone(event)
+        sub.close()
+
+    def publish_until_received(self, broker, sub, event):
+        for attempt in range(40):
+            broker.publish("user:1", event)
+            received = sub.get(timeout=0.25)
+            if received:
+                return received
+        return None
+
+    def test_postgres_broker_reconnects(self):
+        """The listener survives bad payloads and losing its connection"""
+
+        dsn = app.config['SQLALCHEMY_DATABASE_URI']
+        worker1 = PostgresBroker(dsn)
+        worker2 = PostgresBroker(dsn)
+
+        with patch.object(events, 'RECONNECT_DELAY', 0.1):
+            sub = worker2.subscribe(["user:1"])
+            self.assertEqual(self.publish_until_received(worker1, sub, {"id": 1}),
+                             {"id": 1})
+
+            with self.assertLogs('events') as logs:
+                admin = psycopg2.connect(dsn)
+                admin.autocommit = True
+                cursor = admin.cursor()
+                cursor.execute("SELECT pg_notify(%s, 'not json')",
+                               (events.NOTIFY_CHANNEL,))
+                cursor.execute("SELECT pg_terminate_backend(pid) "
+                               "FROM pg_stat_activity WHERE query LIKE "
+                               "'LISTEN %%' AND pid <> pg_backend_pid()")
+                admin.close()
+
+                self.assertEqual(
+                    self.publish_until_received(worker1, sub, {"id": 2}),
+                    {"id": 2})
+
+            self.assertTrue(any("malformed" in line for line in logs.output))
+            self.assertTrue(any("reconnecting" in line for line in logs.output))
+            self.assertTrue(worker2._listener.is_alive())
+        sub.close()
+
+
+    def test_postgres_broker_unreachable(self):
+        """Publishing to a broker that can't connect raises PublishError"""
+
+        broker = PostgresBroker("postgresql:///warbler_test?host=/nonexistent")
+        with self.assertRaises(PublishError):
+            broker.publish("user:1", {"id": 1})
+
+
+class StreamViewTestCase(TestCase):
+    """Test the /stream endpoint."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        u1 = User.signup("testuser", "test@test.com", "HASHED_PASSWORD","/static/images/default-pic.png")
+        u2 = User.signup("test2user", "test2@test.com", "HASHED_PASSWORD2","/static/images/default-pic.png")
+        db.session.commit()
+
+        u1.following.append(u2)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+    def tearDown(self):
+
+        db.session.rollback()
+
+    def test_stream_logged_out(self):
+        """Must be logged in to stream"""
+
+        with app.test_client() as client:
+            resp = client.get('/stream')
+            self.assertEqual(resp.status_code, 401)
+
+    def test_homepage_opens_stream(self):
+        """Pages only open /stream where streams don't tie up a worker"""
+
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session["curr_user"] = self.u1_id
+
+            # the test client is neither threaded nor gevent
+            self.assertNotIn('EventSource("/stream")',
+                             client.get('/').get_data(as_text=True))
+
+            with patch.dict(app.config, {'LIVE_UPDATES': True}):
+                self.assertIn('EventSource("/stream")',
+                              client.get('/').get_data(as_text=True))
+
+    def test_stream_pushes_new_messages(self):
+        """A followed user's new message is pushed down the stream"""
+
+        with app.test_client() as reader, app.test_client() as writer:
+            with reader.session_transaction() as change_session:
+                change_session["curr_user"] = self.u1_id
+            with writer.session_transaction() as change_session:
+                change_session["curr_user"] = self.u2_id
+
+            resp = reader.get('/stream', buffered=False)
+            self.assertEqual(resp.mimetype, 'text/event-stream')
+            chunks = iter(resp.response)
+            self.assertEqual(next(chunks), b"retry: 5000\n\n")
+
+            writer.post('/messages/new', data={"text": "live warble"})
+
+            event = next(chunks).decode()
+            resp.close()
+
+            self.assertIn("event: warble", event)
+            data = json.loads(event.split("data: ", 1)[1])
+            self.assertIn("live warble", data["html"])
+            self.assertIn("@test2user", data["html"])
+
+    def test_broker_down(self):
+        """A message is still added (and logged) when publishing fails"""
+
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session["curr_user"] = self.u2_id
+
+            with patch.object(LocalBroker, 'publish',
+                              side_effect=PublishError("down")):
+                with self.assertLogs(app.logger, 'ERROR'):
+                    resp = client.post('/messages/new',
+                                       data={"text": "quiet warble"})
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(Message.query.filter_by(text="quiet warble").count(), 1)
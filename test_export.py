@@ -0,0 +1,151 @@
+"""Data export tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_export.py
+
+
+import csv
+import gzip
+import io
+import json
+import os
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Like
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app
+import archive
+from export import gzip_chunks, export_records
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class ExportTestCase(TestCase):
+    """Test exporting a user's data."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        u1 = User.signup("testuser", "test@test.com", "HASHED_PASSWORD","/static/images/default-pic.png")
+        u2 = User.signup("test2user", "test2@test.com", "HASHED_PASSWORD2","/static/images/default-pic.png")
+        db.session.commit()
+
+        m1 = Message(text = "test message 1", user_id=u1.id)
+        m2 = Message(text = "test message 2", user_id=u2.id)
+        db.session.add_all([m1, m2])
+        db.session.commit()
+
+        db.session.add_all([
+            Like(user_id=u1.id, message_id=m2.id),
+            Follows(user_following_id=u1.id, user_being_followed_id=u2.id),
+        ])
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.m2_id = m2.id
+
+    def tearDown(self):
+
+        db.session.rollback()
+
+    def test_export_ndjson(self):
+        """Export streams gzipped NDJSON of everything the user owns"""
+
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session["curr_user"] = self.u1_id
+
+            resp = client.get('/users/export')
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertTrue(resp.is_streamed)
+            self.assertIn("warbler-testuser.ndjson.gz",
+                          resp.headers['Content-Disposition'])
+
+            lines = gzip.decompress(resp.data).decode().splitlines()
+            records = [json.loads(line) for line in lines]
+
+            self.assertEqual([r['record'] for r in records],
+                             ['message', 'like', 'following'])
+            self.assertEqual(records[0]['text'], "test message 1")
+            self.assertEqual(records[1]['id'], self.m2_id)
+            self.assertEqual(records[2]['username'], "test2user")
+
+    def test_export_archived(self):
+        """Archived messages and likes are exported too, first"""
+
+        with tempfile.TemporaryDirectory() as archive_dir:
+            archive.write_archive(archive_dir, datetime(2020, 1, 1), [
+                {'id': self.m2_id + 100, 'text': "archived",
+                 'timestamp': "2020-01-05T00:00:00", 'user_id': self.u1_id,
+                 'liked_by': []}])
+
+            records = list(export_records(User.query.get(self.u1_id),
+                                          archive_dir))
+
+        self.assertEqual([r['record'] for r in records],
+                         ['message', 'message', 'like', 'following'])
+        self.assertEqual(records[0]['text'], "archived")
+
+    def test_export_csv(self):
+        """CSV export has a header and one row per record"""
+
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session["curr_user"] = self.u1_id
+
+            resp = client.get('/users/export?format=csv')
+            rows = list(csv.DictReader(
+                io.StringIO(gzip.decompress(resp.data).decode())))
+
+            self.assertEqual(len(rows), 3)
+            self.assertEqual(rows[2]['username'], "test2user")
+
+    def test_export_logged_out(self):
+        """Must be logged in to export"""
+
+        with app.test_client() as client:
+            resp = client.get('/users/export', follow_redirects=True)
+            html = resp.get_data(as_text=True)
+
+            self.assertIn("Access unauthorized", html)
+
+    def test_export_cli(self):
+        """The CLI writes the same export"""
+
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=['export-user', 'testuser'])
+
+        self.assertEqual(result.exit_code, 0)
+        lines = gzip.decompress(result.stdout_bytes).decode().splitlines()
+        self.assertEqual(len(lines), 3)
+
+    def test_gzip_chunks_flushes(self):
+        """Compressed output arrives in several chunks for long exports"""
+
+        chunks = list(gzip_chunks((f"line {i}\n" for i in range(10)),
+                                  flush_every=2))
+
+        self.assertGreater(len(chunks), 2)
+        self.assertEqual(gzip.decompress(b"".join(chunks)).decode(),
+                         "".join(f"line {i}\n" for i in range(10)))
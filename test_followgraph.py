@@ -0,0 +1,197 @@
+"""Follow graph snapshot tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_followgraph.py
+
+
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, User, Message, Follows, FollowEvent
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app
+import followgraph
+from followgraph import FollowGraph
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.create_all()
+
+
+class FollowGraphTestCase(TestCase):
+    """Test the graph on its own."""
+
+    def setUp(self):
+        # 1 follows 2 and 3, 2 follows 3, 4 follows 3
+        self.graph = FollowGraph.from_edges([(1, 2), (1, 3), (2, 3), (4, 3)],
+                                            built_at=100)
+
+    def test_queries(self):
+        """Lookups and counts come from the arrays"""
+
+        graph = self.graph
+        self.assertTrue(graph.is_following(1, 2))
+        self.assertFalse(graph.is_following(2, 1))
+        self.assertFalse(graph.is_following(99, 1))
+        self.assertEqual(list(graph.following_ids(1)), [2, 3])
+        self.assertEqual(list(graph.follower_ids(3)), [1, 2, 4])
+        self.assertEqual(graph.following_count(4), 1)
+        self.assertEqual(graph.followers_count(1), 0)
+        self.assertEqual(graph.followed_by_following(1, 3), 1)
+
+    def test_deltas(self):
+        """Follows and unfollows since the snapshot are applied on top"""
+
+        graph = self.graph
+        graph.apply(3, 1, True, at=101)
+        graph.apply(1, 2, False, at=102)
+        # following someone already followed is no delta
+        graph.apply(2, 3, True, at=103)
+
+        self.assertTrue(graph.is_following(3, 1))
+        self.assertFalse(graph.is_following(1, 2))
+        self.assertEqual(list(graph.following_ids(1)), [3])
+        self.assertEqual(list(graph.follower_ids(1)), [3])
+        self.assertEqual(graph.followers_count(2), 0)
+        self.assertEqual(sorted(graph.deltas_since(102)), [(1, 2, False, 102)])
+
+    def test_save_load(self):
+        """A saved snapshot maps back to the same graph"""
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "follows.graph")
+            self.graph.save(path)
+            loaded = FollowGraph.load(path)
+
+            self.assertEqual(loaded.built_at, 100)
+            self.assertEqual(list(loaded.following_ids(1)), [2, 3])
+            self.assertEqual(list(loaded.follower_ids(3)), [1, 2, 4])
+            self.assertTrue(loaded.is_following(4, 3))
+
+
+class FollowGraphModelTestCase(TestCase):
+    """Test the models and CLI using the graph."""
+
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        FollowEvent.query.delete()
+
+        u1 = User.signup("testuser", "test@test.com", "HASHED_PASSWORD", None)
+        u2 = User.signup("test2user", "test2@test.com", "HASHED_PASSWORD2", None)
+        u3 = User.signup("test3user", "test3@test.com", "HASHED_PASSWORD3", None)
+        db.session.commit()
+
+        u1.following.append(u2)
+        u2.following.append(u3)
+        db.session.commit()
+
+        ids = u1.id, u2.id, u3.id
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "follows.graph")
+        app.config['FOLLOW_GRAPH_PATH'] = self.path
+
+        result = app.test_cli_runner().invoke(args=['build-follow-graph'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        followgraph.configure(self.path, None, FollowEvent.since)
+
+        self.u1, self.u2, self.u3 = (User.query.get(id) for id in ids)
+
+    def tearDown(self):
+        db.session.rollback()
+        followgraph.configure(None, None)
+        app.config['FOLLOW_GRAPH_PATH'] = None
+        self.directory.cleanup()
+
+    def test_snapshot(self):
+        """The CLI snapshots the follows table"""
+
+        graph = followgraph.current()
+        self.assertIsNotNone(graph)
+        self.assertTrue(self.u1.is_following(self.u2))
+        self.assertTrue(self.u3.is_followed_by(self.u2))
+        self.assertEqual(self.u2.followers_count(), 1)
+        self.assertEqual(self.u2.following_count(), 1)
+        self.assertEqual(self.u1.followed_by_following(self.u3), 1)
+
+    def test_follow_unfollow(self):
+        """Follows and unfollows show up without a new snapshot"""
+
+        self.u1.follow(self.u3.id)
+        self.u1.unfollow(self.u2.id)
+
+        self.assertTrue(self.u1.is_following(self.u3))
+        self.assertFalse(self.u1.is_following(self.u2))
+        self.assertEqual(self.u3.followers_count(), 2)
+        self.assertEqual(self.u2.followers_count(), 0)
+
+    def test_follow_many(self):
+        """Batched follows and unfollows show up too"""
+
+        self.u1.follow_many([self.u3.id])
+        self.u1.follow_many(["test2user"], following=False)
+
+        self.assertTrue(self.u1.is_following(self.u3))
+        self.assertFalse(self.u1.is_following(self.u2))
+        self.assertEqual(self.u3.followers_count(), 2)
+
+    def test_reload(self):
+        """A newer snapshot is picked up, keeping newer deltas"""
+
+        graph = followgraph.current()
+        self.u3.follow(self.u1.id)
+
+        # written before that follow, so it doesn't have it
+        stale = FollowGraph.from_edges([(self.u1.id, self.u2.id)],
+                                       built_at=graph.built_at - 1)
+        stale.save(self.path)
+        os.utime(self.path, (0, 0))
+        followgraph._checked_at = 0
+
+        self.assertIsNot(followgraph.current(), graph)
+        self.assertTrue(self.u3.is_following(self.u1))
+        self.assertFalse(self.u2.is_following(self.u3))
+
+    def test_new_process_catches_up(self):
+        """A process started after a change gets it from the log"""
+
+        followgraph.current()
+        self.u1.follow(self.u3.id)
+        self.u1.follow_many(["test2user"], following=False)
+
+        # as a restarted worker or `run-jobs` would start
+        followgraph.configure(self.path, None, FollowEvent.since)
+
+        self.assertTrue(self.u1.is_following(self.u3))
+        self.assertFalse(self.u1.is_following(self.u2))
+        self.assertEqual(self.u3.followers_count(), 2)
+
+    def test_log_unreadable(self):
+        """A graph that can't catch up isn't used"""
+
+        followgraph.configure(self.path, None, FollowEvent.since)
+        self.u1.follow(self.u3.id)
+
+        followgraph._checked_at = 0
+
+        with patch.object(followgraph, '_read_events', side_effect=OSError), \
+                self.assertLogs('followgraph', 'WARNING'):
+            self.assertIsNone(followgraph.current())
+            self.assertTrue(self.u1.is_following(self.u3))
+
+        self.assertIsNotNone(followgraph.current())
+        self.assertTrue(self.u1.is_following(self.u3))
@@ -0,0 +1,200 @@
+"""Image proxy tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_images.py
+
+
+import io
+import ipaddress
+import os
+import tempfile
+import threading
+import time
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from unittest import TestCase
+from unittest.mock import patch
+
+from PIL import Image
+
+from models import db
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app
+import images
+from images import proxy_url, cached_image, fetch, ImageError
+
+db.create_all()
+
+
+def make_png(width, height):
+    output = io.BytesIO()
+    Image.new('RGB', (width, height), 'blue').save(output, 'PNG')
+    return output.getvalue()
+
+
+class ImageServer(BaseHTTPRequestHandler):
+    """Stand-in for randomuser.me & co: serves one PNG, counts requests."""
+
+    image = make_png(600, 400)
+    requests = 0
+
+    def do_GET(self):
+        ImageServer.requests += 1
+
+        if self.path.startswith('/missing'):
+            self.send_error(404)
+            return
+
+        if self.path.startswith('/drip'):
+            # a byte at a time, each well inside the socket timeout
+            self.send_response(200)
+            self.end_headers()
+            try:
+                for _ in range(30):
+                    self.wfile.write(b"x")
+                    self.wfile.flush()
+                    time.sleep(0.1)
+            except OSError:
+                pass
+            return
+
+        if self.path.startswith('/redirect'):
+            self.send_response(302)
+            self.send_header('Location', self.path.split('?to=', 1)[1])
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.end_headers()
+        self.wfile.write(self.image)
+
+    def log_message(self, *args):
+        pass
+
+
+class ImageProxyTestCase(TestCase):
+    """Test resizing and caching remote images."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(('127.0.0.1', 0), ImageServer)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f"http://127.0.0.1:{cls.server.server_port}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        app.config['IMAGE_CACHE_DIR'] = self.cache_dir.name
+        ImageServer.requests = 0
+
+        # the test server is on loopback, which is otherwise refused
+        self.allowed = patch.object(images, 'ALLOWED_NETWORKS',
+                                    [ipaddress.ip_network('127.0.0.0/8')])
+        self.allowed.start()
+
+    def tearDown(self):
+        self.allowed.stop()
+        self.cache_dir.cleanup()
+
+    def test_proxy_url(self):
+        """Remote URLs are proxied; local ones are left alone"""
+
+        self.assertEqual(proxy_url("/static/images/default-pic.png", "thumb", "k"),
+                         "/static/images/default-pic.png")
+        self.assertTrue(proxy_url("https://example.com/a.jpg", "thumb", "k")
+                        .startswith("/images/thumb/"))
+
+    def test_resize_and_cache(self):
+        """Images are fetched once, then every size is served from disk"""
+
+        url = f"{self.base_url}/a.png"
+
+        with app.test_client() as client:
+            resp = client.get(proxy_url(url, 'thumb', app.config['SECRET_KEY']))
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, 'image/jpeg')
+            self.assertEqual(Image.open(io.BytesIO(resp.data)).size, (96, 96))
+            self.assertEqual(resp.cache_control.max_age, 31536000)
+            self.assertFalse(resp.cache_control.no_store)
+            resp.close()
+
+            resp = client.get(proxy_url(url, 'card-hero', app.config['SECRET_KEY']))
+            self.assertEqual(Image.open(io.BytesIO(resp.data)).size, (800, 288))
+            resp.close()
+
+        self.assertEqual(ImageServer.requests, 1)
+
+    def test_same_content_shared(self):
+        """Two URLs with the same bytes share one cache entry"""
+
+        first = cached_image(f"{self.base_url}/a.png", 'thumb', self.cache_dir.name)
+        second = cached_image(f"{self.base_url}/b.png", 'thumb', self.cache_dir.name)
+
+        self.assertEqual(first, second)
+
+    def test_bad_token_and_fallback(self):
+        """Unsigned URLs 404; unfetchable images redirect to the original"""
+
+        with app.test_client() as client:
+            resp = client.get("/images/thumb/not-a-token")
+            self.assertEqual(resp.status_code, 404)
+
+            url = f"{self.base_url}/missing.png"
+            resp = client.get(proxy_url(url, 'thumb', app.config['SECRET_KEY']))
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(resp.location, url)
+
+    def test_private_addresses_refused(self):
+        """Loopback, private and link-local addresses aren't fetched"""
+
+        for address in ("127.0.0.1", "10.1.2.3", "169.254.169.254", "::1",
+                        "::ffff:192.168.0.1"):
+            with patch.object(images, 'ALLOWED_NETWORKS', []):
+                self.assertFalse(images.address_allowed(address), address)
+        self.assertTrue(images.address_allowed("93.184.216.34"))
+
+        with patch.object(images, 'ALLOWED_NETWORKS', []):
+            with self.assertRaises(ImageError):
+                fetch(f"{self.base_url}/a.png")
+        self.assertEqual(ImageServer.requests, 0)
+
+    def test_redirects_checked(self):
+        """Redirects are followed only to http(s) URLs we'd fetch anyway"""
+
+        target = f"{self.base_url}/a.png"
+        self.assertEqual(fetch(f"{self.base_url}/redirect?to={target}"),
+                         ImageServer.image)
+
+        with self.assertRaises(ImageError):
+            fetch(f"{self.base_url}/redirect?to=file:///etc/passwd")
+
+        # allowed for the first hop only: the redirect's target is refused
+        ImageServer.requests = 0
+        with patch.object(images, 'address_allowed', side_effect=[True, False]):
+            with self.assertRaisesRegex(ImageError, "Refusing"):
+                fetch(f"{self.base_url}/redirect?to={target}")
+        self.assertEqual(ImageServer.requests, 1)
+
+    def test_fetch_deadline(self):
+        """A server sending slowly enough never to time out still gets cut off"""
+
+        started = time.monotonic()
+        with patch.object(images, 'FETCH_DEADLINE', 0.5):
+            with self.assertRaisesRegex(ImageError, "took over"):
+                fetch(f"{self.base_url}/drip")
+
+        self.assertLess(time.monotonic() - started, 2)
@@ -0,0 +1,219 @@
+"""Job queue tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_jobs.py
+
+
+import os
+import threading
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from models import db, User, Message, Follows, Job
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app
+import jobs
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.create_all()
+
+calls = []
+
+
+@jobs.job('test_record', concurrency=1, max_attempts=2)
+def record(value):
+    calls.append(value)
+    if value == "fail":
+        raise ValueError("failed on purpose")
+
+
+class JobQueueTestCase(TestCase):
+    """Test queueing, claiming and running jobs."""
+
+    def setUp(self):
+        Job.query.delete()
+        db.session.commit()
+        calls.clear()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_run(self):
+        """Queued jobs run once, in order"""
+
+        self.assertTrue(jobs.enqueue('test_record', {'value': 1}))
+        self.assertTrue(jobs.enqueue('test_record', {'value': 2}))
+        db.session.commit()
+
+        self.assertEqual(jobs.work(once=True), 2)
+        self.assertEqual(calls, [1, 2])
+        self.assertEqual(jobs.stats()[('test_record', 'done')], 2)
+        self.assertEqual(jobs.work(once=True), 0)
+
+    def test_idempotency_key(self):
+        """A job with a key that was already used isn't queued again"""
+
+        self.assertTrue(jobs.enqueue('test_record', {'value': 1}, key="k"))
+        self.assertFalse(jobs.enqueue('test_record', {'value': 2}, key="k"))
+        db.session.commit()
+
+        jobs.work(once=True)
+        self.assertEqual(calls, [1])
+
+    def test_retry_then_fail(self):
+        """Failing jobs are retried after a delay, then marked failed"""
+
+        jobs.enqueue('test_record', {'value': "fail"})
+        db.session.commit()
+
+        job = jobs.run_one()
+        self.assertEqual((job.status, job.attempts), ('queued', 1))
+        self.assertIn("failed on purpose", job.last_error)
+        self.assertGreater(job.run_after, datetime.utcnow())
+
+        # not runnable until its retry time
+        self.assertIsNone(jobs.run_one())
+
+        job = jobs.run_one(now=datetime.utcnow() + timedelta(minutes=1))
+        self.assertEqual((job.status, job.attempts), ('failed', 2))
+        self.assertEqual(calls, ["fail", "fail"])
+
+    def test_concurrency_limit(self):
+        """No more jobs of a kind run at once than its concurrency"""
+
+        jobs.enqueue('test_record', {'value': 1})
+        jobs.enqueue('test_record', {'value': 2})
+        db.session.commit()
+
+        self.assertIsNotNone(jobs.claim())
+        self.assertIsNone(jobs.claim())
+
+    def test_concurrency_limit_across_workers(self):
+        """A worker that counted before another's claim committed waits for
+        it, then sees the kind is full"""
+
+        jobs.enqueue('test_record', {'value': 1})
+        jobs.enqueue('test_record', {'value': 2})
+        db.session.commit()
+        first_id = min(id for (id,) in db.session.query(Job.id))
+
+        with Session(db.engine) as other_worker:
+            # the other worker is part way through claiming the first job
+            other_worker.execute(db.select(db.func.pg_advisory_xact_lock(
+                db.func.hashtext("jobs:test_record"))))
+            (other_worker.query(Job)
+             .filter(Job.id == first_id)
+             .update({Job.status: 'running'}))
+
+            claimed = []
+            thread = threading.Thread(
+                target=lambda: claimed.append(
+                    jobs.claim(Session(db.engine))))
+            thread.start()
+            thread.join(0.5)
+            # blocked on the kind's lock
+            self.assertTrue(thread.is_alive())
+
+            other_worker.commit()
+            thread.join(5)
+
+        self.assertEqual(claimed, [None])
+
+    def test_skip_locked(self):
+        """A job locked by another worker is skipped, not waited for"""
+
+        jobs.enqueue('test_record', {'value': 1})
+        jobs.enqueue('test_record', {'value': 2})
+        db.session.commit()
+        first_id = min(id for (id,) in db.session.query(Job.id))
+
+        with Session(db.engine) as other_worker:
+            (other_worker.query(Job)
+             .filter(Job.id == first_id)
+             .with_for_update()
+             .one())
+
+            job = jobs.claim()
+            self.assertEqual(job.payload, {'value': 2})
+            other_worker.rollback()
+
+    def test_requeue_stale(self):
+        """Jobs whose worker died go back on the queue"""
+
+        jobs.enqueue('test_record', {'value': 1})
+        db.session.commit()
+        jobs.claim()
+
+        later = datetime.utcnow() + jobs.STALE_AFTER + timedelta(seconds=1)
+        self.assertEqual(jobs.requeue_stale(now=later), 1)
+        self.assertEqual(jobs.run_one(now=later).status, 'done')
+
+    def test_sqlite(self):
+        """Without row locks, jobs are claimed with a conditional update"""
+
+        engine = create_engine("sqlite://")
+        Job.__table__.create(engine)
+
+        with Session(engine) as session:
+            jobs.enqueue('test_record', {'value': 1}, key="k", session=session)
+            jobs.enqueue('test_record', {'value': 1}, key="k", session=session)
+            session.commit()
+
+            self.assertEqual(jobs.work(once=True, session=session), 1)
+            self.assertEqual(calls, [1])
+
+
+class DeferredWorkTestCase(TestCase):
+    """Test the app's jobs."""
+
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        Job.query.delete()
+
+        u1 = User.signup("testuser", "test@test.com", "HASHED_PASSWORD", None)
+        u2 = User.signup("test2user", "test2@test.com", "HASHED_PASSWORD2", None)
+        db.session.commit()
+
+        u2.following.append(u1)
+        db.session.add(Message(text="soon gone", user_id=u1.id))
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_delete_user(self):
+        """Deleting an account hides it at once and removes it in a job"""
+
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session["curr_user"] = self.u1_id
+
+            client.post("/users/delete")
+
+        self.assertIsNone(User.query.filter_by(username="testuser").first())
+        self.assertEqual(Follows.query.count(), 0)
+        self.assertEqual(Message.query.count(), 1)
+
+        self.assertEqual(jobs.work(once=True), 1)
+
+        self.assertIsNone(User.query.get(self.u1_id))
+        self.assertEqual(Message.query.count(), 0)
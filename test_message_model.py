@@ -67,16 +67,28 @@ class MessageModelTestCase(TestCase):
     def test_message_tied_to_user(self):
         """Test that message is associated with correct user"""
 
-        self.assertEqual(len(self.u1.messages), 2)
-        self.assertEqual(len(self.u2.messages), 0)
+        self.assertEqual(self.u1.messages.count(), 2)
+        self.assertEqual(self.u2.messages.count(), 0)
         self.assertEqual(self.m1.user, self.u1)
 
 
     def test_message_removed_on_user_delete(self):
         """Test that a users messages are also deleted when a user is deleted"""
 
+        m1_id = self.m1.id
+
         db.session.delete(self.u1)
         db.session.commit()
 
-        self.assertEqual(Message.query.get(self.m1.id), None)
+        self.assertEqual(Message.query.get(m1_id), None)
+
+
+    def test_bulk_create(self):
+        """Test bulk_create adds valid messages and reports the rest"""
+
+        ids, errors = Message.bulk_create(self.u2.id, ["one", None, "two"])
+        db.session.commit()
 
+        self.assertEqual(len(ids), 2)
+        self.assertEqual(errors, [{"index": 1, "error": "Text is required."}])
+        self.assertEqual(Message.query.filter_by(user_id=self.u2.id).count(), 2)
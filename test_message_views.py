@@ -6,7 +6,12 @@
 
 
 import os
+import re
+from datetime import datetime, timedelta
 from unittest import TestCase
+from unittest.mock import patch
+
+from sqlalchemy import event
 
 from models import db, connect_db, Message, User, Follows, Like
 
@@ -19,7 +24,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY, g
+from app import app, CURR_USER_KEY, g, make_api_token
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -171,7 +176,268 @@ class MessageViewTestCase(TestCase):
         self.assertEqual(len(Like.query.all()),0)
         self.assertEqual(resp.status_code, 200)
 
+    def add_likes(self, user_id, message_ids):
+        """Have `user_id` like `message_ids`, a minute apart, in that order."""
+
+        start = datetime(2022, 1, 1)
+        db.session.add_all([Like(user_id=user_id, message_id=message_id,
+                                 created_at=start + timedelta(minutes=index))
+                            for index, message_id in enumerate(message_ids)])
+        db.session.commit()
+
+    def test_liked_messages_page(self):
+        """Test a user's likes page shows their likes, latest like first"""
+
+        self.add_likes(self.u2_id, [self.m3_id, self.m1_id])
+
+        with app.test_client() as client:
+            resp = client.get(f"/users/{self.u2_id}/likes",
+                              follow_redirects=True)
+            self.assertIn("Access unauthorized",
+                          resp.get_data(as_text=True))
+
+            with client.session_transaction() as change_session:
+                change_session["curr_user"] = self.u1_id
+
+            resp = client.get(f"/users/{self.u2_id}/likes")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("@test2user", html)
+            self.assertNotIn("test message 2", html)
+            self.assertLess(html.index("test message 1"),
+                            html.index("test message 3"))
+            # u1 hasn't liked either
+            self.assertNotIn("bi-heart-fill", html)
+            self.assertNotIn("Older likes", html)
+
+    def test_liked_messages_pages(self):
+        """Test the likes page is paginated with a cursor"""
+
+        self.add_likes(self.u2_id, [self.m1_id, self.m2_id, self.m3_id])
+
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session["curr_user"] = self.u2_id
+
+            with patch('app.LIKES_PAGE_SIZE', 2):
+                html = client.get(f"/users/{self.u2_id}/likes").get_data(as_text=True)
+                self.assertIn("test message 3", html)
+                self.assertIn("test message 2", html)
+                self.assertNotIn("test message 1", html)
+                self.assertEqual(html.count("bi-heart-fill"), 2)
+
+                older = re.search(r'href="([^"]*)"\s+class="[^"]*">Older likes',
+                                  html).group(1)
+                html = client.get(older.replace("&amp;", "&")).get_data(as_text=True)
+                self.assertIn("test message 1", html)
+                self.assertNotIn("test message 2", html)
+                self.assertNotIn("Older likes", html)
+
+    def test_liked_messages_query_count(self):
+        """Test the likes page's query count doesn't grow with its likes"""
+
+        self.add_likes(self.u2_id, [self.m1_id])
+
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session["curr_user"] = self.u4_id
+
+            url = f"/users/{self.u2_id}/likes"
+            one_like = self.count_queries(client, url)
+
+            Like.query.delete()
+            self.add_likes(self.u2_id, [self.m1_id, self.m2_id, self.m3_id])
+            self.add_likes(self.u4_id, [self.m3_id])
+
+            self.assertEqual(self.count_queries(client, url), one_like)
+
+
+
+
+    def test_bulk_messages(self):
+        """Test adding a batch of messages through the API"""
+
+        u1 = User.query.get(self.u1_id)
+        token = make_api_token(u1)
+
+        with app.test_client() as client:
+            resp = client.post('/api/messages/bulk',
+                               headers={"Authorization": f"Bearer {token}"},
+                               json={"messages": ["bulk 1",
+                                                  {"text": "bulk 2"},
+                                                  "x" * 141,
+                                                  ""]})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json["added"], 2)
+            self.assertEqual([e["index"] for e in resp.json["errors"]], [2, 3])
+            self.assertEqual(Message.query.filter(
+                Message.text.like("bulk %")).count(), 2)
+
+    def test_bulk_messages_bad_token(self):
+        """Test the bulk API rejects missing or revoked tokens"""
+
+        u1 = User.query.get(self.u1_id)
+        token = make_api_token(u1)
+        u1.password = "changed"
+        db.session.commit()
+
+        with app.test_client() as client:
+            resp = client.post('/api/messages/bulk',
+                               json={"messages": ["bulk 1"]})
+            self.assertEqual(resp.status_code, 401)
+
+            resp = client.post('/api/messages/bulk',
+                               headers={"Authorization": f"Bearer {token}"},
+                               json={"messages": ["bulk 1"]})
+            self.assertEqual(resp.status_code, 401)
+
+    def test_timeline_since(self):
+        """Test the timeline API only returns messages past the cursor"""
+
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session["curr_user"] = self.u2_id
+
+            resp = client.get("/api/timeline")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual([m["id"] for m in resp.json["messages"]],
+                             [self.m3_id])
+            since_id = resp.json["since_id"]
+
+            resp = client.get(f"/api/timeline?since_id={since_id}")
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.data, b"")
+
+            m4 = Message(text="test message 4", user_id=self.u4_id)
+            db.session.add(m4)
+            db.session.commit()
+            m4_id = m4.id
+
+            resp = client.get(f"/api/timeline?since_id={since_id}")
+            self.assertEqual([(m["id"], m["username"])
+                              for m in resp.json["messages"]],
+                             [(m4_id, "test4user")])
+            self.assertEqual(resp.json["since_id"], m4_id)
+            self.assertFalse(resp.json["more"])
+
+    def test_user_messages_limit(self):
+        """Test a delta response holds at most 'limit' messages"""
+
+        with app.test_client() as client:
+            url = f"/api/users/{self.u1_id}/messages"
+
+            resp = client.get(url, query_string={"since_id": 0, "limit": 1})
+            self.assertEqual([m["id"] for m in resp.json["messages"]],
+                             [self.m2_id])
+            self.assertTrue(resp.json["more"])
+
+            resp = client.get(url, query_string={"since_id": 0, "limit": 1000})
+            self.assertEqual([m["id"] for m in resp.json["messages"]],
+                             [self.m2_id, self.m1_id])
+            self.assertFalse(resp.json["more"])
+
+            resp = client.get(url, query_string={"limit": 0})
+            self.assertEqual(resp.status_code, 400)
+
+    def test_timeline_since_needs_user(self):
+        """Test the timeline API needs a session or token"""
+
+        u2 = User.query.get(self.u2_id)
+
+        with app.test_client() as client:
+            resp = client.get("/api/timeline")
+            self.assertEqual(resp.status_code, 401)
+
+            resp = client.get("/api/timeline",
+                              headers={"Authorization":
+                                       f"Bearer {make_api_token(u2)}"})
+            self.assertEqual(resp.status_code, 200)
+
+    def test_user_messages_since_timestamp(self):
+        """Test a profile's messages since a timestamp"""
+
+        m1 = Message.query.get(self.m1_id)
+
+        with app.test_client() as client:
+            resp = client.get(f"/api/users/{self.u1_id}/messages"
+                              f"?since_timestamp={m1.timestamp.isoformat()}")
+            self.assertEqual([m["id"] for m in resp.json["messages"]],
+                             [self.m2_id])
+
+            resp = client.get(f"/api/users/{self.u1_id}/messages"
+                              f"?since_timestamp={resp.json['since_timestamp']}")
+            self.assertEqual(resp.status_code, 304)
+
+            resp = client.get(f"/api/users/{self.u1_id}/messages"
+                              "?since_timestamp=yesterday")
+            self.assertEqual(resp.status_code, 400)
+
+            # "Z" and offsets mean the same instant in UTC
+            for since in (m1.timestamp.isoformat() + "Z",
+                          (m1.timestamp + timedelta(hours=2)).isoformat()
+                          + "+02:00"):
+                resp = client.get(f"/api/users/{self.u1_id}/messages",
+                                  query_string={"since_timestamp": since})
+                self.assertEqual([m["id"] for m in resp.json["messages"]],
+                                 [self.m2_id])
+
+    def count_queries(self, client, url):
+        """Return how many SQL statements a GET of `url` runs."""
+
+        statements = []
+
+        def count(*args):
+            statements.append(args[2])
+
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            resp = client.get(url)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+
+        self.assertEqual(resp.status_code, 200)
+        return len(statements)
+
+    def test_timeline_query_count(self):
+        """Test a timeline's query count doesn't grow with its authors"""
+
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session["curr_user"] = self.u2_id
+
+            one_author = self.count_queries(client, "/")
+
+            db.session.add_all([Message(text="from 3", user_id=self.u3_id),
+                                Message(text="from 4", user_id=self.u4_id)])
+            Like.query.delete()
+            db.session.add(Like(user_id=self.u2_id, message_id=self.m3_id))
+            db.session.commit()
+
+            three_authors = self.count_queries(client, "/")
+            self.assertEqual(three_authors, one_author)
+
+            resp = client.get("/")
+            html = resp.get_data(as_text=True)
+            self.assertIn("@test3user", html)
+            self.assertIn("@test4user", html)
+            self.assertEqual(html.count("bi-heart-fill"), 1)
+
+    def test_ingest_messages_cli(self):
+        """Test adding messages from a file on the command line"""
+
+        runner = app.test_cli_runner()
+        with runner.isolated_filesystem():
+            with open("messages.txt", "w") as file:
+                file.write("line one\n" + "x" * 141 + "\nline three\n")
+
+            result = runner.invoke(args=['ingest-messages', 'testuser',
+                                         'messages.txt', '--batch-size', '2'])
 
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Added 2 messages.", result.output)
+        self.assertIn("line 2:", result.output)
 
 
     ################## Test the Get requests ############################
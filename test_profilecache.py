@@ -0,0 +1,206 @@
+"""Shared profile cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_profilecache.py
+
+
+import multiprocessing
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app
+import profilecache
+from profilecache import ProfileCache, WAYS
+from readmodels import profile_summary
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.create_all()
+
+
+def write_values(path, rounds):
+    """In another process: keep rewriting user 1's entry."""
+
+    cache = ProfileCache(path, slots=WAYS)
+    for round in range(rounds):
+        value = ["a" * 300, round] if round % 2 else ["b" * 700, round]
+        cache.put(1, value, cache.version(1))
+
+
+class ProfileCacheTestCase(TestCase):
+    """Test the cache on its own."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "profiles")
+        self.cache = ProfileCache(self.path, slots=WAYS, ttl=60)
+
+    def tearDown(self):
+        self.cache.close()
+        self.directory.cleanup()
+
+    def test_put_get(self):
+        """Stored values are read back, by this and other workers"""
+
+        self.assertIsNone(self.cache.get(1))
+        self.assertTrue(self.cache.put(1, ["one", 1], self.cache.version(1)))
+        self.assertEqual(self.cache.get(1), ["one", 1])
+
+        other = ProfileCache(self.path, slots=WAYS)
+        self.assertEqual(other.get(1), ["one", 1])
+        other.close()
+
+    def test_invalidate(self):
+        """Invalidating drops the entry and refuses older values"""
+
+        version = self.cache.version(1)
+        self.cache.put(1, ["old"], version)
+        self.cache.invalidate(1)
+
+        self.assertIsNone(self.cache.get(1))
+        # read from the database before the change: not stored
+        self.assertFalse(self.cache.put(1, ["old"], version))
+        self.assertTrue(self.cache.put(1, ["new"], self.cache.version(1)))
+        self.assertEqual(self.cache.get(1), ["new"])
+
+    def test_ttl(self):
+        """Entries expire"""
+
+        self.cache.ttl = 0.05
+        self.cache.put(1, ["one"], self.cache.version(1))
+        time.sleep(0.1)
+        self.assertIsNone(self.cache.get(1))
+
+    def test_eviction(self):
+        """A full bucket evicts its oldest entry; the size never changes"""
+
+        size = os.path.getsize(self.path)
+        for user_id in range(1, WAYS + 2):
+            self.cache.put(user_id, [user_id], self.cache.version(user_id))
+
+        self.assertIsNone(self.cache.get(1))
+        self.assertEqual(self.cache.get(WAYS + 1), [WAYS + 1])
+        self.assertEqual(os.path.getsize(self.path), size)
+
+        # too big for a slot
+        self.assertFalse(self.cache.put(2, ["x" * 2000], self.cache.version(2)))
+
+    def test_other_settings(self):
+        """A file laid out differently is replaced, not resized"""
+
+        self.cache.put(1, ["one"], self.cache.version(1))
+        bigger = ProfileCache(self.path, slots=WAYS * 2)
+
+        self.assertIsNone(bigger.get(1))
+        # the old mapping is still readable
+        self.assertEqual(self.cache.get(1), ["one"])
+        bigger.close()
+
+    def test_no_torn_reads(self):
+        """Reads while another process writes see whole values"""
+
+        writer = multiprocessing.get_context('fork').Process(
+            target=write_values, args=(self.path, 3000))
+        writer.start()
+
+        seen = 0
+        while writer.is_alive():
+            value = self.cache.get(1)
+            if value is not None:
+                seen += 1
+                text, round = value
+                self.assertEqual(text, ("a" * 300) if round % 2 else ("b" * 700))
+        writer.join()
+
+        self.assertEqual(writer.exitcode, 0)
+        self.assertGreater(seen, 0)
+
+
+class ProfileSummaryTestCase(TestCase):
+    """Test the app's profile summaries through the cache."""
+
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        u1 = User.signup("testuser", "test@test.com", "HASHED_PASSWORD", None)
+        u2 = User.signup("test2user", "test2@test.com", "HASHED_PASSWORD2", None)
+        db.session.commit()
+        db.session.add(Message(text="hello", user_id=u1.id))
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+        self.directory = tempfile.TemporaryDirectory()
+        profilecache.configure(os.path.join(self.directory.name, "profiles"),
+                               slots=64)
+
+    def tearDown(self):
+        db.session.rollback()
+        profilecache.configure(None)
+        self.directory.cleanup()
+
+    def test_cached(self):
+        """A summary is stored once, then served from the cache"""
+
+        summary = profile_summary(self.u1_id)
+        self.assertEqual((summary.username, summary.messages_count),
+                         ("testuser", 1))
+        self.assertIsNotNone(profilecache.current().get(self.u1_id))
+        self.assertIsNone(profile_summary(self.u1_id + 1000))
+
+        # changed behind the cache's back: still the cached copy
+        User.query.filter_by(id=self.u1_id).update({'bio': "changed"})
+        db.session.commit()
+        self.assertIsNone(profile_summary(self.u1_id).bio)
+
+    def test_invalidated_by_changes(self):
+        """Following and editing a profile show up at once"""
+
+        self.assertEqual(profile_summary(self.u2_id).followers_count, 0)
+
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session["curr_user"] = self.u1_id
+
+            client.post(f"/users/follow/{self.u2_id}")
+            self.assertEqual(profile_summary(self.u2_id).followers_count, 1)
+            self.assertEqual(profile_summary(self.u1_id).following_count, 1)
+
+            client.post("/users/profile", data={"username": "renamed",
+                                                "email": "test@test.com",
+                                                "password": "HASHED_PASSWORD"})
+            html = client.get(f"/users/{self.u1_id}").get_data(as_text=True)
+            self.assertIn("@renamed", html)
+
+    def test_invalidated_by_deleted_follows(self):
+        """Deleting an account updates the counts of the people it followed"""
+
+        db.session.add(Follows(user_following_id=self.u1_id,
+                               user_being_followed_id=self.u2_id))
+        db.session.commit()
+        self.assertEqual(profile_summary(self.u2_id).followers_count, 1)
+
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session["curr_user"] = self.u1_id
+
+            client.post("/users/delete")
+
+        self.assertEqual(profile_summary(self.u2_id).followers_count, 0)
@@ -0,0 +1,78 @@
+"""Sampling profiler tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_profiler.py
+
+
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+from models import db
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app
+import profiler
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.create_all()
+
+
+def spin(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+class ProfilerTestCase(TestCase):
+    """Test sampling, writing and pruning profiles."""
+
+    def setUp(self):
+        self.profile_dir = tempfile.TemporaryDirectory()
+        app.config['PROFILE_DIR'] = self.profile_dir.name
+
+    def tearDown(self):
+        self.profile_dir.cleanup()
+
+    def profiles(self):
+        return [os.path.join(dirpath, name)
+                for dirpath, _, names in os.walk(self.profile_dir.name)
+                for name in names]
+
+    def test_sampler(self):
+        """Samples show where the thread spent its time"""
+
+        sampler = profiler.Sampler(0.001)
+        sampler.start()
+        spin(0.05)
+        stacks = sampler.stop()
+
+        self.assertTrue(stacks)
+        self.assertTrue(any("spin (test_profiler.py" in stack
+                            for stack in stacks))
+
+    def test_signed_header(self):
+        """Requests with a valid token are profiled; others aren't"""
+
+        token = profiler.make_token(app.config['SECRET_KEY'])
+
+        with app.test_client() as client:
+            client.get('/login', headers={profiler.PROFILE_HEADER: "forged"})
+            self.assertEqual(self.profiles(), [])
+
+            client.get('/login', headers={profiler.PROFILE_HEADER: token})
+
+        [path] = self.profiles()
+        self.assertEqual(os.path.basename(os.path.dirname(path)), "login")
+        self.assertTrue(path.endswith(".folded"))
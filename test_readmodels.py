@@ -0,0 +1,96 @@
+"""Read model tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_readmodels.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Like
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app
+from readmodels import message_rows, user_cards, MessageRow
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.create_all()
+
+
+class ReadModelsTestCase(TestCase):
+    """Test building list rows from column queries."""
+
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        u1 = User.signup("testuser", "test@test.com", "HASHED_PASSWORD", None)
+        u2 = User.signup("test2user", "test2@test.com", "HASHED_PASSWORD2", None)
+        u2.bio = "second"
+        db.session.commit()
+
+        db.session.add_all([Message(text="one", user_id=u1.id),
+                            Message(text="two", user_id=u1.id),
+                            Message(text="three", user_id=u2.id)])
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        db.session.expunge_all()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_message_rows(self):
+        """Messages come back with their authors, shared, and untracked"""
+
+        rows = message_rows(Message.query.order_by(Message.id))
+
+        self.assertEqual([row.text for row in rows], ["one", "two", "three"])
+        self.assertIsInstance(rows[0], MessageRow)
+        self.assertEqual(rows[0].user.username, "testuser")
+        self.assertIs(rows[0].user, rows[1].user)
+        self.assertEqual(rows[2].user.id, self.u2_id)
+        self.assertEqual(len(db.session.identity_map), 0)
+
+        with self.assertRaises(AttributeError):
+            rows[0].bio = "no such column"
+
+    def test_message_rows_columns_and_limit(self):
+        """Extra columns come back alongside each row"""
+
+        liked = (Message.query.filter(Message.user_id == self.u1_id)
+                 .order_by(Message.id).first())
+        db.session.add(Like(user_id=self.u2_id, message_id=liked.id))
+        db.session.commit()
+
+        rows = message_rows(Message.query
+                            .join(Like, Like.message_id == Message.id)
+                            .order_by(Message.id),
+                            Like.user_id, limit=1)
+
+        self.assertEqual(len(rows), 1)
+        row, user_id = rows[0]
+        self.assertEqual((row.text, user_id), ("one", self.u2_id))
+
+    def test_user_cards(self):
+        """Users come back as cards with just what a card shows"""
+
+        cards = list(user_cards(User.query.order_by(User.id)))
+
+        self.assertEqual([card.username for card in cards],
+                         ["testuser", "test2user"])
+        self.assertEqual(cards[1].bio, "second")
+        self.assertFalse(hasattr(cards[0], 'password'))
+        self.assertEqual(len(db.session.identity_map), 0)
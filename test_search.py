@@ -0,0 +1,174 @@
+"""Message search tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_search.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Hashtag, Mention, Job
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, make_api_token
+from search import MemorySearch, PostgresSearch, index_tags
+import jobs
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class SearchTestCase(TestCase):
+    """Test searching messages."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        Job.query.delete()
+
+        u1 = User.signup("testuser", "test@test.com", "HASHED_PASSWORD","/static/images/default-pic.png")
+        u2 = User.signup("test2user", "test2@test.com", "HASHED_PASSWORD2","/static/images/default-pic.png")
+        db.session.commit()
+
+        m1 = Message(text="birds birds birds", user_id=u1.id)
+        m2 = Message(text="I like birds #spring @test2user", user_id=u1.id)
+        m3 = Message(text="nothing to see here #Spring", user_id=u2.id)
+        db.session.add_all([m1, m2, m3])
+        db.session.flush()
+        for msg in (m1, m2, m3):
+            index_tags(msg)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.m1_id = m1.id
+        self.m2_id = m2.id
+        self.m3_id = m3.id
+
+    def tearDown(self):
+
+        db.session.rollback()
+
+    def check_backend(self, backend):
+        messages, has_next = backend.search("birds")
+        self.assertEqual([m.id for m in messages], [self.m1_id, self.m2_id])
+        self.assertFalse(has_next)
+
+        messages, _ = backend.search("birds", order="recent")
+        self.assertEqual([m.id for m in messages], [self.m2_id, self.m1_id])
+
+        messages, has_next = backend.search("birds", order="recent", per_page=1)
+        self.assertEqual([m.id for m in messages], [self.m2_id])
+        self.assertTrue(has_next)
+
+        messages, _ = backend.search("#spring")
+        self.assertEqual([m.id for m in messages], [self.m3_id, self.m2_id])
+
+        messages, _ = backend.search("@test2user")
+        self.assertEqual([m.id for m in messages], [self.m2_id])
+
+        self.assertEqual(backend.search("penguins"), ([], False))
+
+    def test_postgres_search(self):
+        """Full-text search through the tsvector column"""
+
+        self.check_backend(PostgresSearch())
+
+    def test_memory_search(self):
+        """The in-process index answers the same queries"""
+
+        backend = MemorySearch()
+        for msg in Message.query.all():
+            backend.add(msg)
+
+        self.check_backend(backend)
+
+        backend.remove(self.m1_id)
+        messages, _ = backend.search("birds")
+        self.assertEqual([m.id for m in messages], [self.m2_id])
+
+    def test_memory_search_add_ids(self):
+        """The in-process index can load messages inserted in bulk"""
+
+        backend = MemorySearch()
+        backend.add_ids([self.m1_id, self.m2_id, self.m3_id])
+
+        self.check_backend(backend)
+
+    def test_tags_recorded_on_post(self):
+        """Posting a message queues recording its hashtags and mentions"""
+
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session["curr_user"] = self.u1_id
+
+            client.post('/messages/new',
+                        data={"text": "#Warbles are fun, right @testuser?"})
+
+        jobs.work(once=True)
+
+        msg = Message.query.filter(Message.text.like("#Warbles%")).one()
+        self.assertEqual([h.tag for h in Hashtag.query.filter_by(message_id=msg.id)],
+                         ["warbles"])
+        self.assertEqual([m.user_id for m in Mention.query.filter_by(message_id=msg.id)],
+                         [self.u1_id])
+
+    def test_tags_recorded_on_bulk_add(self):
+        """Messages added in bulk get their hashtags and mentions too"""
+
+        with app.test_client() as client:
+            client.post('/api/messages/bulk',
+                        headers={"Authorization":
+                                 f"Bearer {make_api_token(User.query.get(self.u1_id))}"},
+                        json={"messages": ["bulk #Birds", "hi @test2user",
+                                           ""]})
+
+        jobs.work(once=True)
+
+        messages, _ = PostgresSearch().search("#birds")
+        self.assertEqual([m.text for m in messages], ["bulk #Birds"])
+        messages, _ = PostgresSearch().search("@test2user")
+        self.assertIn("hi @test2user", [m.text for m in messages])
+
+    def test_reindex_messages(self):
+        """The backfill command records tags again, and can be rerun"""
+
+        Hashtag.query.delete()
+        db.session.commit()
+
+        runner = app.test_cli_runner()
+        for _ in range(2):
+            result = runner.invoke(args=["reindex-messages", "--batch-size", "2"])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn("Indexed 3 messages.", result.output)
+
+        messages, _ = PostgresSearch().search("#spring")
+        self.assertEqual([m.id for m in messages], [self.m3_id, self.m2_id])
+        self.assertEqual(Mention.query.count(), 1)
+
+    def test_search_page(self):
+        """The search page lists matches"""
+
+        with app.test_client() as client:
+            resp = client.get('/messages/search?q=birds&sort=recent')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("I like birds", html)
+            self.assertNotIn("nothing to see here", html)
@@ -0,0 +1,150 @@
+"""Slow query log tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_slow_queries.py
+
+
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app, slow_query_log
+from slow_queries import normalize, summarize, can_analyze, short_params
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.create_all()
+
+
+class SlowQueryTestCase(TestCase):
+    """Test logging, explaining and summarizing slow statements."""
+
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        u1 = User.signup("testuser", "test@test.com", "HASHED_PASSWORD", None)
+        db.session.commit()
+        self.u1_id = u1.id
+
+        self.log = tempfile.NamedTemporaryFile(delete=False)
+        self.log.close()
+
+        self.old_settings = (slow_query_log.threshold_ms, slow_query_log.path)
+        # log everything
+        slow_query_log.threshold_ms = 0
+        slow_query_log.path = self.log.name
+        slow_query_log.explained.clear()
+
+    def tearDown(self):
+        slow_query_log.wait()
+        slow_query_log.threshold_ms, slow_query_log.path = self.old_settings
+        os.unlink(self.log.name)
+        db.session.rollback()
+
+    def records(self):
+        slow_query_log.wait()
+        with open(self.log.name) as file:
+            return [json.loads(line) for line in file]
+
+    def test_normalize(self):
+        """Literals, parameters and IN-lists are normalized away"""
+
+        self.assertEqual(
+            normalize("SELECT * FROM users\n WHERE id IN (%(id_1_1)s, "
+                      "%(id_1_2)s) AND name = 'bob' LIMIT 10"),
+            "SELECT * FROM users WHERE id IN (...) AND name = ? LIMIT ?")
+
+    def test_request_queries_logged(self):
+        """Statements are logged with their params, endpoint and a plan"""
+
+        with app.test_client() as client:
+            client.get(f'/users/{self.u1_id}')
+            client.get(f'/users/{self.u1_id}')
+
+        records = [record for record in self.records()
+                   if record['source'] == 'users_show']
+        self.assertTrue(records)
+
+        user_lookups = [record for record in records
+                        if record['normalized'].startswith("SELECT users.id")]
+        self.assertEqual(len(user_lookups), 2)
+        self.assertIn(self.u1_id, user_lookups[0]['params'].values())
+
+        # the plan is captured once per statement, with ANALYZE for reads
+        plans = [record['plan'] for record in user_lookups if record['plan']]
+        self.assertEqual(len(plans), 1)
+        self.assertIn("actual time", plans[0])
+
+    def test_write_not_analyzed(self):
+        """Writes get a plain EXPLAIN, so they aren't run twice"""
+
+        db.session.add(Message(text="explain me", user_id=self.u1_id))
+        db.session.commit()
+
+        [insert] = [record for record in self.records()
+                    if record['normalized'].startswith("INSERT INTO messages")]
+        self.assertIn("Insert on messages", insert['plan'])
+        self.assertNotIn("actual time", insert['plan'])
+        self.assertEqual(Message.query.filter_by(text="explain me").count(), 1)
+
+    def test_only_plain_selects_analyzed(self):
+        """Data-modifying CTEs and locking reads get a plain EXPLAIN"""
+
+        self.assertTrue(can_analyze("SELECT users.id FROM users"))
+        self.assertFalse(can_analyze("WITH moved AS (DELETE FROM messages "
+                                     "RETURNING *) SELECT count(*) FROM moved"))
+        self.assertFalse(can_analyze("SELECT jobs.id FROM jobs LIMIT 1 "
+                                     "FOR UPDATE SKIP LOCKED"))
+        self.assertFalse(can_analyze("SELECT * FROM t FOR NO KEY UPDATE"))
+        self.assertFalse(can_analyze("select * from t for share"))
+
+    def test_secrets_redacted(self):
+        """Password hashes, tokens and emails never reach the log"""
+
+        User.signup("secretuser", "secret@test.com", "HASHED_PASSWORD", None)
+        db.session.commit()
+
+        [insert] = [record for record in self.records()
+                    if record['normalized'].startswith("INSERT INTO users")]
+        self.assertEqual(insert['params']['password'], "REDACTED")
+        self.assertEqual(insert['params']['email'], "REDACTED")
+        self.assertEqual(insert['params']['username'], "secretuser")
+        self.assertEqual(short_params(["$2b$12$abcdefghijklmnopqrstuv", 1]),
+                         ["REDACTED", 1])
+
+    def test_summarize(self):
+        """Summaries group by statement and rank by total time"""
+
+        records = [
+            {'fingerprint': 'a', 'normalized': 'A', 'ms': 300, 'source': 'x',
+             'params': [1], 'plan': 'plan a'},
+            {'fingerprint': 'b', 'normalized': 'B', 'ms': 500, 'source': 'y',
+             'params': [2], 'plan': None},
+            {'fingerprint': 'a', 'normalized': 'A', 'ms': 400, 'source': 'z',
+             'params': [3], 'plan': None},
+        ]
+
+        [first, second] = summarize(records)
+
+        self.assertEqual((first['normalized'], first['count'], first['total_ms'],
+                          first['max_ms']), ('A', 2, 700, 400))
+        self.assertEqual(first['sources'], ['x', 'z'])
+        self.assertEqual(first['params'], [3])
+        self.assertEqual(first['plan'], 'plan a')
+        self.assertEqual(second['normalized'], 'B')
+        self.assertEqual(summarize(records, top=1), [first])
@@ -0,0 +1,116 @@
+"""Follow suggestion tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_suggestions.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, FollowSuggestion
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app
+from suggestions import compute_suggestions, suggestions_for
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class SuggestionsTestCase(TestCase):
+    """Test "who to follow" suggestions."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        u1 = User.signup("testuser", "test@test.com", "HASHED_PASSWORD","/static/images/default-pic.png")
+        u2 = User.signup("test2user", "test2@test.com", "HASHED_PASSWORD2","/static/images/default-pic.png")
+        u3 = User.signup("test3user", "test3@test.com", "HASHED_PASSWORD3","/static/images/default-pic.png")
+        u4 = User.signup("test4user", "test4@test.com", "HASHED_PASSWORD4","/static/images/default-pic.png")
+        db.session.commit()
+
+        # u1 follows u2 and u3, who both follow u4
+        db.session.add_all([
+            Follows(user_following_id=u1.id, user_being_followed_id=u2.id),
+            Follows(user_following_id=u1.id, user_being_followed_id=u3.id),
+            Follows(user_following_id=u2.id, user_being_followed_id=u4.id),
+            Follows(user_following_id=u3.id, user_being_followed_id=u4.id),
+            Follows(user_following_id=u2.id, user_being_followed_id=u1.id),
+            Follows(user_following_id=u4.id, user_being_followed_id=u3.id),
+        ])
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.u3_id = u3.id
+        self.u4_id = u4.id
+
+    def tearDown(self):
+
+        db.session.rollback()
+
+    def test_compute_suggestions(self):
+        """Friends of friends are suggested, best-connected first"""
+
+        compute_suggestions(batch_size=2)
+
+        rows = (FollowSuggestion.query
+                .filter_by(user_id=self.u1_id)
+                .all())
+        self.assertEqual([(row.suggested_user_id, row.score) for row in rows],
+                         [(self.u4_id, 2)])
+
+        u2_rows = FollowSuggestion.query.filter_by(user_id=self.u2_id).all()
+        self.assertEqual([(row.suggested_user_id, row.score) for row in u2_rows],
+                         [(self.u3_id, 2)])
+
+        # never suggest yourself
+        self.assertEqual(FollowSuggestion.query
+                         .filter_by(user_id=self.u4_id)
+                         .count(), 0)
+
+    def test_suggestions_skip_new_follows(self):
+        """Someone followed after the job ran is no longer suggested"""
+
+        compute_suggestions()
+        u1 = User.query.get(self.u1_id)
+        self.assertEqual([user.id for user in suggestions_for(u1)],
+                         [self.u4_id])
+
+        db.session.add(Follows(user_following_id=self.u1_id,
+                               user_being_followed_id=self.u4_id))
+        db.session.commit()
+
+        self.assertEqual(suggestions_for(u1), [])
+
+    def test_homepage_sidebar(self):
+        """Suggestions show up on the homepage"""
+
+        compute_suggestions()
+
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session["curr_user"] = self.u1_id
+
+            resp = client.get('/')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Who to follow", html)
+            self.assertIn("@test4user", html)
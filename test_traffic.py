@@ -0,0 +1,184 @@
+"""Traffic recording and replay tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_traffic.py
+
+
+import json
+import os
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from flask import Flask, g, request
+from werkzeug.serving import make_server
+
+from models import db, User, Message, Follows
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app
+import replay
+import traffic
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.create_all()
+
+
+class RecorderTestCase(TestCase):
+    """Test recording requests."""
+
+    def setUp(self):
+        self.log = tempfile.NamedTemporaryFile(delete=False)
+        self.log.close()
+
+        self.app = Flask(__name__)
+        self.app.config['TRAFFIC_LOG'] = self.log.name
+
+        @self.app.before_request
+        def no_user():
+            g.user = None
+
+        @self.app.route('/search')
+        def search():
+            request.args.get('q')
+            request.args.get('page')
+            return "results"
+
+        traffic.init_app(self.app)
+
+    def tearDown(self):
+        os.unlink(self.log.name)
+
+    def test_record(self):
+        """Requests are logged with only the allowed query parameters"""
+
+        with self.app.test_client() as client:
+            client.get('/search?q=secret&page=2')
+            client.post('/search')
+
+        with open(self.log.name) as file:
+            lines = [json.loads(line) for line in file]
+
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[0]['path'], '/search?page=2')
+        self.assertEqual(lines[0]['endpoint'], 'search')
+        self.assertEqual(lines[0]['status'], 200)
+        self.assertIsNone(lines[0]['user_id'])
+        self.assertEqual(lines[1]['method'], 'POST')
+        self.assertEqual(lines[1]['status'], 405)
+
+    def test_app_params(self):
+        """The app's cursor, paging and sort parameters are recorded"""
+
+        params = traffic.read_params(app)
+
+        self.assertLessEqual(
+            {'since_id', 'since_timestamp', 'before', 'before_id', 'sort',
+             'page', 'format', 'limit'},
+            params)
+        self.assertIn('q', params)
+
+
+class ReplayTestCase(TestCase):
+    """Test replaying recorded requests."""
+
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        u1 = User.signup("testuser", "test@test.com", "HASHED_PASSWORD", None)
+        db.session.commit()
+        self.u1_id = u1.id
+
+        now = time.time()
+        self.records = [
+            {'ts': now, 'method': 'GET',
+             'path': f'/users/{self.u1_id}/following', 'endpoint': 'show_following',
+             'user_id': self.u1_id, 'status': 200, 'ms': 10.0},
+            {'ts': now + 0.1, 'method': 'GET', 'path': f'/users/{self.u1_id}',
+             'endpoint': 'users_show', 'user_id': None, 'status': 200, 'ms': 5.0},
+            {'ts': now + 0.2, 'method': 'POST', 'path': '/messages/new',
+             'endpoint': 'messages_add', 'user_id': self.u1_id, 'status': 302,
+             'ms': 20.0},
+        ]
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_split(self):
+        """Writes are skipped; each user's requests stay in one share"""
+
+        shares, skipped = replay.split(self.records, 2)
+
+        self.assertEqual(skipped, 1)
+        self.assertEqual(sum(len(share) for share in shares), 2)
+        self.assertIn(self.records[0], shares[self.u1_id % 2])
+
+    def test_replay_share(self):
+        """Requests are sent as the recorded user and timed per route"""
+
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+
+        try:
+            cookies = replay.session_cookies({self.u1_id}, app.secret_key)
+            results, behind = replay.replay_share(
+                f"http://127.0.0.1:{server.port}", self.records[:2],
+                speed=0, start_at=time.time(), cookies=cookies)
+        finally:
+            server.shutdown()
+            thread.join()
+
+        # following pages render (instead of redirecting) only when logged in
+        self.assertEqual([(endpoint, status) for endpoint, _, status in results],
+                         [('show_following', 200), ('users_show', 200)])
+        self.assertEqual(behind, 0)
+
+        lines = replay.report(self.records, results)
+        self.assertEqual(len(lines), 3)
+        self.assertIn('show_following', lines[1] + lines[2])
+
+    def test_replay_cursor(self):
+        """A recorded delta request keeps its cursor when replayed"""
+
+        msg = Message(text="hello", user_id=self.u1_id)
+        db.session.add(msg)
+        db.session.commit()
+
+        url = f'/api/users/{self.u1_id}/messages?since_id={msg.id}&q=secret'
+        with app.test_request_context(url):
+            path = traffic.sanitized_path(
+                traffic.read_params(app) - traffic.CONTENT_PARAMS)
+        self.assertEqual(
+            path, f'/api/users/{self.u1_id}/messages?since_id={msg.id}')
+
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+
+        try:
+            record = {'ts': time.time(), 'method': 'GET', 'path': path,
+                      'endpoint': 'api_user_messages', 'user_id': None,
+                      'status': 304, 'ms': 5.0}
+            results, _ = replay.replay_share(
+                f"http://127.0.0.1:{server.port}", [record],
+                speed=0, start_at=time.time(), cookies={})
+        finally:
+            server.shutdown()
+            thread.join()
+
+        # nothing is newer than the cursor; without it the message comes back
+        self.assertEqual(results[0][2], 304)
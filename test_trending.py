@@ -0,0 +1,220 @@
+"""Trending tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_trending.py
+
+
+import os
+import threading
+from unittest import TestCase
+from unittest.mock import patch
+
+from sqlalchemy.exc import OperationalError
+
+from models import db, User, Message, Follows, TrendingScore
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app
+from trending import TrendingTracker, EPOCH, LIKE_WEIGHT, log2_add
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class FakeClock:
+    """Clock we can move forward by hand."""
+
+    def __init__(self):
+        self.now = EPOCH + 1000
+
+    def __call__(self):
+        return self.now
+
+
+class TrendingTrackerTestCase(TestCase):
+    """Test the in-memory tracker."""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.tracker = TrendingTracker(half_life=100, capacity=3, top_n=2,
+                                       clock=self.clock)
+
+    def test_likes_rank_higher(self):
+        """A liked message outranks one that was only posted"""
+
+        self.tracker.record_message(1)
+        self.tracker.record_message(2)
+        self.tracker.record_like(2)
+
+        self.assertEqual(self.tracker.top_ids(), [2, 1])
+
+    def test_recent_activity_wins(self):
+        """An old like is worth less than a new one"""
+
+        self.tracker.record_like(1)
+        self.tracker.record_like(1)
+        self.clock.now += 300
+        self.tracker.record_like(2)
+
+        self.assertEqual(self.tracker.top_ids(), [2, 1])
+
+    def test_unlike_and_discard(self):
+        """Unliking takes the like's weight back out; discard forgets"""
+
+        self.tracker.record_message(1)
+        self.tracker.record_like(1)
+        self.tracker.record_unlike(1)
+        self.tracker.record_like(2)
+
+        scores = self.tracker.scores()
+        self.assertAlmostEqual(scores[1], self.tracker._event_score(1.0))
+        self.assertEqual(self.tracker.top_ids(), [2, 1])
+
+        self.tracker.discard(2)
+        self.assertEqual(self.tracker.top_ids(), [1])
+
+    def test_unlike_old_like(self):
+        """Unliking removes the like's weight from when it was made"""
+
+        self.tracker.record_message(1)
+        liked_at = self.clock.now
+        self.tracker.record_like(1)
+        self.clock.now += 500
+
+        self.tracker.record_unlike(1, liked_at)
+        self.assertAlmostEqual(self.tracker.scores()[1],
+                               self.tracker._event_score(1.0, liked_at))
+
+    def test_bounded(self):
+        """Never holds more than twice `capacity` messages"""
+
+        for id in range(20):
+            self.clock.now += 1
+            self.tracker.record_message(id)
+
+        self.assertLessEqual(len(self.tracker.scores()), 6)
+        self.assertEqual(self.tracker.top_ids(), [19, 18])
+
+
+class TrendingViewTestCase(TestCase):
+    """Test trending page and score snapshots."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        u1 = User.signup("testuser", "test@test.com", "HASHED_PASSWORD","/static/images/default-pic.png")
+        db.session.commit()
+
+        m1 = Message(text = "test message 1", user_id=u1.id)
+        m2 = Message(text = "test message 2", user_id=u1.id)
+        db.session.add_all([m1, m2])
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.m1_id = m1.id
+        self.m2_id = m2.id
+
+    def tearDown(self):
+
+        db.session.rollback()
+
+    def test_sync_merges_workers(self):
+        """Two trackers' events both end up in the stored scores"""
+
+        worker1 = TrendingTracker()
+        worker2 = TrendingTracker()
+
+        worker1.record_like(self.m1_id)
+        worker2.record_like(self.m2_id)
+        worker2.record_like(self.m2_id)
+
+        worker1.sync()
+        worker2.sync()
+        worker1.sync()
+
+        self.assertEqual(TrendingScore.query.count(), 2)
+        self.assertEqual(worker1.top_ids(), [self.m2_id, self.m1_id])
+
+    def test_sync_inserts_race(self):
+        """A new message another worker is storing at the same time is
+        merged into, not inserted twice"""
+
+        worker = TrendingTracker()
+        worker.record_like(self.m1_id)
+
+        # another worker has inserted the row but not committed yet
+        other = db.engine.connect()
+        transaction = other.begin()
+        other.execute(TrendingScore.__table__.insert(),
+                      {"message_id": self.m1_id, "score": 10.0})
+
+        errors = []
+
+        def sync():
+            with app.app_context():
+                try:
+                    worker.sync()
+                except Exception as exc:
+                    errors.append(exc)
+                finally:
+                    db.session.remove()
+
+        thread = threading.Thread(target=sync)
+        thread.start()
+        thread.join(0.5)
+        self.assertTrue(thread.is_alive())  # waiting on the other insert
+        transaction.commit()
+        other.close()
+        thread.join()
+
+        self.assertEqual(errors, [])
+        [stored] = TrendingScore.query.all()
+        self.assertAlmostEqual(
+            stored.score, log2_add(10.0, worker._event_score(LIKE_WEIGHT)),
+            places=3)
+
+    def test_failed_sync_keeps_events(self):
+        """Events survive a sync that fails, and maybe_sync doesn't raise"""
+
+        worker = TrendingTracker(sync_interval=0)
+        worker.record_like(self.m1_id)
+
+        with patch.object(TrendingTracker, '_store',
+                          side_effect=OperationalError("stmt", {}, Exception())):
+            with self.assertLogs('trending'):
+                worker.maybe_sync()
+
+        worker.sync()
+        self.assertEqual(TrendingScore.query.count(), 1)
+
+    def test_trending_page(self):
+        """Liked messages show up on the trending page"""
+
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session["curr_user"] = self.u1_id
+
+            client.post(f'/messages/{self.m2_id}/like')
+            resp = client.get('/trending')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("test message 2", html)
@@ -57,8 +57,8 @@ class UserModelTestCase(TestCase):
     def test_user_model(self):
         """Does basic model work?"""
 
-        self.assertEqual(len(self.u1.messages), 0)
-        self.assertEqual(len(self.u1.followers), 0)
+        self.assertEqual(self.u1.messages.count(), 0)
+        self.assertEqual(self.u1.followers.count(), 0)
 
     def test_repr(self):
         """Does the repr return the correct info """
@@ -84,6 +84,58 @@ class UserModelTestCase(TestCase):
 
         self.assertTrue(self.u1.is_followed_by(self.u2))
 
+    def test_follow_unfollow(self):
+        """Do follow/unfollow write follows rows directly """
+
+        self.assertTrue(self.u1.follow(self.u2.id))
+        self.assertFalse(self.u1.follow(self.u2.id))
+        self.assertTrue(self.u1.is_following(self.u2))
+        self.assertTrue(self.u2.is_followed_by(self.u1))
+
+        self.assertTrue(self.u1.unfollow(self.u2.id))
+        self.assertFalse(self.u1.unfollow(self.u2.id))
+        self.assertFalse(self.u1.is_following(self.u2))
+
+    def test_follow_many(self):
+        """Does follow_many report a status for each user, in order"""
+
+        u3 = User.signup("test3user", "test3@test.com", "HASHED_PASSWORD3", None)
+        db.session.commit()
+        self.u1.follow(u3.id)
+
+        results = self.u1.follow_many(["@test2user", u3.id, "nobody",
+                                       self.u1.id, None, self.u2.id])
+        self.assertEqual([result["status"] for result in results],
+                         ["followed", "unchanged", "not_found", "self",
+                          "invalid", "followed"])
+        self.assertEqual(results[0]["id"], self.u2.id)
+        self.assertEqual(self.u1.following.count(), 2)
+
+        results = self.u1.follow_many(["test2user", "test3user", "nobody"],
+                                      following=False)
+        self.assertEqual([result["status"] for result in results],
+                         ["unfollowed", "unfollowed", "not_found"])
+        self.assertEqual(self.u1.following.count(), 0)
+
+        # ids Postgres can't hold are invalid, not an error
+        results = self.u1.follow_many([2**31, -2**63, 2**31 - 1])
+        self.assertEqual([result["status"] for result in results],
+                         ["invalid", "invalid", "not_found"])
+
+    def test_delete_keeps_liked_messages(self):
+        """Deleting a user removes their likes, not the messages they liked """
+
+        msg = Message(text="liked message", user_id=self.u2.id)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
+        self.u1.like_message(msg)
+
+        db.session.delete(self.u1)
+        db.session.commit()
+
+        self.assertIsNotNone(Message.query.get(msg_id))
+
     def test_signup(self):
         """Does User.signup successfully create a new user """
 
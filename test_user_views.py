@@ -5,11 +5,12 @@
 #    python -m unittest test_user_views.py
 
 
+import gzip
 import os
 from unittest import TestCase
 from sqlalchemy.exc import IntegrityError
 from flask import Flask, session
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, FollowSuggestion
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
 # before we import our app, since that will have already
@@ -19,7 +20,8 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
 # Now we can import app
 
-from app import app
+from app import app, make_api_token
+from suggestions import suggestions_for
 app.config['WTF_CSRF_ENABLED'] = False
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -189,6 +191,66 @@ class UserViewsTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
 
 
+    def test_bulk_follows(self):
+        """Test following and unfollowing many users through the API"""
+
+        u1 = User.query.get(self.u1_id)
+        token = make_api_token(u1)
+        u1.follow(self.u4_id)
+
+        with app.test_client() as client:
+            resp = client.post('/api/follows/bulk',
+                               headers={"Authorization": f"Bearer {token}"},
+                               json={"follow": ["test2user", self.u3_id,
+                                                "nobody"],
+                                     "unfollow": ["@test4user"]})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual([r["status"] for r in resp.json["follow"]],
+                             ["followed", "followed", "not_found"])
+            self.assertEqual(resp.json["unfollow"],
+                             [{"user": "@test4user", "id": self.u4_id,
+                               "status": "unfollowed"}])
+            self.assertEqual(
+                {id for (id,) in User.query.get(self.u1_id).following_ids()},
+                {self.u2_id, self.u3_id})
+
+            resp = client.post('/api/follows/bulk',
+                               headers={"Authorization": f"Bearer {token}"},
+                               json={"follow": "test2user"})
+            self.assertEqual(resp.status_code, 400)
+
+            resp = client.post('/api/follows/bulk',
+                               json={"follow": ["test2user"]})
+            self.assertEqual(resp.status_code, 401)
+
+    def test_follow_users_command(self):
+        """Test following the users listed in a file"""
+
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=["follow-users", "testuser", "-",
+                                     "--batch-size", "2"],
+                               input="test2user\nnobody\ntest3user\n")
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("line 2: not_found", result.output)
+        self.assertIn("followed: 2", result.output)
+        self.assertEqual(
+            Follows.query.filter_by(user_following_id=self.u1_id).count(), 2)
+
+    def test_follow_users_command_ids(self):
+        """Test lines that aren't user ids are reported, not an error"""
+
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=["follow-users", "testuser", "-", "--ids"],
+                               input=f"{self.u2_id}\n\u00b2\n"
+                                     f"99999999999\n{'9' * 5000}\n")
+
+        self.assertEqual(result.exit_code, 0)
+        for line in (2, 3, 4):
+            self.assertIn(f"line {line}: invalid", result.output)
+        self.assertIn("followed: 1", result.output)
+
     def test_following_while_logged_out(self):
         """Test to see if you are disallowed from visiting
         a users following/follower page while logged out"""
@@ -251,6 +313,61 @@ class UserViewsTestCase(TestCase):
             self.assertIn("Join Warbler today.",html)
             self.assertEqual(resp.status_code, 200)
 
+    def test_deleted_user_locked_out(self):
+        """Test a deleted account's password, tokens and sessions stop working"""
+
+        u2 = User.query.get(self.u2_id)
+        token = make_api_token(u2)
+
+        with app.test_client() as client, app.test_client() as other_client:
+            for each in (client, other_client):
+                with each.session_transaction() as change_session:
+                    change_session["curr_user"] = self.u2_id
+            client.post("/users/delete")
+
+            self.assertFalse(User.authenticate(f"deleted-{self.u2_id}",
+                                               "HASHED_PASSWORD2"))
+            resp = client.post('/api/follows/bulk',
+                               headers={"Authorization": f"Bearer {token}"},
+                               json={"follow": [self.u1_id]})
+            self.assertEqual(resp.status_code, 401)
+
+            resp = other_client.post("/messages/new", data={"text": "still here?"})
+            self.assertEqual(resp.location, "/")
+            self.assertEqual(Message.query.filter_by(text="still here?").count(), 0)
+
+    def test_deleted_prefix_reserved(self):
+        """Test usernames kept for deleted accounts can't be signed up with"""
+
+        with app.test_client() as client:
+            resp = client.post("/signup", data={"username": "deleted-12345",
+                                                "email": "new@test.com",
+                                                "password": "password"})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("That username is reserved.", resp.get_data(as_text=True))
+            self.assertIsNone(User.query.filter_by(username="deleted-12345").first())
+
+    def test_deleted_user_hidden(self):
+        """Test deleted accounts are left out of lists, profiles and suggestions"""
+
+        db.session.add(FollowSuggestion(user_id=self.u1_id,
+                                        suggested_user_id=self.u2_id, score=1))
+        User.query.get(self.u2_id).mark_deleted()
+        db.session.commit()
+
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session["curr_user"] = self.u1_id
+
+            with client.get("/users") as resp:
+                html = resp.get_data(as_text=True)
+            self.assertNotIn(f"deleted-{self.u2_id}", html)
+            self.assertIn("test3user", html)
+            self.assertEqual(client.get(f"/users/{self.u2_id}").status_code, 404)
+
+        self.assertEqual(suggestions_for(User.query.get(self.u1_id)), [])
+
 
     #####################Testing status codes/html from get requests###################
 
@@ -285,6 +402,66 @@ class UserViewsTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn(f"@{u1.username}",html)
 
+    def test_list_users_streamed(self):
+        """Test the user list is streamed, gzipped when accepted"""
+
+        with app.test_client() as client:
+            resp = client.get("/users", headers={"Accept-Encoding": "gzip"})
+            self.assertTrue(resp.is_streamed)
+            self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+
+            html = gzip.decompress(resp.get_data()).decode()
+            self.assertIn("@test3user", html)
+            self.assertIn("</html>", html)
+
+            resp = client.get("/users?q=nobody")
+            self.assertNotIn("Content-Encoding", resp.headers)
+            self.assertIn("Sorry, no users found", resp.get_data(as_text=True))
+
+    def test_streamed_page_flash(self):
+        """Test a streamed page shows a flashed message only once"""
+
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session["_flashes"] = [("success", "Streamed hello")]
+
+            self.assertIn("Streamed hello",
+                          client.get("/users").get_data(as_text=True))
+            self.assertNotIn("Streamed hello",
+                             client.get("/users").get_data(as_text=True))
+
+    def test_autocomplete_users(self):
+        """Test username autocomplete by prefix"""
+
+        with app.test_client() as client:
+            resp = client.get("/api/users/autocomplete?q=TEST2")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual([user["username"] for user in resp.json["users"]],
+                             ["test2user"])
+
+            resp = client.get("/api/users/autocomplete?q=test&limit=2")
+            self.assertEqual([user["username"] for user in resp.json["users"]],
+                             ["test2user", "test3user"])
+
+            # LIKE wildcards are matched literally
+            resp = client.get("/api/users/autocomplete?q=test_")
+            self.assertEqual(resp.json["users"], [])
+
+            resp = client.get("/api/users/autocomplete?q=")
+            self.assertEqual(resp.json["users"], [])
+
+    def test_autocomplete_renamed_user(self):
+        """Test autocomplete follows username changes"""
+
+        u2 = User.query.get(self.u2_id)
+        u2.username = "renamed"
+        db.session.commit()
+
+        with app.test_client() as client:
+            resp = client.get("/api/users/autocomplete?q=ren")
+            self.assertEqual([user["id"] for user in resp.json["users"]],
+                             [self.u2_id])
+
     def test_user_profile(self):
         """Test if it shows user profile correctly """
 
@@ -0,0 +1,64 @@
+"""Template precompilation and warm-up tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_warmup.py
+
+
+import os
+import tempfile
+from unittest import TestCase
+
+from jinja2 import FileSystemBytecodeCache
+
+from models import db
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+# Now we can import app
+
+from app import app
+import warmup
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.create_all()
+
+
+class WarmupTestCase(TestCase):
+    """Test compiling templates and warming a worker."""
+
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.old_cache = app.jinja_env.bytecode_cache
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(self.cache_dir.name)
+        app.jinja_env.cache.clear()
+
+    def tearDown(self):
+        app.jinja_env.bytecode_cache = self.old_cache
+        app.jinja_env.cache.clear()
+        self.cache_dir.cleanup()
+
+    def test_compile_templates(self):
+        """Every template is compiled into the bytecode cache"""
+
+        timings = warmup.compile_templates(app)
+
+        self.assertIn("base.html", timings)
+        self.assertIn("messages/_item.html", timings)
+        self.assertEqual(len(os.listdir(self.cache_dir.name)), len(timings))
+
+    def test_warm(self):
+        """Warming loads templates and requests the given routes"""
+
+        with self.assertLogs(warmup.log, level="INFO") as logs:
+            warmup.warm(app, ["/login", "/signup"])
+
+        self.assertTrue(os.listdir(self.cache_dir.name))
+        self.assertTrue(any("warmed /login (200)" in line for line in logs.output))
+        self.assertTrue(any("warmed /signup (200)" in line for line in logs.output))
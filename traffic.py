@@ -0,0 +1,113 @@
+"""Record production traffic for replay (see replay.py).
+
+With TRAFFIC_LOG set to a file path, each request (or a TRAFFIC_SAMPLE
+fraction of them) is appended to it as one JSON line:
+
+    {"ts": 1760000000.123, "method": "GET", "path": "/users/12",
+     "endpoint": "users_show", "user_id": 7, "status": 200, "ms": 14.2}
+
+Lines are sanitized: no headers, cookies or form bodies, and only the
+query parameters the app's code reads with `request.args.get(...)` are
+kept, minus CONTENT_PARAMS (search terms etc. are dropped). Each line is
+written with a single append, so several workers can share a file.
+"""
+
+import ast
+import inspect
+import json
+import os
+import random
+import sys
+import time
+from urllib.parse import urlencode
+
+from flask import g, request
+
+from warmup import WARMUP_HEADER
+
+# Query parameters that carry what users typed, never recorded
+CONTENT_PARAMS = {'q'}
+
+# Static files and long-lived streams say nothing about request cost
+SKIP_ENDPOINTS = {'static', 'stream'}
+
+
+def read_params(app):
+    """Names of the query parameters read in the modules defining `app`'s
+    views, i.e. `request.args.get('name', ...)` calls with a literal name."""
+
+    names = set()
+    modules = {sys.modules.get(view.__module__)
+               for view in app.view_functions.values()}
+    for module in modules:
+        try:
+            tree = ast.parse(inspect.getsource(module))
+        except (OSError, TypeError):
+            continue
+        for node in ast.walk(tree):
+            if (isinstance(node, ast.Call)
+                    and isinstance(node.func, ast.Attribute)
+                    and node.func.attr in ('get', 'getlist')
+                    and isinstance(node.func.value, ast.Attribute)
+                    and node.func.value.attr == 'args'
+                    and isinstance(node.func.value.value, ast.Name)
+                    and node.func.value.value.id == 'request'
+                    and node.args
+                    and isinstance(node.args[0], ast.Constant)
+                    and isinstance(node.args[0].value, str)):
+                names.add(node.args[0].value)
+    return names
+
+
+def sanitized_path(params):
+    """The request path plus any query parameters in `params`."""
+
+    args = [(key, value) for key, value in request.args.items(multi=True)
+            if key in params]
+    return f"{request.path}?{urlencode(args)}" if args else request.path
+
+
+def init_app(app):
+    """Append a line per request to app.config['TRAFFIC_LOG'], if set."""
+
+    path = app.config.get('TRAFFIC_LOG')
+    if not path:
+        return
+
+    sample = app.config.get('TRAFFIC_SAMPLE', 1.0)
+
+    # Views are registered after this runs, so look at them on first use
+    params = None
+
+    @app.before_request
+    def start_recording():
+        if (request.endpoint not in SKIP_ENDPOINTS
+                and WARMUP_HEADER not in request.headers
+                and random.random() < sample):
+            g.traffic_started = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        nonlocal params
+        if 'traffic_started' in g:
+            if params is None:
+                params = read_params(app) - CONTENT_PARAMS
+            user = g.get('user')
+            line = json.dumps({
+                'ts': round(time.time(), 3),
+                'method': request.method,
+                'path': sanitized_path(params),
+                'endpoint': request.endpoint,
+                'user_id': user.id if user else None,
+                'status': response.status_code,
+                'ms': round((time.perf_counter() - g.traffic_started) * 1000, 1),
+            })
+
+            # O_APPEND writes this small go to the end of the file in one piece
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+            try:
+                os.write(fd, (line + "\n").encode())
+            finally:
+                os.close(fd)
+
+        return response
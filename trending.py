@@ -0,0 +1,283 @@
+"""Incrementally maintained "trending warbles" scores for Warbler.
+
+Every like, unlike and new message nudges a per-message score that decays
+exponentially with time. Scores are kept in log2 space relative to a fixed
+epoch, so decay never has to be applied to stored values: a newer event simply
+carries more weight than an older one, and ranking by stored score is the same
+as ranking by decayed score at any moment.
+
+The tracker keeps at most `capacity` messages in memory, keeps the current
+top-N ranking ready to serve, and periodically snapshots its scores into the
+`trending_scores` table, which is also how a fresh worker (or any other worker)
+picks up events it didn't see itself.
+"""
+
+import logging
+import math
+import threading
+import time
+
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import SQLAlchemyError
+
+from models import db, Message, TrendingScore
+
+log = logging.getLogger(__name__)
+
+# Reference point for log-space scores (2022-01-01 UTC).
+EPOCH = 1640995200
+
+NEW_MESSAGE_WEIGHT = 1.0
+LIKE_WEIGHT = 2.0
+
+
+def log2_add(a, b):
+    """Return log2(2**a + 2**b) without overflowing."""
+
+    if a is None:
+        return b
+    if b is None:
+        return a
+
+    high, low = max(a, b), min(a, b)
+    return high + math.log2(1 + 2 ** (low - high))
+
+
+def log2_sub(a, b):
+    """Return log2(2**a - 2**b), or None if the result is not positive."""
+
+    if a is None or b is None:
+        return a
+    if b >= a:
+        return None
+
+    return a + math.log2(1 - 2 ** (b - a))
+
+
+class TrendingTracker:
+    """Bounded, time-decayed top-K scores for messages."""
+
+    def __init__(self, half_life=6 * 60 * 60, capacity=1000, top_n=50,
+                 sync_interval=60, clock=time.time):
+        self.half_life = half_life
+        self.capacity = capacity
+        self.top_n = top_n
+        self.sync_interval = sync_interval
+        self.clock = clock
+
+        self._scores = {}
+        self._pending = {}
+        self._top = []
+        self._dirty = False
+        self._loaded = False
+        self._last_sync = clock()
+        self._lock = threading.Lock()
+
+    def _event_score(self, weight, at=None):
+        """Log-space score contributed by an event of `weight` happening at
+        unix time `at` (default: now)."""
+
+        at = self.clock() if at is None else at
+        return math.log2(weight) + (at - EPOCH) / self.half_life
+
+    def _trim(self):
+        """Evict the lowest-scored messages once we are well over capacity."""
+
+        if len(self._scores) <= self.capacity * 2:
+            return
+
+        keep = sorted(self._scores.items(), key=lambda item: item[1],
+                      reverse=True)[:self.capacity]
+        self._scores = dict(keep)
+
+    def _change(self, message_id, weight, add=True, at=None):
+        with self._lock:
+            current = self._scores.get(message_id)
+            event = self._event_score(weight, at)
+            added, removed = self._pending.get(message_id, (None, None))
+
+            if add:
+                score = log2_add(current, event)
+                added = log2_add(added, event)
+            else:
+                score = log2_sub(current, event)
+                removed = log2_add(removed, event)
+
+            self._pending[message_id] = (added, removed)
+
+            if score is None:
+                self._scores.pop(message_id, None)
+            else:
+                self._scores[message_id] = score
+
+            self._trim()
+            self._dirty = True
+
+    def record_message(self, message_id):
+        """A message was just posted."""
+
+        self._change(message_id, NEW_MESSAGE_WEIGHT)
+
+    def record_like(self, message_id):
+        """A message was just liked."""
+
+        self._change(message_id, LIKE_WEIGHT)
+
+    def record_unlike(self, message_id, liked_at=None):
+        """A like was taken back; remove the weight it was given when it was
+        made, at unix time `liked_at` (if unknown, now)."""
+
+        self._change(message_id, LIKE_WEIGHT, add=False, at=liked_at)
+
+    def discard(self, message_id):
+        """Forget a message entirely (e.g. it was deleted)."""
+
+        with self._lock:
+            self._pending.pop(message_id, None)
+            if self._scores.pop(message_id, None) is not None:
+                self._dirty = True
+
+    def top_ids(self):
+        """Return the ids of the current top-N messages, best first.
+
+        The ranking is rebuilt at most once per change, so repeated reads
+        between updates are just a list copy.
+        """
+
+        with self._lock:
+            if self._dirty or not self._top:
+                ranked = sorted(self._scores.items(), key=lambda item: item[1],
+                                reverse=True)
+                self._top = [message_id for message_id, _ in ranked[:self.top_n]]
+                self._dirty = False
+
+            return list(self._top)
+
+    def scores(self):
+        """Return a copy of all tracked scores (message_id -> log2 score)."""
+
+        with self._lock:
+            return dict(self._scores)
+
+    ##########################################################################
+    # Persistence
+    #
+    # Each worker only sees its own events, so workers don't overwrite the
+    # snapshot with their partial view. Instead they fold the events seen
+    # since their last sync into the stored scores and then reload the merged
+    # ranking, which is how events from other workers reach this one.
+
+    def load(self):
+        """Seed the tracker from the stored scores, once per process."""
+
+        if not self._loaded:
+            self._reload()
+
+    def _reload(self):
+        rows = (db.session
+                .query(TrendingScore.message_id, TrendingScore.score)
+                .order_by(TrendingScore.score.desc())
+                .limit(self.capacity)
+                .all())
+
+        with self._lock:
+            scores = dict(rows)
+            for message_id, (added, removed) in self._pending.items():
+                scores[message_id] = log2_sub(
+                    log2_add(scores.get(message_id), added), removed)
+            self._scores = {message_id: score
+                            for message_id, score in scores.items()
+                            if score is not None}
+            self._loaded = True
+            self._dirty = True
+
+    def sync(self):
+        """Merge pending events into `trending_scores` and reload the ranking.
+
+        If writing fails, the events are kept for the next sync.
+        """
+
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+        try:
+            if pending:
+                self._store(pending)
+        except BaseException:
+            db.session.rollback()
+            self._restore(pending)
+            raise
+        finally:
+            self._last_sync = self.clock()
+
+        self._reload()
+
+    def _store(self, pending):
+        ids = list(pending)
+        existing = {message_id for (message_id,) in (db.session
+                    .query(Message.id)
+                    .filter(Message.id.in_(ids)))}
+
+        # Rows nobody has stored yet: insert them, skipping any another
+        # worker inserts first (ON CONFLICT waits for it to commit, then
+        # leaves that row to the merge below).
+        new_rows = []
+        for message_id, (added, removed) in pending.items():
+            score = log2_sub(added, removed)
+            if message_id in existing and score is not None:
+                new_rows.append({"message_id": message_id, "score": score})
+        inserted = set()
+        if new_rows:
+            insert = (postgresql.insert(TrendingScore)
+                      .values(new_rows)
+                      .on_conflict_do_nothing()
+                      .returning(TrendingScore.message_id))
+            inserted = {message_id for (message_id,)
+                        in db.session.execute(insert)}
+
+        # Everything else merges into the stored score, under a row lock.
+        rest = [message_id for message_id in ids if message_id not in inserted]
+        stored = dict(db.session
+                      .query(TrendingScore.message_id, TrendingScore.score)
+                      .filter(TrendingScore.message_id.in_(rest))
+                      .with_for_update()
+                      .all()) if rest else {}
+
+        for message_id in rest:
+            if message_id not in stored:
+                continue
+            added, removed = pending[message_id]
+            score = log2_sub(log2_add(stored[message_id], added), removed)
+            if message_id not in existing or score is None:
+                TrendingScore.query.filter_by(message_id=message_id).delete()
+            else:
+                TrendingScore.query.filter_by(
+                    message_id=message_id).update({"score": score})
+
+        db.session.commit()
+
+    def _restore(self, pending):
+        """Put events that couldn't be stored back in front of newer ones."""
+
+        with self._lock:
+            for message_id, (added, removed) in pending.items():
+                newer_added, newer_removed = self._pending.get(message_id,
+                                                               (None, None))
+                self._pending[message_id] = (log2_add(added, newer_added),
+                                             log2_add(removed, newer_removed))
+
+    def maybe_sync(self):
+        """Sync if `sync_interval` seconds have passed since the last sync.
+
+        Called after likes and new messages, which are already committed:
+        a failed sync is logged (and retried next interval), not raised.
+        """
+
+        if self.clock() - self._last_sync >= self.sync_interval:
+            try:
+                self.sync()
+            except SQLAlchemyError:
+                log.exception("couldn't sync trending scores; will retry")
+
+
+tracker = TrendingTracker()
@@ -0,0 +1,86 @@
+"""Template precompilation and worker warm-up.
+
+Jinja compiles each template to Python the first time it's rendered, so a
+fresh worker serves its first requests slowly. To avoid that:
+
+- templates' compiled bytecode is cached on local disk
+  (TEMPLATE_CACHE_DIR), so only the first process on a host compiles;
+- `flask compile-templates` fills that cache ahead of time (gunicorn runs it
+  before starting workers, see gunicorn.conf.py);
+- each worker loads every template when it boots, and can also request a
+  few key routes (WARM_ROUTES) to warm up everything else;
+- the time from boot to the first response faster than
+  FAST_RESPONSE_MS is logged, so we can see how long workers stay cold.
+"""
+
+import logging
+import os
+import time
+
+from flask import g, request
+from jinja2 import FileSystemBytecodeCache
+
+log = logging.getLogger(__name__)
+
+# Marks our own warm-up requests, which don't count as serving traffic
+WARMUP_HEADER = 'X-Warbler-Warmup'
+
+
+def init_app(app):
+    """Set up the template bytecode cache and first-fast-response timing."""
+
+    cache_dir = app.config['TEMPLATE_CACHE_DIR']
+    os.makedirs(cache_dir, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+
+    booted_at = time.perf_counter()
+    first_fast = {}
+
+    @app.before_request
+    def start_timer():
+        if WARMUP_HEADER not in request.headers:
+            g.request_started = time.perf_counter()
+
+    @app.after_request
+    def log_first_fast_response(response):
+        if not first_fast and 'request_started' in g:
+            now = time.perf_counter()
+            elapsed_ms = (now - g.request_started) * 1000
+            if elapsed_ms < app.config['FAST_RESPONSE_MS']:
+                first_fast['at'] = now - booted_at
+                log.info("pid %s: first fast response (%.1f ms) %.2fs after boot",
+                         os.getpid(), elapsed_ms, first_fast['at'])
+        return response
+
+
+def compile_templates(app):
+    """Load every template, compiling any missing from the bytecode cache.
+
+    Returns {template name: seconds taken}.
+    """
+
+    timings = {}
+
+    for name in app.jinja_env.list_templates(extensions=['html']):
+        start = time.perf_counter()
+        app.jinja_env.get_template(name)
+        timings[name] = time.perf_counter() - start
+
+    return timings
+
+
+def warm(app, routes=()):
+    """Load all templates and request `routes`; log how long it took."""
+
+    start = time.perf_counter()
+    compile_templates(app)
+    log.info("pid %s: loaded templates in %.3fs",
+             os.getpid(), time.perf_counter() - start)
+
+    with app.test_client() as client:
+        for route in routes:
+            route_start = time.perf_counter()
+            response = client.get(route, headers={WARMUP_HEADER: '1'})
+            response.close()
+            log.info("pid %s: warmed %s (%s) in %.3fs", os.getpid(), route,
+                     response.status_code, time.perf_counter() - route_start)